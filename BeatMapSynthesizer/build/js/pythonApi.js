@@ -3,7 +3,7 @@ var __importDefault = (this && this.__importDefault) || function (mod) {
     return (mod && mod.__esModule) ? mod : { "default": mod };
 };
 Object.defineProperty(exports, "__esModule", { value: true });
-exports.convertMusicFile = exports.getObstaclesList = exports.getEventsList = exports.getNotesList = exports.getBeatFeatures = exports.closePythonServer = exports.isPythonServerRunning = exports.pythonRequest = void 0;
+exports.convertMusicFile = exports.releaseSong = exports.segmentSong = exports.runNotesListsJob = exports.cancelJob = exports.getJob = exports.getNotesLists = exports.getNotesList = exports.getBeatFeatures = exports.waitForPythonServer = exports.getServerStatus = exports.closePythonServer = exports.isPythonServerRunning = exports.pythonRequest = void 0;
 const node_fetch_1 = __importDefault(require("node-fetch"));
 const pythonRequest = async (url = '', data) => {
     const options = {
@@ -18,7 +18,9 @@ const pythonRequest = async (url = '', data) => {
     }
     const response = await node_fetch_1.default(`http://127.0.0.1:5000/${url}`, options);
     if (response.ok) {
-        return options.method === 'GET' || url === 'convert_music_file' ? await response.text() : await response.json();
+        return (options.method === 'GET' && !url.startsWith('jobs/') && url !== 'ping') || url === 'convert_music_file' || url === 'release_song'
+            ? await response.text()
+            : await response.json();
     }
     return new Error(response.statusText);
 };
@@ -31,150 +33,73 @@ const closePythonServer = async () => {
     return !!(await exports.pythonRequest('close'));
 };
 exports.closePythonServer = closePythonServer;
+const getServerStatus = () => exports.pythonRequest('ping');
+exports.getServerStatus = getServerStatus;
+/**
+ * Waits until the server answers, it accepts requests from then on
+ * and runs them faster once its status is ready (libraries and models warm).
+ */
+const waitForPythonServer = async (onStatus, pollInterval = 100, timeout = 30000) => {
+    const start = Date.now();
+    while (Date.now() - start < timeout) {
+        try {
+            const status = (await exports.getServerStatus()).data;
+            if (status) {
+                onStatus && onStatus(status);
+                return true;
+            }
+        }
+        catch (e) {
+            // Not listening yet
+        }
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+    }
+    return false;
+};
+exports.waitForPythonServer = waitForPythonServer;
 const getBeatFeatures = (song_path) => exports.pythonRequest('get_beat_features', { song_path });
 exports.getBeatFeatures = getBeatFeatures;
 const getNotesList = (args) => exports.pythonRequest('run_model', args);
 exports.getNotesList = getNotesList;
+const getNotesLists = (args) => exports.pythonRequest('run_models', args);
+exports.getNotesLists = getNotesLists;
+const getJob = (job_id) => exports.pythonRequest(`jobs/${job_id}`);
+exports.getJob = getJob;
+const cancelJob = (job_id) => exports.pythonRequest(`jobs/${job_id}/cancel`, {});
+exports.cancelJob = cancelJob;
 /**
- * Function for writing a list of events.
- * @param args
- * @returns event_list
+ * Maps the difficulties of a song as a server-side job, polling it until it finishes
+ * instead of holding a request open for the whole model run.
+ * @param args same as getNotesLists
+ * @param onProgress called with the job status after every poll
+ * @param pollInterval milliseconds between polls
+ * @returns the notes lists, like getNotesLists
  */
-const getEventsList = (args) => {
-    const { eventColorSwapOffset, notes_list, bpm } = args;
-    // Set an event to be at time 0
-    let events_list = [{ _time: 0, _type: 4, _value: 0 }];
-    /**
-     * _type
-     *  0 : Back Laser
-     *  1 : Track Neons
-     *  2 : Left Laser
-     *  3 : Right Laser
-     *  4 : Primary Light
-     *  5 :
-     *  6 :
-     *  7 :
-     *  8 : Ring Rotation (uses value of 0, swaps rotation each time)
-     *  9 : Small Ring Zoom (uses value of 0, zooms in/out if it is zoomed out/in)
-     * 10 :
-     * 11 :
-     * 12 : Left Laser Speed (value is 0-12, higher value = higher speed)
-     * 13 : Right Laser Speed (value is 0-12, higher value = higher speed)
-     */
-    const eventTypes = {
-        Lights: 4,
-        Lasers: [0, 1, 2, 3],
-        Rings: [8, 9],
-        Speeds: [12, 13],
-    };
-    /**
-     * _value
-     * 0 : Off
-     * 1 : Blue Normal
-     * 2 : Blue Fade In
-     * 3 : Blue Fade Out
-     * 4 :
-     * 5 : Red Normal
-     * 6 : Red Fade In
-     * 7 : Red Fade Out
-     */
-    const eventValues = {
-        Off: 0,
-        Normal: [5, 1],
-        FadeIn: [6, 2],
-        FadeOut: [7, 3],
-    };
-    let lastEventTime = 0;
-    let lastEventColor = 0;
-    let lastEventIntensity = 'Off';
-    let lastEventRing = 0;
-    // Offset is applied to change the lighting every n'th second
-    const eventColorSwapInterval = Math.round(bpm / 60) * eventColorSwapOffset;
-    if (!notes_list || notes_list.length === 0) {
-        throw new Error('Notes list is empty!');
+const runNotesListsJob = async (args, onProgress, pollInterval = 1000) => {
+    let job = (await exports.pythonRequest('jobs', args)).data;
+    if (!job) {
+        throw new Error('Mapping job was not accepted!');
     }
-    const firstNote = notes_list[0];
-    const lastNote = notes_list[notes_list.length - 1];
-    for (const note of notes_list) {
-        // Lights
-        try {
-            if (note === lastNote || note === firstNote) {
-                events_list.push({
-                    _time: note._time,
-                    _type: eventTypes.Lights,
-                    _value: eventValues.Off,
-                });
-            }
-            else if (note._time - lastEventTime > eventColorSwapInterval) {
-                let color = 0;
-                let intensity = 'Normal';
-                if (lastEventIntensity === 'Off' || lastEventIntensity === 'FadeOut') {
-                    intensity = 'FadeIn';
-                    color = lastEventColor === 1 ? 0 : 1;
-                }
-                else if (lastEventIntensity === 'FadeIn') {
-                    intensity = 'Normal';
-                    color = lastEventColor;
-                }
-                else {
-                    intensity = 'FadeOut';
-                    color = lastEventColor;
-                }
-                events_list.push({
-                    _time: note._time,
-                    _type: eventTypes.Lights,
-                    _value: eventValues[intensity][color],
-                });
-                lastEventTime = note._time;
-                lastEventColor = color;
-                lastEventIntensity = intensity;
-            }
-        }
-        catch (error) {
-            console.error(`Lights event writing error: ${JSON.stringify(note, null, 2)}`);
-            console.error(error);
-        }
-        // Rings
-        try {
-            if (lastEventRing > 2) {
-                lastEventRing = 0;
-            }
-            const ring = lastEventRing > 0 ? 1 : 0;
-            events_list.push({
-                _time: note._time,
-                _type: eventTypes.Rings[ring],
-                _value: eventValues.Off,
-            });
-            lastEventRing++;
-        }
-        catch (error) {
-            console.error(`Rings event writing error: ${JSON.stringify(note, null, 2)}`);
-            console.error(error);
-        }
-        // Lasers
-        try {
-            if (note._type !== 3) {
-                events_list.push({
-                    _time: note._time,
-                    _type: eventTypes.Lasers[1],
-                    _value: eventValues.Normal[note._type],
-                });
-            }
-        }
-        catch (error) {
-            console.error(`Lasers event writing error: ${JSON.stringify(note, null, 2)}`);
-            console.error(error);
+    while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+        job = (await exports.getJob(job.id)).data;
+        if (!job) {
+            throw new Error('Mapping job was lost!');
         }
+        onProgress && onProgress(job);
+    }
+    if (job.status !== 'done') {
+        throw new Error(`Mapping job ${job.status}! ${job.error || ''}`);
     }
-    return events_list;
+    return exports.pythonRequest(`jobs/${job.id}/result`);
 };
-exports.getEventsList = getEventsList;
-const getObstaclesList = (args) => {
-    const { notes_list, bpm } = args;
-    let obstacles_list = [];
-    return obstacles_list;
+exports.runNotesListsJob = runNotesListsJob;
+const segmentSong = (song_id) => exports.pythonRequest('segment_song', { song_id });
+exports.segmentSong = segmentSong;
+const releaseSong = async (song_id) => {
+    return !!(await exports.pythonRequest('release_song', { song_id }));
 };
-exports.getObstaclesList = getObstaclesList;
+exports.releaseSong = releaseSong;
 const convertMusicFile = async (song_path, workingDir) => {
     return !!(await exports.pythonRequest('convert_music_file', { song_path, workingDir }));
 };
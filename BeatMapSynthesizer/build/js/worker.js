@@ -258,7 +258,8 @@ class Worker {
             environment: args.environment ?? 'DefaultEnvironment',
             lightsIntensity: args.lightsIntensity ? 11.5 - args.lightsIntensity : 2.5,
             zipFiles: args.zipFiles,
-            seed: seedrandom_1.default(song_name, { entropy: true })(),
+            // Unsigned 32-bit integer, seeds the server's random generator
+            seed: seedrandom_1.default(song_name, { entropy: true }).int32() >>> 0,
             eventColorSwapOffset: 2.5,
         };
         if (!fsx.existsSync(this.song_args.outDir)) {
@@ -272,7 +273,7 @@ class Worker {
         this.tracks = {
             bpm: 0,
             beat_times: [],
-            y: [],
+            song_id: '',
             sr: 0,
             easy: { ...baseLists },
             normal: { ...baseLists },
@@ -287,7 +288,12 @@ class Worker {
         fsx.writeFileSync(path.join(this.tempDir.normalize(), 'songs.json'), JSON.stringify(songs_json, null, 2));
         this.appendMessageTaskLog('Generating beat map');
         await this.runPythonShell();
-        if (this.song_args && this.tracks && (await pythonApi_1.isPythonServerRunning())) {
+        if (this.song_args &&
+            this.tracks &&
+            (await pythonApi_1.waitForPythonServer(status => this.appendMessageTaskLog(`Python server ${status.phase}`)))) {
+            // Converting first also hands the decoded song to the server, so loading it doesn't decode it again
+            this.appendMessageTaskLog('Converting music file');
+            await pythonApi_1.convertMusicFile(this.song_args.song_path, this.song_args.workingDir);
             this.appendMessageTaskLog('Loading Song');
             const modelParams = (await pythonApi_1.getBeatFeatures(this.song_args.song_path)).data;
             this.tracks = {
@@ -300,31 +306,44 @@ class Worker {
                 : [this.song_args.difficulty]).map(difficulty => difficulty.toLowerCase());
             let processedDifficultes = [];
             this.appendMessageTaskLog('Mapping');
+            // Every difficulty is mapped in a single job sharing the song analysis
+            let notesLists;
+            let lastStage = '';
+            try {
+                notesLists = (await pythonApi_1.runNotesListsJob({
+                    model: this.song_args.model,
+                    difficulties: difficulties,
+                    beat_times: this.tracks.beat_times,
+                    bpm: this.tracks.bpm,
+                    version: this.song_args.version,
+                    song_id: this.tracks.song_id,
+                    tempDir: this.tempDir,
+                    seed: this.song_args.seed,
+                    level: { color_swap_offset: this.song_args.eventColorSwapOffset },
+                }, (job) => {
+                    if (job.stage !== lastStage) {
+                        lastStage = job.stage;
+                        this.appendMessageTaskLog(`Mapping: ${job.stage} (${Math.round(job.percent)}%)`);
+                    }
+                })).data;
+            }
+            catch (e) {
+                this.error(e);
+            }
             for (const difficulty of difficulties) {
                 this.appendMessageTaskLog(`Processing ${difficulty}`);
                 try {
-                    this.tracks[difficulty].notes_list = (await pythonApi_1.getNotesList({
-                        model: this.song_args.model,
-                        difficulty: difficulty,
-                        beat_times: this.tracks.beat_times,
-                        bpm: this.tracks.bpm,
-                        version: this.song_args.version,
-                        y: this.tracks.y,
-                        sr: this.tracks.sr,
-                        tempDir: this.tempDir,
-                    })).data;
+                    const result = notesLists?.results[difficulty];
+                    if (result?.error) {
+                        throw new Error(result.error);
+                    }
+                    this.tracks[difficulty].notes_list = result?.data;
                     if (!this.tracks[difficulty].notes_list || !Array.isArray(this.tracks[difficulty].notes_list)) {
                         throw new Error(`Notes list was invalid!\n\t${JSON.stringify(this.tracks[difficulty].notes_list)}`);
                     }
-                    this.tracks[difficulty].events_list = pythonApi_1.getEventsList({
-                        notes_list: this.tracks[difficulty].notes_list,
-                        bpm: this.tracks.bpm,
-                        eventColorSwapOffset: this.song_args.eventColorSwapOffset,
-                    });
-                    this.tracks[difficulty].obstacles_list = pythonApi_1.getObstaclesList({
-                        notes_list: this.tracks[difficulty].notes_list,
-                        bpm: this.tracks.bpm,
-                    });
+                    // Events and obstacles are generated by the server along with the notes
+                    this.tracks[difficulty].events_list = result?.events;
+                    this.tracks[difficulty].obstacles_list = result?.obstacles;
                     processedDifficultes.push(difficulty);
                 }
                 catch (e) {
@@ -334,12 +353,11 @@ class Worker {
                 this.appendMessageTaskLog(`Processing ${difficulty} done!`);
             }
             this.appendMessageTaskLog('Mapping done!');
+            await pythonApi_1.releaseSong(this.tracks.song_id);
             if (processedDifficultes.length > 0) {
                 this.appendMessageTaskLog('Writing files to disk');
                 this.writeInfoFile(processedDifficultes);
                 this.writeLevelFile(processedDifficultes);
-                this.appendMessageTaskLog('Converting music file');
-                await pythonApi_1.convertMusicFile(this.song_args.song_path, this.song_args.workingDir);
                 this.appendMessageTaskLog('Zipping folder');
                 this.zipFiles(processedDifficultes);
                 this.appendMessageTaskLog(`${this.song_args.song_name} | Finished! \n\tLook for ${this.song_args.zipFiles === 1 ? 'zipped folder' : 'folder'} in ${this.song_args.outDir}, ${this.song_args.zipFiles === 1 ? 'unzip the folder, ' : ''}\n\tplace in the 'CustomMusic' folder in Beat Saber's files.`, false);
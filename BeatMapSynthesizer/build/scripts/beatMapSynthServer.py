@@ -1,28 +1,88 @@
 from __future__ import print_function
+import argparse
+import base64
+import bisect
+import cProfile
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
+import importlib
+import importlib.util
+import json
+import multiprocessing
 import os
 import pickle
 import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import uuid
 import warnings
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from flask import Flask
-from flask import jsonify, request
+from flask import copy_current_request_context, jsonify, make_response, request
+import gevent
+from gevent.event import AsyncResult
 from gevent.pywsgi import WSGIServer
-import audioread
-import librosa
-import markovify
+from gevent.threadpool import ThreadPool as CooperativeThreadPool
+from werkzeug.serving import make_server
 import numpy as np
-import pandas as pd
-import scipy
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import MinMaxScaler
-from pydub import AudioSegment
 
 warnings.filterwarnings(
     'ignore',
     "PySoundFile failed. Trying audioread instead.")
 
+# Seconds spent importing each lazily imported library and warming the server up, see warm_up
+startup_times = {}
+_module_start = time.perf_counter()
+
+
+class LazyModule:
+    """
+    Stands in for a module (and the given submodules) until one of its attributes is first used,
+    so that the server answers requests before the heavy scientific libraries are imported.
+    """
+
+    def __init__(self, name, submodules=()):
+        # Prefixed so that they don't hide attributes of the module
+        self._lazy_name = name
+        self._lazy_submodules = submodules
+        self._lazy_module = None
+
+    def _lazy_load(self):
+        if self._lazy_module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self._lazy_name)
+            for submodule in self._lazy_submodules:
+                importlib.import_module(f"{self._lazy_name}.{submodule}")
+            startup_times.setdefault(f"import {self._lazy_name}", time.perf_counter() - start)
+            self._lazy_module = module
+        return self._lazy_module
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+
+# In the order warm_up imports them, so that each library is timed without the ones it shares
+scipy = LazyModule('scipy', ['linalg', 'ndimage', 'sparse', 'sparse.csgraph', 'sparse.linalg'])
+sklearn = LazyModule('sklearn', ['cluster', 'preprocessing'])
+pd = LazyModule('pandas')
+soundfile = LazyModule('soundfile')
+audioread = LazyModule('audioread')
+librosa = LazyModule('librosa')
+markovify = LazyModule('markovify')
+pydub = LazyModule('pydub')
+LAZY_MODULES = [scipy, sklearn, pd, soundfile, audioread, librosa, markovify, pydub]
+
 
 def _print(message=None):
     if message:
@@ -52,6 +112,731 @@ def _print_exception(exception=None, message=None, json_content=None):
         _print()
 
 
+# Metrics
+# Upper bounds, in seconds, of the buckets of every latency histogram
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRIC_HELP = {
+    'beatmap_stage_seconds': 'Wall time of the pipeline stages, a stage includes the stages it runs',
+    'beatmap_request_seconds': 'Wall time of the model requests, including the wait for a worker',
+    'beatmap_model_seconds': 'Wall time of mapping one difficulty with a model',
+    'beatmap_model_load_seconds': 'Wall time of unpickling an HMM model',
+    'beatmap_notes_total': 'Notes written by the models',
+    'beatmap_audio_seconds_total': 'Seconds of audio decoded',
+}
+
+
+def _format_labels(labels):
+    """Formats (name, value) label pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+class Metrics:
+    """
+    Prometheus-style counters and latency histograms, served as text by /metrics.
+    Series are identified by a metric name and its labels.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self, extra=()):
+        """
+        Returns every series in the Prometheus text format, followed by the extra
+        (name, type, help, [(labels, value)]) metrics.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, {'buckets': list(histogram['buckets']), 'sum': histogram['sum'],
+                                       'count': histogram['count']})
+                                for key, histogram in self._histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind, help_text=None):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text or METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        for name, kind, help_text, samples in extra:
+            describe(name, kind, help_text)
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def span(stage):
+    """
+    Times a pipeline stage into the beatmap_stage_seconds histogram,
+    used either as a context manager or as a function decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('beatmap_stage_seconds', time.perf_counter() - start, stage=stage)
+
+
+class SongStore:
+    """
+    Server-side store of decoded songs, keyed by an opaque song id.
+    Songs are kept as float32 arrays so that clients only have to pass
+    the song id around instead of the raw waveform.
+    The least recently used songs are dropped once max_songs is exceeded.
+    The .npy files written for songs (see save_npy) are deleted along with them.
+    """
+
+    def __init__(self, max_songs=8):
+        self.max_songs = max_songs
+        self._songs = OrderedDict()
+        self._npy_paths = {}
+        self._lock = threading.Lock()
+
+    def put(self, y, sr):
+        song_id = uuid.uuid4().hex
+        dropped = []
+        with self._lock:
+            self._songs[song_id] = (_freeze(np.ascontiguousarray(y, dtype=np.float32)), sr)
+            while len(self._songs) > self.max_songs:
+                dropped.append(self._songs.popitem(last=False)[0])
+            dropped_paths = [self._npy_paths.pop(dropped_id, None) for dropped_id in dropped]
+        self._remove_files(dropped_paths)
+        return song_id
+
+    def get(self, song_id):
+        with self._lock:
+            song = self._songs.get(song_id)
+            if song is not None:
+                self._songs.move_to_end(song_id)
+            return song
+
+    def release(self, song_id):
+        with self._lock:
+            released = self._songs.pop(song_id, None) is not None
+            npy_path = self._npy_paths.pop(song_id, None)
+        self._remove_files([npy_path])
+        return released
+
+    def save_npy(self, song_id, y):
+        """Saves a stored song's waveform to a .npy file, deleted when the song leaves the store."""
+        npy_path = os.path.join(tempfile.gettempdir(), f"{song_id}.npy")
+        np.save(npy_path, y)
+        with self._lock:
+            stored = song_id in self._songs
+            if stored:
+                self._npy_paths[song_id] = npy_path
+        if not stored:
+            self._remove_files([npy_path])
+            raise KeyError(f"Unknown song: {song_id}")
+        return npy_path
+
+    def npy_song_id(self, npy_path):
+        """The id of the stored song saved to npy_path by save_npy, None for any other path."""
+        with self._lock:
+            return next((song_id for song_id, path in self._npy_paths.items() if path == npy_path), None)
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+song_store = SongStore()
+
+
+def encode_waveform(y, y_format, song_id):
+    """
+    Encodes a waveform in one of the opt-in compact formats:
+    'base64' (little-endian float32 bytes) or 'npy' (path to a .npy file saved by the song store).
+    """
+    y = np.ascontiguousarray(y, dtype='<f4')
+    if y_format == 'base64':
+        return base64.b64encode(y.tobytes()).decode('ascii')
+    elif y_format == 'npy':
+        return song_store.save_npy(song_id, y)
+    raise ValueError(f"Unsupported waveform format: {y_format}")
+
+
+def decode_waveform(y, y_format):
+    """Decodes a waveform sent by a client, see encode_waveform ('npy' paths are resolved by resolve_song)."""
+    if y_format == 'base64':
+        return np.frombuffer(base64.b64decode(y), dtype='<f4')
+    return np.asarray(y, dtype=np.float32)
+
+
+def resolve_song(data):
+    """
+    Returns the (y, sr) pair for a request, either from the song store
+    when a 'song_id' (or the 'npy' path the server saved it to) is given
+    or from a waveform sent with the request.
+    Returns None if the song id is unknown, and for 'npy' paths the server did not save.
+    """
+    song_id = data.get('song_id')
+    if song_id is None and data.get('y_format') == 'npy':
+        song_id = song_store.npy_song_id(data['y'])
+        if song_id is None:
+            return None
+    if song_id is not None:
+        return song_store.get(song_id)
+    return decode_waveform(data['y'], data.get('y_format')), data['sr']
+
+
+# Audio hashes of read-only (shared, see _freeze) songs by array identity, dropped with their arrays
+_audio_keys = {}
+
+
+def audio_hash(y, sr):
+    """
+    Content hash of a decoded song, used to key cached analysis results.
+    Read-only songs, such as the stored and decoded ones, are only hashed once.
+    """
+    known = _audio_keys.get(id(y))
+    if known is not None and known[0]() is y and known[1] == sr:
+        return known[2]
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(sr).encode('ascii'))
+    h.update(np.ascontiguousarray(y, dtype=np.float32))
+    key = h.hexdigest()
+    if isinstance(y, np.ndarray) and not y.flags.writeable:
+        ident = id(y)
+        _audio_keys[ident] = (weakref.ref(y, lambda _: _audio_keys.pop(ident, None)), sr, key)
+    return key
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(x) for x in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(x) for x in value.values())
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    """Marks cached arrays as read-only, since they are shared between requests."""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for x in value:
+            _freeze(x)
+    elif isinstance(value, dict):
+        for x in value.values():
+            _freeze(x)
+    return value
+
+
+class FeatureCache:
+    """
+    LRU cache of per-song analysis results (beat tracking, spectrograms, ...)
+    bounded by a byte budget and a maximum number of entries.
+    Entries are computed once and shared between difficulties and models,
+    concurrent misses of an entry wait for the first one to compute it.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024, max_entries=256):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._compute_locks = {}
+        self._lock = threading.RLock()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def get(self, key, compute):
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry[0]
+        with self._lock:
+            compute_lock = self._compute_locks.setdefault(key, threading.Lock())
+        # Concurrent misses of a key wait for the first one to compute it
+        with compute_lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry[0]
+            with self._lock:
+                self.misses += 1
+            try:
+                value = _freeze(compute())
+                self.put(key, value)
+            finally:
+                with self._lock:
+                    self._compute_locks.pop(key, None)
+        return value
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self.total_bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
+
+
+feature_cache = FeatureCache()
+
+
+# On-disk Feature Store
+def user_cache_dir():
+    """Per-user cache directory of the app, outside of its (possibly read-only) install directory."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser(os.path.join('~', 'AppData', 'Local'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'BeatMapSynthesizer')
+
+
+# Directory of the analyses kept across server restarts and batch runs (None disables it)
+FEATURE_STORE_DIR = os.path.join(user_cache_dir(), 'feature_store')
+FEATURE_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Bump when a stored analysis changes, older entries are then never read again
+FEATURE_STORE_VERSION = 4
+
+
+def _encode_segmentation(value):
+    segments, beat_times, tempo = value
+    return {'times': np.array([times for times, _, _ in segments], dtype=np.float64).reshape(-1, 2),
+            'beats': np.array([beats for _, beats, _ in segments], dtype=np.int64).reshape(-1, 2),
+            'seg_no': np.array([seg_no for _, _, seg_no in segments], dtype=np.int64),
+            'beat_times': np.asarray(beat_times, dtype=np.float64),
+            'tempo': np.float64(tempo)}
+
+
+def _decode_segmentation(arrays):
+    segments = [(tuple(times), tuple(beats), seg_no) for times, beats, seg_no
+                in zip(arrays['times'].tolist(), arrays['beats'].tolist(), arrays['seg_no'].tolist())]
+    return segments, arrays['beat_times'], float(arrays['tempo'])
+
+
+# Song features kept in the feature store, with their (encode, decode) functions to and from named arrays.
+# Only beat-level results are stored, frame-level spectrograms are cheaper to recompute than to keep.
+STORED_FEATURES = {
+    'beat_track': (lambda value: {'tempo': np.float64(value[0]), 'beats': value[1]},
+                   lambda arrays: (float(arrays['tempo']), arrays['beats'])),
+    'beat_cqt_db': (lambda value: {'value': value}, lambda arrays: arrays['value']),
+    'beat_mfcc': (lambda value: {'value': value}, lambda arrays: arrays['value']),
+    'beat_decibel': (lambda value: {'value': value}, lambda arrays: arrays['value']),
+    'segmentation': (_encode_segmentation, _decode_segmentation),
+}
+
+
+def file_hash(path, chunk_size=2**20):
+    """Content hash of a file."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FeatureStore:
+    """
+    Content-addressed on-disk store of the STORED_FEATURES of songs, backing the feature cache.
+    Entries are compressed .npz files under a directory per song (named by its audio hash),
+    named by the feature and a digest of its analysis parameters.
+    The least recently used songs are deleted once the store grows past max_bytes.
+    Writes are atomic, so that several processes (e.g. batch workers) can share a store.
+    """
+
+    def __init__(self, root=FEATURE_STORE_DIR, max_bytes=FEATURE_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    def song_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def entry_path(self, key, name, params):
+        digest = hashlib.blake2b(repr((FEATURE_STORE_VERSION, N_FFT, HOP_LENGTH, params)).encode('utf-8'),
+                                 digest_size=8).hexdigest()
+        return os.path.join(self.song_dir(key), f"{name}-{digest}.npz")
+
+    def get(self, key, name, params, compute):
+        """Returns a stored feature of a song, computing and storing it if it isn't stored yet."""
+        if self.root is None or name not in STORED_FEATURES:
+            return compute()
+        encode, decode = STORED_FEATURES[name]
+        path = self.entry_path(key, name, params)
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                value = decode(arrays)
+            # Directory times order the songs for eviction
+            os.utime(self.song_dir(key))
+            with self._lock:
+                self.hits += 1
+            return value
+        except FileNotFoundError:
+            pass
+        except Exception:
+            _print_exception(traceback.format_exc(), f"Discarding unreadable feature store entry: {path}")
+        with self._lock:
+            self.misses += 1
+        value = compute()
+        try:
+            self._write(path, encode(value))
+        except OSError:
+            _print_exception(traceback.format_exc(), f"Failed to write feature store entry: {path}")
+        return value
+
+    def _write(self, path, arrays):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        os.utime(os.path.dirname(path))
+        size = os.path.getsize(path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """Returns the (mtime, size, path) of every song directory of the store, and their total size."""
+        songs = []
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir() or prefix.name == 'sources':
+                continue
+            for song in os.scandir(prefix.path):
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(song.path))
+                    songs.append((song.stat().st_mtime, size, song.path))
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+        return songs, sum(size for _, size, _ in songs)
+
+    def _evict(self):
+        songs, self._bytes = self._scan()
+        for _, size, path in sorted(songs):
+            if self._bytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self._bytes -= size
+            self.evictions += 1
+
+    def source_path(self, song_path):
+        return os.path.join(self.root, 'sources', file_hash(song_path))
+
+    def mark_source(self, song_path, key):
+        """Records the audio hash of a song file whose analysis has been stored."""
+        path = self.source_path(song_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(key)
+
+    def has_source(self, song_path):
+        """Whether the analysis of a song file marked by mark_source is still stored."""
+        try:
+            with open(self.source_path(song_path)) as f:
+                return os.path.isdir(self.song_dir(f.read().strip()))
+        except FileNotFoundError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'root': self.root,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+
+feature_store = FeatureStore()
+
+
+# Streaming Analysis
+# librosa's default STFT frame and hop lengths, shared by every feature of a song
+N_FFT = 2048
+HOP_LENGTH = 512
+# Peak bytes of the spectrogram analysis of a song. Songs whose full spectrograms would take more
+# are analysed block by block, in blocks sized to stay within it.
+ANALYSIS_MEMORY_LIMIT = 512 * 1024 * 1024
+# Rough peak bytes per frame of the full analysis (complex STFT, magnitudes, decibels, CQT)
+ANALYSIS_BYTES_PER_FRAME = 32 * 1024
+# Samples around a CQT block covering its longest (lowest) filter
+CQT_BLOCK_CONTEXT = 2**16
+
+
+def stream_block_frames():
+    """Frames per block of the streaming analysis, half of the memory limit is left to the per-frame results."""
+    return max(256, ANALYSIS_MEMORY_LIMIT // (2 * ANALYSIS_BYTES_PER_FRAME))
+
+
+def _block_ranges(n_frames, frames_per_block, bounds=None):
+    """
+    Splits n_frames frames into (start, stop) blocks of at most frames_per_block frames.
+    With bounds (sorted frame boundaries from 0 to n_frames, e.g. beats), blocks only end on a boundary
+    and a segment longer than frames_per_block is a block of its own.
+    """
+    if bounds is None:
+        return [(start, min(start + frames_per_block, n_frames)) for start in range(0, n_frames, frames_per_block)]
+    ranges = []
+    start = 0
+    while start < n_frames:
+        i = np.searchsorted(bounds, start + frames_per_block, side='right') - 1
+        stop = int(bounds[i]) if bounds[i] > start else int(bounds[np.searchsorted(bounds, start, side='right')])
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def _stft_frames(y, start, stop, n_fft=N_FFT, hop_length=HOP_LENGTH):
+    """Frames start to stop of the centered (zero padded) STFT of y, computed from those samples only."""
+    first = start * hop_length - n_fft // 2
+    last = (stop - 1) * hop_length + n_fft - n_fft // 2
+    samples = np.pad(y[max(first, 0):max(min(last, len(y)), 0)], (max(-first, 0), max(last - len(y), 0)))
+    return librosa.stft(samples, n_fft=n_fft, hop_length=hop_length, center=False)
+
+
+def _cqt_frames(y, sr, start, stop, bins_per_octave, n_bins, hop_length=HOP_LENGTH):
+    """Frames start to stop of the CQT of y, computed from those samples and CQT_BLOCK_CONTEXT around them."""
+    first = max(start * hop_length - CQT_BLOCK_CONTEXT, 0)
+    last = min(stop * hop_length + CQT_BLOCK_CONTEXT, len(y))
+    offset = start - first // hop_length
+    C = librosa.cqt(y=y[first:last], sr=sr, hop_length=hop_length, bins_per_octave=bins_per_octave, n_bins=n_bins)
+    return C[:, offset:offset + stop - start]
+
+
+def _streaming_tempo(onset_envelope, sr, hop_length=HOP_LENGTH, ac_size=8.0, start_bpm=120.0, std_bpm=1.0,
+                     max_tempo=320.0):
+    """
+    librosa.beat.tempo with its default mean aggregate, summing the tempogram block by block
+    instead of holding its autocorrelation of every frame at once.
+    """
+    win_length = librosa.time_to_frames(ac_size, sr=sr, hop_length=hop_length).item()
+    n = len(onset_envelope)
+    padded = np.pad(onset_envelope, win_length // 2, mode='linear_ramp', end_values=[0, 0])
+    ac_window = librosa.filters.get_window('hann', win_length, fftbins=True)[:, np.newaxis]
+    tg = np.zeros(win_length)
+    for start, stop in _block_ranges(n, stream_block_frames()):
+        job_progress()
+        odf_frame = librosa.util.frame(padded[start:stop + win_length - 1], frame_length=win_length, hop_length=1)
+        tg += librosa.util.normalize(librosa.autocorrelate(odf_frame * ac_window, axis=0), norm=np.inf,
+                                     axis=0).sum(axis=1)
+    tg /= n
+    bpms = librosa.tempo_frequencies(win_length, hop_length=hop_length, sr=sr)
+    logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    logprior[:np.argmax(bpms < max_tempo)] = -np.inf
+    return bpms[np.argmax(np.log1p(1e6 * tg) + logprior)]
+
+
+class SongFeatures:
+    """
+    Cached analysis of a single song.
+    Every representation is computed at most once per song and stored in the feature cache,
+    the STORED_FEATURES are also read from and written to the on-disk feature store.
+    Returned arrays are shared and read-only.
+    Songs too long to analyse within ANALYSIS_MEMORY_LIMIT are analysed block by block (streaming):
+    they only keep per-frame mel powers and beat-synchronous features, never full spectrograms.
+    """
+
+    def __init__(self, y, sr, cache=None, store=None):
+        self.y = y
+        self.sr = sr
+        self.cache = cache if cache is not None else feature_cache
+        self.store = store if store is not None else feature_store
+        self.key = audio_hash(y, sr)
+        self.n_frames = 1 + len(y) // HOP_LENGTH
+        self.streaming = self.n_frames * ANALYSIS_BYTES_PER_FRAME > ANALYSIS_MEMORY_LIMIT
+
+    def _get(self, name, compute, *params):
+        return self.cache.get((self.key, name) + params,
+                              lambda: self.store.get(self.key, name, params, span(name)(compute)))
+
+    def beat_track(self):
+        """Returns (tempo, beat_frames)."""
+        def compute():
+            if self.streaming:
+                onset_envelope = librosa.onset.onset_strength(S=librosa.power_to_db(self.mel_power()),
+                                                              sr=self.sr, aggregate=np.median)
+                tempo, beats = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=self.sr, trim=False,
+                                                       bpm=_streaming_tempo(onset_envelope, self.sr))
+            else:
+                tempo, beats = librosa.beat.beat_track(y=self.y, sr=self.sr, trim=False)
+            return float(tempo), beats
+        return self._get('beat_track', compute)
+
+    def beat_bounds(self):
+        """Frame boundaries of the beats, as used by librosa.util.sync."""
+        tempo, beats = self.beat_track()
+        return librosa.util.fix_frames(beats, x_min=0, x_max=self.n_frames)
+
+    def cqt_db(self, bins_per_octave, n_bins):
+        return self._get('cqt_db', lambda: librosa.amplitude_to_db(np.abs(librosa.cqt(y=self.y,
+                                                                                      sr=self.sr,
+                                                                                      bins_per_octave=bins_per_octave,
+                                                                                      n_bins=n_bins)), ref=np.max),
+                         bins_per_octave, n_bins)
+
+    def beat_cqt_db(self, bins_per_octave, n_bins):
+        """Median CQT decibels (relative to the loudest bin of the song) of every beat."""
+        def compute():
+            bounds = self.beat_bounds()
+            if not self.streaming:
+                # librosa's CQT may have a frame past n_frames, the beats end at n_frames like the STFT's
+                return librosa.util.sync(self.cqt_db(bins_per_octave, n_bins)[:, :self.n_frames], bounds,
+                                         aggregate=np.median)
+            blocks = []
+            peak_db = -np.inf
+            for start, stop in _block_ranges(self.n_frames, stream_block_frames(), bounds):
+                job_progress()
+                C = librosa.amplitude_to_db(np.abs(_cqt_frames(self.y, self.sr, start, stop, bins_per_octave, n_bins)),
+                                            ref=1.0, top_db=None)
+                peak_db = max(peak_db, float(C.max()))
+                blocks.append(librosa.util.sync(C, bounds[(bounds > start) & (bounds < stop)] - start,
+                                                aggregate=np.median))
+            # Referencing to the loudest bin and the 80 dB floor commute with the median
+            return np.maximum(np.concatenate(blocks, axis=1) - peak_db, -80.0).astype(np.float32)
+        return self._get('beat_cqt_db', compute, bins_per_octave, n_bins)
+
+    def stft_db(self):
+        return self._get('stft_db', lambda: librosa.amplitude_to_db(np.abs(librosa.stft(self.y)), ref=np.max))
+
+    def beat_decibel(self):
+        """Mean STFT decibels (relative to the loudest bin of the song) of every beat."""
+        def compute():
+            bounds = self.beat_bounds()
+            if not self.streaming:
+                return librosa.util.sync(self.stft_db(), bounds, aggregate=np.mean).mean(axis=0)
+            peak = self._mel_power_and_stft_peak()[1]
+            blocks = []
+            for start, stop in _block_ranges(self.n_frames, stream_block_frames(), bounds):
+                job_progress()
+                S_db = np.maximum(librosa.amplitude_to_db(np.abs(_stft_frames(self.y, start, stop)),
+                                                          ref=peak, top_db=None), -80.0)
+                blocks.append(librosa.util.sync(S_db, bounds[(bounds > start) & (bounds < stop)] - start,
+                                                aggregate=np.mean).mean(axis=0))
+            return np.concatenate(blocks)
+        return self._get('beat_decibel', compute)
+
+    def _mel_power_and_stft_peak(self):
+        """Mel power spectrogram and loudest STFT magnitude, computed block by block."""
+        def compute():
+            mel = None
+            peak = 0.0
+            for start, stop in _block_ranges(self.n_frames, stream_block_frames()):
+                job_progress()
+                S = np.abs(_stft_frames(self.y, start, stop))
+                peak = max(peak, float(S.max()))
+                block = librosa.feature.melspectrogram(S=S**2, sr=self.sr)
+                if mel is None:
+                    mel = np.empty((block.shape[0], self.n_frames), dtype=block.dtype)
+                mel[:, start:stop] = block
+            return mel, peak
+        return self._get('mel_power', compute)
+
+    def mel_power(self):
+        return self._mel_power_and_stft_peak()[0]
+
+    def mfcc(self):
+        if self.streaming:
+            return self._get('mfcc', lambda: librosa.feature.mfcc(S=librosa.power_to_db(self.mel_power()), sr=self.sr))
+        return self._get('mfcc', lambda: librosa.feature.mfcc(y=self.y, sr=self.sr))
+
+    def beat_mfcc(self):
+        """Mean MFCCs of every beat."""
+        return self._get('beat_mfcc', lambda: librosa.util.sync(self.mfcc(), self.beat_track()[1]))
+
+    def melspectrogram_db(self):
+        if self.streaming:
+            return self._get('melspectrogram_db', lambda: librosa.power_to_db(self.mel_power(), ref=np.max))
+        return self._get('melspectrogram_db', lambda: librosa.power_to_db(
+            librosa.feature.melspectrogram(y=self.y, sr=self.sr), ref=np.max))
+
+
 class Notes:
     class CutDirs:
         Up = 0
@@ -85,92 +870,126 @@ class Notes:
     validRows = [line_layers.Bottom, line_layers.Middle, line_layers.Top]
 
 
-def remove_bad_notes(notes_list, bpm):
-    """Remove notes that come too early in the song"""
-    cut_dirs = Notes().cut_dirs
-    line_indices = Notes().line_indices
-    line_layers = Notes().line_layers
-
-    # Using the BPM we can covert from beats to seconds
-    def seconds(number):
-        return round(bpm / 60) * number
-
-    # Only keep notes that come after the 2 seconds into the song
-    notes_list = list(
-        filter(lambda note: note['_time'] >= seconds(2), notes_list))
-
-    def validateNotes(notes_list):
-        validated_notes_list = []
-        index = 0
-        current_note = notes_list[index]
-
-        def remove_zeros(number):
-            while number % 10 == 0:
-                number //= 10
-            return number
-
-        def makeLineIndexValid(note):
-            if note['_lineIndex'] > line_indices.Col4:
-                note['_lineIndex'] = remove_zeros(note['_lineIndex'])
-            if note['_lineIndex'] in Notes().validColumns:
-                return note
-            return None
-
-        def makeLineLayerValid(note):
-            if note['_lineLayer'] > line_layers.Top:
-                note['_lineLayer'] = remove_zeros(note['_lineLayer'])
-            if note['_lineLayer'] in Notes().validRows:
-                return note
-            return None
-
-        def makeCutDirectionValid(note):
-            if note['_cutDirection'] > cut_dirs.Dot:
-                note['_cutDirection'] = remove_zeros(note['_cutDirection'])
-            if note['_cutDirection'] in Notes().validCutDirs:
-                return note
-            return None
-
-        while current_note:
-            try:
-                current_note = makeLineIndexValid(current_note)
-                if current_note is None:
-                    index += 1
-                    current_note = notes_list[index]
-                    continue
-
-                current_note = makeLineLayerValid(current_note)
-                if current_note is None:
-                    index += 1
-                    current_note = notes_list[index]
-                    continue
-
-                current_note = makeCutDirectionValid(current_note)
-                if current_note is None:
-                    index += 1
-                    current_note = notes_list[index]
-                    continue
-
-                validated_notes_list.append(current_note)
-                index += 1
-                current_note = notes_list[index]
-            except KeyError:
-                index += 1
-                current_note = notes_list[index]
-                continue
-            except IndexError:
-                break
-        return validated_notes_list
-
-    notes_list = validateNotes(notes_list)
-
-    oppositeCutDirs = {cut_dirs.Up:        [cut_dirs.DownRight,   cut_dirs.Down,         cut_dirs.DownLeft],
-                       cut_dirs.UpRight:   [cut_dirs.Down,        cut_dirs.DownLeft,     cut_dirs.Left],
-                       cut_dirs.Right:     [cut_dirs.Down,        cut_dirs.DownLeft,     cut_dirs.Left],
-                       cut_dirs.DownRight: [cut_dirs.Up,          cut_dirs.UpLeft,       cut_dirs.Left],
-                       cut_dirs.Down:      [cut_dirs.Up,          cut_dirs.UpRight,      cut_dirs.UpLeft],
-                       cut_dirs.DownLeft:  [cut_dirs.Up,          cut_dirs.UpRight,      cut_dirs.Right],
-                       cut_dirs.Left:      [cut_dirs.UpRight,     cut_dirs.Right,        cut_dirs.DownRight],
-                       cut_dirs.UpLeft:    [cut_dirs.Right,       cut_dirs.DownRight,    cut_dirs.Down]}
+NOTE_DTYPE = np.dtype([('_time', np.float64),
+                       ('_lineIndex', np.int64),
+                       ('_lineLayer', np.int64),
+                       ('_type', np.int64),
+                       ('_cutDirection', np.int64)])
+
+
+def notes_to_array(notes_list):
+    """Converts a list of note dictionaries to a structured note array, notes with missing fields are skipped."""
+    fields = NOTE_DTYPE.names
+    return np.array([tuple(note[field] for field in fields)
+                     for note in notes_list if all(field in note for field in fields)], dtype=NOTE_DTYPE)
+
+
+def records_to_list(records):
+    """Converts a structured note, event or obstacle array to a list of dictionaries."""
+    fields = records.dtype.names
+    return [dict(zip(fields, values)) for values in zip(*(records[field].tolist() for field in fields))]
+
+
+def records_to_columns(records):
+    """Converts a structured note, event or obstacle array to a dictionary of parallel lists, one per field."""
+    return {field: records[field].tolist() for field in records.dtype.names}
+
+
+EVENT_DTYPE = np.dtype([('_time', np.float64),
+                        ('_type', np.int64),
+                        ('_value', np.int64)])
+OBSTACLE_DTYPE = np.dtype([('_time', np.float64),
+                           ('_lineIndex', np.int64),
+                           ('_type', np.int64),
+                           ('_duration', np.float64),
+                           ('_width', np.int64)])
+# Structured arrays of the level data by name, with their packed little-endian records in the binary format
+LEVEL_RECORDS = {
+    'notes': (NOTE_DTYPE, np.dtype([('_time', '<f8'),
+                                    ('_lineIndex', '<i2'),
+                                    ('_lineLayer', '<i2'),
+                                    ('_type', '<i2'),
+                                    ('_cutDirection', '<i2')])),
+    'events': (EVENT_DTYPE, np.dtype([('_time', '<f8'),
+                                      ('_type', '<i2'),
+                                      ('_value', '<i4')])),
+    'obstacles': (OBSTACLE_DTYPE, np.dtype([('_time', '<f8'),
+                                            ('_lineIndex', '<i2'),
+                                            ('_type', '<i2'),
+                                            ('_duration', '<f8'),
+                                            ('_width', '<i2')])),
+}
+
+
+def record_kind(value):
+    """Name of the LEVEL_RECORDS held by a structured array, None for anything else."""
+    if isinstance(value, np.ndarray):
+        for kind, (dtype, _) in LEVEL_RECORDS.items():
+            if value.dtype == dtype:
+                return kind
+    return None
+
+
+def map_records(value, convert):
+    """Applies convert to every level record array held by value (nested in dicts, lists and tuples)."""
+    if record_kind(value) is not None:
+        return convert(value)
+    if isinstance(value, dict):
+        return {key: map_records(item, convert) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [map_records(item, convert) for item in value]
+    return value
+
+
+def pack_level_payload(data):
+    """
+    Packs data holding level record arrays into the binary format: the byte length of a JSON header
+    (little-endian uint32), the header, then the packed records of every array.
+    The header is {'data': data} with each array replaced by {'records': its LEVEL_RECORDS name, 'offset', 'count'},
+    the offset of its records in bytes from the end of the header.
+    """
+    packed = []
+    offset = 0
+
+    def reference(records):
+        nonlocal offset
+        kind = record_kind(records)
+        packed.append(records.astype(LEVEL_RECORDS[kind][1]).tobytes())
+        ref = {'records': kind, 'offset': offset, 'count': len(records)}
+        offset += len(packed[-1])
+        return ref
+
+    header = json.dumps({'data': map_records(data, reference)}).encode()
+    return b''.join([len(header).to_bytes(4, 'little'), header] + packed)
+
+
+def unpack_level_payload(payload):
+    """Reads the data packed by pack_level_payload back, with structured record arrays."""
+    header_length = int.from_bytes(payload[:4], 'little')
+    packed = memoryview(payload)[4 + header_length:]
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if 'records' in value:
+                dtype, wire_dtype = LEVEL_RECORDS[value['records']]
+                return np.frombuffer(packed, dtype=wire_dtype, count=value['count'],
+                                     offset=value['offset']).astype(dtype)
+            return {key: resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [resolve(item) for item in value]
+        return value
+    return resolve(json.loads(bytes(payload[4:4 + header_length]))['data'])
+
+
+def _note_rule_tables():
+    """
+    Lookup tables for the note validation rules, indexed by cut direction, column and row.
+    Choice tables have 6 entries per row so a single draw in [0, 6) picks uniformly
+    out of both 2 and 3 options.
+    """
+    cut_dirs = Notes.cut_dirs
+    line_indices = Notes.line_indices
+    line_layers = Notes.line_layers
 
     oppositeCutDir = {cut_dirs.Up:         cut_dirs.Down,
                       cut_dirs.UpRight:    cut_dirs.DownLeft,
@@ -181,11 +1000,6 @@ def remove_bad_notes(notes_list, bpm):
                       cut_dirs.Left:       cut_dirs.Right,
                       cut_dirs.UpLeft:     cut_dirs.DownRight}
 
-    cardinalDirs = [cut_dirs.Up, cut_dirs.Right,
-                    cut_dirs.Down, cut_dirs.Left]
-    upDownDirs = [cut_dirs.Up, cut_dirs.Down]
-    leftRightDirs = [cut_dirs.Left, cut_dirs.Right]
-
     oppositeIndices = {line_indices.Col1: [line_indices.Col2, line_indices.Col3],
                        line_indices.Col2: [line_indices.Col1, line_indices.Col3, line_indices.Col4],
                        line_indices.Col3: [line_indices.Col1, line_indices.Col2, line_indices.Col4],
@@ -195,217 +1009,448 @@ def remove_bad_notes(notes_list, bpm):
                       line_layers.Middle:   [line_layers.Bottom, line_layers.Top],
                       line_layers.Top:      [line_layers.Bottom, line_layers.Middle]}
 
-    # Top Row can't have cuts inward
-    layerInwards = {line_layers.Top: [
-        cut_dirs.DownRight, cut_dirs.Down, cut_dirs.DownLeft]}
-    # Columns 1 and 4 can't have cuts inward
-    indexInwards = {line_indices.Col1: [cut_dirs.UpRight, cut_dirs.Right, cut_dirs.DownRight],
-                    line_indices.Col4: [cut_dirs.DownLeft, cut_dirs.Left, cut_dirs.UpLeft]}
+    opposite_cut_dir = np.full(len(Notes.validCutDirs), -1, dtype=np.int64)
+    for cut_dir, opposite in oppositeCutDir.items():
+        opposite_cut_dir[cut_dir] = opposite
+
+    def opposite_tables(opposites, size):
+        is_opposite = np.zeros((size, size), dtype=bool)
+        choices = np.zeros((size, 6), dtype=np.int64)
+        for value, options in opposites.items():
+            is_opposite[value, options] = True
+            choices[value] = np.resize(options, 6)
+        return is_opposite, choices
+
+    is_opposite_index, opposite_index_choice = opposite_tables(oppositeIndices, len(Notes.validColumns))
+    is_opposite_layer, opposite_layer_choice = opposite_tables(oppositeLayers, len(Notes.validRows))
+
+    # Cut direction forced by a note's position given the previous cut direction, -1 keeps it.
+    # Top row notes can't be cut inward (downward), notes in columns 1 and 4 can't be cut inward
+    position_cut_dir = np.full((len(Notes.validRows), len(Notes.validColumns), len(Notes.validCutDirs)),
+                               -1, dtype=np.int64)
+    for layer in Notes.validRows:
+        for index in Notes.validColumns:
+            for last_cut_dir in Notes.validCutDirs:
+                if (layer == line_layers.Top and index in [line_indices.Col2, line_indices.Col3]
+                        and last_cut_dir != cut_dirs.Up):
+                    cut_dir = cut_dirs.Up
+                elif layer == line_layers.Top and index == line_indices.Col1 and last_cut_dir != cut_dirs.UpLeft:
+                    cut_dir = cut_dirs.UpLeft
+                elif layer == line_layers.Top and index == line_indices.Col2 and last_cut_dir != cut_dirs.UpRight:
+                    cut_dir = cut_dirs.UpRight
+                elif index == line_indices.Col1 and last_cut_dir != cut_dirs.Left:
+                    cut_dir = cut_dirs.Left
+                elif index == line_indices.Col4 and last_cut_dir != cut_dirs.Right:
+                    cut_dir = cut_dirs.Right
+                else:
+                    continue
+                position_cut_dir[layer, index, last_cut_dir] = cut_dir
 
-    lastNote = notes_list[0] if notes_list else None
+    # Cut directions of two notes of different colors placed at the same time in the same column or row
+    same_column_cut_dir = np.array([cut_dirs.Left, cut_dirs.Dot, cut_dirs.Dot, cut_dirs.Right])
+    same_row_cut_dir = np.array([cut_dirs.Down, cut_dirs.Down, cut_dirs.Up])
 
-    for i in range(1, len(notes_list)):
-        try:
-            if notes_list[i]['_cutDirection'] != cut_dirs.Dot and notes_list[i]['_type'] != 3 and lastNote['_time'] - notes_list[i]['_time'] < seconds(1.5):
-                try:
-                    if (lastNote['_cutDirection'] != cut_dirs.Dot and notes_list[i]['_cutDirection'] != oppositeCutDir[lastNote['_cutDirection']] and
-                            notes_list[i]['_type'] == lastNote['_type']):
-                        notes_list[i]['_cutDirection'] = int(
-                            oppositeCutDir[lastNote['_cutDirection']])
+    return {key: value.tolist() for key, value in {
+        'opposite_cut_dir': opposite_cut_dir,
+        'is_opposite_index': is_opposite_index,
+        'opposite_index_choice': opposite_index_choice,
+        'is_opposite_layer': is_opposite_layer,
+        'opposite_layer_choice': opposite_layer_choice,
+        'position_cut_dir': position_cut_dir,
+        'same_column_cut_dir': same_column_cut_dir,
+        'same_row_cut_dir': same_row_cut_dir,
+    }.items()}
 
-                except Exception:
-                    _print_exception(traceback.format_exc(),
-                                     f"1.1 Note Validation Error for Note: {i}")
-                try:
-                    if (notes_list[i]['_lineIndex'] not in oppositeIndices[lastNote['_lineIndex']] and
-                            notes_list[i]['_lineLayer'] not in oppositeLayers[lastNote['_lineLayer']] and
-                            notes_list[i]['_type'] != lastNote['_type']):
 
-                        if int(np.random.choice([0, 1])):
-                            notes_list[i]['_lineIndex'] = int(np.random.choice(
-                                oppositeIndices[lastNote['_lineIndex']]))
-                        else:
-                            notes_list[i]['_lineLayer'] = int(
-                                np.random.choice(oppositeLayers[lastNote['_lineLayer']]))
+NOTE_RULE_TABLES = _note_rule_tables()
 
-                except Exception:
-                    _print_exception(traceback.format_exc(),
-                                     f"1.2 Note Validation Error for Note: {i}")
 
-                try:
-                    if notes_list[i]['_time'] == lastNote['_time']:
-
-                        if notes_list[i]['_type'] == lastNote['_type']:
-                            notes_list = notes_list.pop(i)
-
-                        else:
-
-                            if notes_list[i]['_lineIndex'] == lastNote['_lineIndex']:
-                                if notes_list[i]['_lineIndex'] in [line_indices.Col2, line_indices.Col3]:
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Dot
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Dot
-
-                                elif notes_list[i]['_lineIndex'] == line_indices.Col1:
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Left
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Left
-                                    if notes_list[i]['_type'] == 0 and notes_list[i]['_lineLayer'] < lastNote['_lineLayer']:
-                                        notes_list[i-1]['_lineLayer'] = notes_list[i]['_lineLayer']
-                                        notes_list[i]['_lineLayer'] = lastNote['_lineLayer']
-
-                                elif notes_list[i]['_lineIndex'] == line_indices.Col4:
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Right
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Right
-                                    if notes_list[i]['_type'] == 0 and notes_list[i]['_lineLayer'] > lastNote['_lineLayer']:
-                                        notes_list[i-1]['_lineLayer'] = notes_list[i]['_lineLayer']
-                                        notes_list[i]['_lineLayer'] = lastNote['_lineLayer']
-
-                            elif notes_list[i]['_lineLayer'] == lastNote['_lineLayer']:
-
-                                if notes_list[i]['_lineLayer'] == line_layers.Bottom:
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Down
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Down
-
-                                elif notes_list[i]['_lineLayer'] == line_layers.Middle:
-                                    choice = int(np.random.choice([0, 1]))
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Down
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Down
-
-                                elif notes_list[i]['_lineLayer'] == line_layers.Top:
-                                    notes_list[i]['_cutDirection'] = cut_dirs.Up
-                                    notes_list[i -
-                                               1]['_cutDirection'] = cut_dirs.Up
+def _remove_zeros(values, limit):
+    """Strips trailing zeros of the values above limit, e.g. 30 -> 3."""
+    values = values.copy()
+    while True:
+        mask = (values > limit) & (values % 10 == 0)
+        if not mask.any():
+            return values
+        values[mask] //= 10
 
-                except Exception:
-                    _print_exception(traceback.format_exc(),
-                                     f"1.3 Note Validation Error for Note: {i}")
 
-                try:
-                    if (notes_list[i]['_lineLayer'] == line_layers.Top and notes_list[i]['_lineIndex'] in [line_indices.Col2, line_indices.Col3]
-                            and lastNote['_cutDirection'] != cut_dirs.Up):
-                        notes_list[i]['_cutDirection'] = cut_dirs.Up
+@span('validation')
+def validate_notes(notes, bpm, rng=None):
+    """
+    Removes notes that come too early in the song or are not placeable,
+    and fixes the cut directions and positions of notes that follow each other.
+    Takes and returns a structured note array (see NOTE_DTYPE).
+    """
+    job_progress('validation')
+    rng = rng if rng is not None else np.random.default_rng()
+    cut_dirs = Notes.cut_dirs
+    line_indices = Notes.line_indices
+    line_layers = Notes.line_layers
 
-                    elif (notes_list[i]['_lineLayer'] == line_layers.Top and notes_list[i]['_lineIndex'] == line_indices.Col1
-                            and lastNote['_cutDirection'] != cut_dirs.UpLeft):
-                        notes_list[i]['_cutDirection'] = cut_dirs.UpLeft
+    # Using the BPM we can covert from beats to seconds
+    def seconds(number):
+        return round(bpm / 60) * number
 
-                    elif (notes_list[i]['_lineLayer'] == line_layers.Top and notes_list[i]['_lineIndex'] == line_indices.Col2
-                            and lastNote['_cutDirection'] != cut_dirs.UpRight):
-                        notes_list[i]['_cutDirection'] = cut_dirs.UpRight
+    # Only keep notes that come after the 2 seconds into the song
+    notes = notes[notes['_time'] >= seconds(2)].copy()
+
+    # Strip trailing zeros and drop notes that are still out of range
+    notes['_lineIndex'] = _remove_zeros(notes['_lineIndex'], line_indices.Col4)
+    notes['_lineLayer'] = _remove_zeros(notes['_lineLayer'], line_layers.Top)
+    notes['_cutDirection'] = _remove_zeros(notes['_cutDirection'], cut_dirs.Dot)
+    notes = notes[np.isin(notes['_lineIndex'], Notes.validColumns) &
+                  np.isin(notes['_lineLayer'], Notes.validRows) &
+                  np.isin(notes['_cutDirection'], Notes.validCutDirs)]
+
+    n = len(notes)
+    if n < 2:
+        return notes
+
+    # A note is checked against the previous one if it is a close, directional, non-bomb note.
+    # Notes that are dropped share their time with the previous note,
+    # so comparing times with the immediately preceding note is equivalent.
+    times = notes['_time']
+    check = np.zeros(n, dtype=bool)
+    check[1:] = ((notes['_cutDirection'][1:] != cut_dirs.Dot) & (notes['_type'][1:] != 3) &
+                 (times[:-1] - times[1:] < seconds(1.5)))
+    same_time = np.zeros(n, dtype=bool)
+    same_time[1:] = times[:-1] == times[1:]
+    coins = rng.integers(0, 2, size=n).tolist()
+    picks = rng.integers(0, 6, size=n).tolist()
+
+    tables = NOTE_RULE_TABLES
+    opposite_cut_dir = tables['opposite_cut_dir']
+    is_opposite_index = tables['is_opposite_index']
+    opposite_index_choice = tables['opposite_index_choice']
+    is_opposite_layer = tables['is_opposite_layer']
+    opposite_layer_choice = tables['opposite_layer_choice']
+    position_cut_dir = tables['position_cut_dir']
+    same_column_cut_dir = tables['same_column_cut_dir']
+    same_row_cut_dir = tables['same_row_cut_dir']
+
+    # Every note depends on the already corrected previous note,
+    # so this pass walks the notes in order using only integer table lookups
+    index = notes['_lineIndex'].tolist()
+    layer = notes['_lineLayer'].tolist()
+    types = notes['_type'].tolist()
+    cut = notes['_cutDirection'].tolist()
+    check = check.tolist()
+    same_time = same_time.tolist()
+    keep = [True] * n
+    last = 0
+    for i in range(1, n):
+        if check[i]:
+            # Alternate the cut direction of consecutive notes of the same color
+            if (cut[last] != cut_dirs.Dot and cut[i] != opposite_cut_dir[cut[last]] and
+                    types[i] == types[last]):
+                cut[i] = opposite_cut_dir[cut[last]]
+
+            # Move notes of different colors apart
+            if (not is_opposite_index[index[last]][index[i]] and
+                    not is_opposite_layer[layer[last]][layer[i]] and
+                    types[i] != types[last]):
+                if coins[i]:
+                    index[i] = opposite_index_choice[index[last]][picks[i]]
+                else:
+                    layer[i] = opposite_layer_choice[layer[last]][picks[i]]
+
+            if same_time[i]:
+                if types[i] == types[last]:
+                    # Two notes of the same color can't be placed at the same time
+                    keep[i] = False
+                    continue
+                elif index[i] == index[last]:
+                    cut[i] = cut[last] = same_column_cut_dir[index[i]]
+                    if types[i] == 0 and ((index[i] == line_indices.Col1 and layer[i] < layer[last]) or
+                                          (index[i] == line_indices.Col4 and layer[i] > layer[last])):
+                        layer[last] = layer[i]
+                elif layer[i] == layer[last]:
+                    cut[i] = cut[last] = same_row_cut_dir[layer[i]]
 
-                    elif (notes_list[i]['_lineIndex'] == line_indices.Col1
-                            and lastNote['_cutDirection'] != cut_dirs.Left):
-                        notes_list[i]['_cutDirection'] = cut_dirs.Left
+            position_cut = position_cut_dir[layer[i]][index[i]][cut[last]]
+            if position_cut >= 0:
+                cut[i] = position_cut
 
-                    elif (notes_list[i]['_lineIndex'] == line_indices.Col4
-                            and lastNote['_cutDirection'] != cut_dirs.Right):
-                        notes_list[i]['_cutDirection'] = cut_dirs.Right
+        last = i
 
-                except Exception:
-                    _print_exception(traceback.format_exc(),
-                                     f"1.4 Note Validation Error for Note: {i}")
+    notes['_lineIndex'] = index
+    notes['_lineLayer'] = layer
+    notes['_cutDirection'] = cut
+    return notes[np.array(keep)]
 
-            lastNote = notes_list[i]
 
-        except Exception:
-            _print_exception(traceback.format_exc(),
-                             f"1.0 Note Validation Error for Note: {i}")
+def remove_bad_notes(notes_list, bpm, rng=None):
+    """Remove notes that come too early in the song"""
+    notes = notes_list if isinstance(notes_list, np.ndarray) else notes_to_array(notes_list)
+    return records_to_list(validate_notes(notes, bpm, rng))
 
-    return notes_list
 
+def walk_to_notes(times, walk_matrix):
+    """
+    Turns note placement predictions (see walk_to_matrix) at the given times into a structured note array.
+    Steps past the end of either input, and steps at a NaN time, are skipped.
+    """
+    length = min(len(times), len(walk_matrix))
+    times = np.asarray(times, dtype=np.float64)[:length]
+    # (step, note type, [type, lineIndex, lineLayer, cutDirection])
+    predictions = walk_matrix[:length].reshape(length, len(WALK_NOTE_TYPES), 4)
+    mask = (predictions[:, :, 0] != WALK_EMPTY) & ~np.isnan(times)[:, None]
+    notes = np.empty(np.count_nonzero(mask), dtype=NOTE_DTYPE)
+    notes['_time'] = np.broadcast_to(times[:, None], mask.shape)[mask]
+    notes['_lineIndex'] = predictions[:, :, 1][mask]
+    notes['_lineLayer'] = predictions[:, :, 2][mask]
+    notes['_type'] = np.broadcast_to(np.array(WALK_NOTE_TYPES), mask.shape)[mask]
+    notes['_cutDirection'] = predictions[:, :, 3][mask]
+    return notes
 
-def write_notes_hmm(df_preds, bpm):
-    notes_list = []
-    for index, row in df_preds.iterrows():
-        for x in list(filter(lambda y: y.startswith('notes_type'), df_preds.columns)):
-            if row[x] != '999':
-                num = x[-1]
-                note = {'_time': row['_time'],
-                        '_lineIndex':    int(row[f"notes_lineIndex_{num}"]),
-                        '_lineLayer':    int(row[f"notes_lineLayer_{num}"]),
-                        '_type':         int(num),
-                        '_cutDirection': int(row[f"notes_cutDirection_{num}"])}
-                notes_list.append(note)
-    return remove_bad_notes(notes_list, bpm)
+
+def write_notes_hmm(times, walk, bpm, rng=None):
+    """Writes the structured note array of a Markov walk placed at the given times."""
+    return validate_notes(walk_to_notes(times, walk_to_matrix(walk)), bpm, rng)
 
 
 # Random Mapping Note Writer
-def random_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr):
+RANDOM_LINE_INDICES = 4
+RANDOM_LINE_LAYERS = 3
+RANDOM_TYPES = np.array([0, 1, 3])
+RANDOM_CUT_DIRECTIONS = 8
+
+
+def random_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr, rng=None):
     """
     This function randomly places blocks at approximately each beat
     or every other beat depending on the difficulty.
+    Every column of the map is drawn at once into a structured note array.
     """
-    notes_list = []
-    line_index = [0, 1, 2, 3]
-    line_layer = [0, 1, 2]
-    types = [0, 1, 3]
-    directions = list(range(0, 8))
-    beat_times = [
-        x * (bpm / 60) for x in beat_times]
+    rng = rng if rng is not None else np.random.default_rng()
+    beats = np.asarray(beat_times, dtype=np.float64) * (bpm / 60)
 
     if difficulty.casefold() == 'easy' or difficulty.casefold() == 'normal':
-        for beat in beat_times:
-            empty = np.random.choice([0, 1])
-            if empty == 1:
-                note = {'_time': beat,
-                        '_lineIndex':    int(np.random.choice(line_index)),
-                        '_lineLayer':    int(np.random.choice(line_layer)),
-                        '_type':         int(np.random.choice(types)),
-                        '_cutDirection': int(np.random.choice(directions))}
-                notes_list.append(note)
-            else:
-                continue
+        # About every other beat is left empty
+        times = beats[rng.integers(0, 2, size=len(beats), dtype=bool)]
     else:
         # Randomly choose beats to have more than one note placed
-        random_beats = np.random.choice(beat_times, np.random.choice(
-            range(len(beat_times))))
-        randomly_duplicated_beat_times = np.concatenate(
-            [beat_times, random_beats])
-        randomly_duplicated_beat_times.sort()
-        randomly_duplicated_beat_times = [
-            float(x) for x in randomly_duplicated_beat_times]
-        for beat in randomly_duplicated_beat_times:
-            note = {'_time': beat,
-                    '_lineIndex':    int(np.random.choice(line_index)),
-                    '_lineLayer':    int(np.random.choice(line_layer)),
-                    '_type':         int(np.random.choice(types)),
-                    '_cutDirection': int(np.random.choice(directions))}
-            notes_list.append(note)
-
-    notes_list = remove_bad_notes(notes_list, bpm)
-    return notes_list
+        n_duplicates = rng.integers(0, len(beats)) if len(beats) else 0
+        times = np.sort(np.concatenate([beats, rng.choice(beats, n_duplicates)]))
+
+    n = len(times)
+    notes = np.empty(n, dtype=NOTE_DTYPE)
+    notes['_time'] = times
+    notes['_lineIndex'] = rng.integers(0, RANDOM_LINE_INDICES, size=n)
+    notes['_lineLayer'] = rng.integers(0, RANDOM_LINE_LAYERS, size=n)
+    notes['_type'] = RANDOM_TYPES[rng.integers(0, len(RANDOM_TYPES), size=n)]
+    notes['_cutDirection'] = rng.integers(0, RANDOM_CUT_DIRECTIONS, size=n)
+    return validate_notes(notes, bpm, rng)
 
 
 # Hidden Markov Models Note Writing Functions
-def walk_to_data_frame(walk):
-    """
-    Function for turning a Markov walk sequence into a DataFrame of note placement predictions
-    """
-    sequence = []
-    for step in walk:
-        sequence.append(step.replace(", ", ",").split(","))
-    constant = ['notes_type_0', 'notes_lineIndex_0', 'notes_lineLayer_0',
-                'notes_cutDirection_0', 'notes_type_1', 'notes_lineIndex_1',
-                'notes_lineLayer_1', 'notes_cutDirection_1', 'notes_type_3',
-                'notes_lineIndex_3', 'notes_lineLayer_3', 'notes_cutDirection_3']
-    df = pd.DataFrame(sequence, columns=constant)
-    return df
+# Every walk step holds [type, lineIndex, lineLayer, cutDirection] for each of these note types,
+# a type of WALK_EMPTY means there is no note of that type on the step
+WALK_NOTE_TYPES = [0, 1, 3]
+WALK_EMPTY = 999
+
+
+def walk_to_matrix(walk):
+    """
+    Function for turning a Markov walk sequence into an integer matrix of note placement predictions,
+    with one row per step.
+    Each distinct step is only parsed once.
+    """
+    if len(walk) == 0:
+        return np.empty((0, len(WALK_NOTE_TYPES) * 4), dtype=np.int64)
+    steps, inverse = np.unique(np.asarray(walk, dtype=str), return_inverse=True)
+    parsed = np.array([step.replace(", ", ",").split(",") for step in steps.tolist()], dtype=np.int64)
+    return parsed[inverse.ravel()]
+
+
+class MarkovWalker:
+    """
+    Array-backed walker compiled from a markovify chain.
+    States and tokens are mapped to integers and every state's transitions are stored
+    as cumulative weights, so a walk draws all its random numbers at once and
+    generates exactly the requested number of steps.
+    When the chain ends (or reaches a state it has never seen),
+    the walk restarts from its seed state instead of being thrown away,
+    a seed state that can only end is replaced by the begin state.
+    """
+
+    def __init__(self, chain):
+        self.state_size = chain.state_size
+        model = chain.model
+        self.begin_state = tuple([markovify.chain.BEGIN] * self.state_size)
+        states = list(model.keys())
+        self.state_index = {state: i for i, state in enumerate(states)}
+        tokens = {}
+        offsets = [0]
+        next_tokens = []
+        next_states = []
+        cumweights = []
+        totals = []
+        for state in states:
+            total = 0
+            for token, weight in model[state].items():
+                total += weight
+                cumweights.append(total)
+                next_tokens.append(tokens.setdefault(token, len(tokens)))
+                next_states.append(-1 if token == markovify.chain.END
+                                   else self.state_index.get(state[1:] + (token,), -1))
+            offsets.append(len(next_tokens))
+            totals.append(total)
+        self.tokens = list(tokens.keys())
+        # Python lists are used on purpose, indexing them one step at a time is faster than numpy arrays
+        self.offsets = offsets
+        self.next_tokens = next_tokens
+        self.next_states = next_states
+        self.cumweights = cumweights
+        self.totals = totals
+        self.end_token = tokens.get(markovify.chain.END, -1)
+        begin = self.state_index.get(self.begin_state)
+        if begin is None or all(token == self.end_token
+                                for token in next_tokens[offsets[begin]:offsets[begin + 1]]):
+            raise ValueError('Markov chain has no transitions out of its begin state')
+
+    def walk(self, n, init_state=None, rng=None):
+        """Returns a list of exactly n tokens."""
+        rng = rng if rng is not None else np.random.default_rng()
+        offsets, next_tokens, next_states = self.offsets, self.next_tokens, self.next_states
+        cumweights, totals, end_token = self.cumweights, self.totals, self.end_token
+        seed = self.state_index.get(tuple(init_state)) if init_state is not None else None
+        # A seed state that can only end (e.g. the tail of a training song) would restart into itself forever
+        if seed is None or all(token == end_token for token in next_tokens[offsets[seed]:offsets[seed + 1]]):
+            seed = self.state_index[self.begin_state]
+        tokens = self.tokens
+        walk = []
+        state = seed
+        while len(walk) < n:
+            for u in rng.random(n - len(walk)).tolist():
+                i = bisect.bisect_right(cumweights, u * totals[state], offsets[state], offsets[state + 1] - 1)
+                token = next_tokens[i]
+                if token != end_token:
+                    walk.append(tokens[token])
+                state = next_states[i]
+                if state < 0:
+                    state = seed
+        return walk
+
+
+def _model_footprint(MC):
+    """Approximate in-memory size of a markovify chain, its strings are not counted."""
+    model = getattr(MC, 'model', {})
+    return sys.getsizeof(model) + sum(sys.getsizeof(state) + sys.getsizeof(next_dict)
+                                      for state, next_dict in model.items())
+
+
+class ModelRegistry:
+    """
+    In-process registry of the HMM models.
+    Each (difficulty, version) model is unpickled once and kept in memory,
+    it is reloaded if the model file changes on disk.
+    Models are unpickled under a lock of their own path, the registry lock only guards its entries,
+    so different models load in parallel and loaded models are not held up by a load.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._load_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_path(tempDir, difficulty, version):
+        return f"{tempDir}/models/HMM_{difficulty}_v{version}.pkl"
+
+    def _cached(self, path, mtime):
+        """The loaded model of path if it is up to date, counting the hit, else None."""
+        with self._lock:
+            entry = self._models.get(path)
+            if entry is not None and entry['mtime'] == mtime:
+                entry['hits'] += 1
+                return entry['model']
+            return None
+
+    def get(self, tempDir, difficulty, version):
+        path = self.model_path(tempDir, difficulty, version)
+        mtime = os.path.getmtime(path)
+        MC = self._cached(path, mtime)
+        if MC is not None:
+            return MC
+        with self._lock:
+            load_lock = self._load_locks.setdefault(path, threading.Lock())
+        with load_lock:
+            # Another request may have loaded the model while this one waited
+            MC = self._cached(path, mtime)
+            if MC is not None:
+                return MC
+            start = time.perf_counter()
+            with open(path, 'rb') as m:
+                MC = pickle.load(m)
+            load_seconds = time.perf_counter() - start
+            metrics.observe('beatmap_model_load_seconds', load_seconds)
+            file_bytes = os.path.getsize(path)
+            memory_bytes = _model_footprint(MC)
+            with self._lock:
+                entry = self._models.get(path)
+                self._models[path] = {
+                    'model': MC,
+                    'walker': None,
+                    'difficulty': difficulty,
+                    'version': version,
+                    'mtime': mtime,
+                    'load_seconds': load_seconds,
+                    'loads': entry['loads'] + 1 if entry is not None else 1,
+                    'hits': entry['hits'] if entry is not None else 0,
+                    'file_bytes': file_bytes,
+                    'memory_bytes': memory_bytes,
+                }
+            return MC
+
+    def walker(self, tempDir, difficulty, version):
+        """Returns the compiled MarkovWalker of a model, compiling it on first use."""
+        MC = self.get(tempDir, difficulty, version)
+        path = self.model_path(tempDir, difficulty, version)
+        with self._lock:
+            entry = self._models[path]
+            if entry['model'] is MC and entry['walker'] is not None:
+                return entry['walker']
+        start = time.perf_counter()
+        walker = MarkovWalker(MC)
+        with self._lock:
+            if entry['model'] is MC:
+                entry['walker'] = walker
+                entry['compile_seconds'] = time.perf_counter() - start
+        return walker
+
+    def preload(self, tempDir, versions, difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus')):
+        for version in versions:
+            for difficulty in difficulties:
+                try:
+                    self.get(tempDir, difficulty, version)
+                except Exception:
+                    _print_exception(traceback.format_exc(),
+                                     f"Failed to preload model: {difficulty} v{version}")
+
+    def stats(self):
+        with self._lock:
+            return [{key: value for key, value in entry.items() if key not in ('model', 'walker')}
+                    for entry in self._models.values()]
+
+
+model_registry = ModelRegistry()
 
 
 def load_hmm_model(tempDir, difficulty, version):
     # Load model
-    with open(f"{tempDir}/models/HMM_{difficulty}_v{version}.pkl", 'rb') as m:
-        MC = pickle.load(m)
-        return MC
+    return model_registry.get(tempDir, difficulty, version)
+
+
+def load_hmm_walker(tempDir, difficulty, version):
+    # Load model compiled for walking
+    return model_registry.walker(tempDir, difficulty, version)
 
 
-def hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr):
-    """Writes a list of notes based on a Hidden Markov Model walk."""
-    MC = load_hmm_model(tempDir, difficulty, version)
+def hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr, rng=None):
+    """Writes the notes of a Hidden Markov Model walk."""
+    walker = load_hmm_walker(tempDir, difficulty, version)
     # Set note placement rate dependent on difficulty level
     counter = 2
     beats = []
@@ -419,106 +1464,245 @@ def hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr):
     while counter <= len(beat_times):
         beats.append(counter)
         counter += rate
-    # Get HMM walk long enough to cover number of beats
-    random_walk = MC.walk()
-    while len(random_walk) < len(beats):
-        random_walk = MC.walk()
-    df_walk = walk_to_data_frame(random_walk)
-    # Combine beat numbers with HMM walk steps
-    df_preds = pd.concat(
-        [pd.DataFrame(beats, columns=['_time']), df_walk], axis=1, sort=True)
-    df_preds.dropna(axis=0, inplace=True)
+    # Get HMM walk covering the number of beats
+    with span('walk'):
+        random_walk = walker.walk(len(beats), rng=rng)
     # Write notes dictionaries
-    return write_notes_hmm(df_preds, bpm)
+    return write_notes_hmm(beats, random_walk, bpm, rng)
 
 
 # Segmented HMM Note Writing Functions
-def laplacian_segmentation(y, sr):
+BINS_PER_OCTAVE = 12 * 3
+N_OCTAVES = 7
+# Range of k values tried when estimating the number of segments
+K_RANGE = (1, 12)
+# How the number of segments is estimated:
+# 'exhaustive' fits a full KMeans for every k on the mel bands,
+# 'fast' fits the same KMeans on the mel bands projected onto their principal components,
+# which keeps the distances between bands (and so the inertias) but has at most n_mels dimensions instead of n_frames
+# (and evaluates the k values in parallel when SEGMENT_ESTIMATION_JOBS > 1)
+SEGMENT_ESTIMATION = 'exhaustive'
+SEGMENT_ESTIMATION_JOBS = 1
+# Also run the exhaustive estimation and log both results, to check the quality of the fast mode
+SEGMENT_ESTIMATION_COMPARE = False
+# How the Laplacian eigenvectors are computed:
+# 'dense' builds dense matrices and uses a partial dense eigensolver,
+# 'sparse' keeps the recurrence and Laplacian sparse and uses a Lanczos solver,
+# 'auto' uses the sparse path for songs with at least SPARSE_EIGENSOLVER_MIN_BEATS beats
+EIGENSOLVER = 'auto'
+SPARSE_EIGENSOLVER_MIN_BEATS = 1000
+# Seed of the clusterings, a song is always segmented the same way so that seeded maps are reproducible
+SEGMENTATION_RANDOM_STATE = 0
+
+
+def select_k(sum_of_squared_distances):
     """
-    This function uses the Laplacian Segmentation method
-    described in McFee and Ellis, 2014, and adapted from
-    example code in the librosa documentation.
-    It returns the segment boundaries (in frame number and time)
-    and segment ID's of isolated music file segments.
+    Elbow method on the KMeans inertias of consecutive k values.
+    Returns None if no elbow is found.
     """
-    BINS_PER_OCTAVE = 12 * 3
-    N_OCTAVES = 7
-    C = librosa.amplitude_to_db(np.abs(librosa.cqt(y=np.array(y),
-                                                   sr=sr,
-                                                   bins_per_octave=BINS_PER_OCTAVE,
-                                                   n_bins=N_OCTAVES * BINS_PER_OCTAVE)), ref=np.max)
-    tempo, beats = librosa.beat.beat_track(
-        y=np.array(y), sr=sr, trim=False)
-    Csync = librosa.util.sync(C, beats, aggregate=np.median)
+    delta_sum_of_squared_distances = np.diff(sum_of_squared_distances)
 
-    # For plotting purposes, we'll need the timing of the beats
-    # We fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
-    beat_times = librosa.frames_to_time(librosa.util.fix_frames(
-        beats, x_min=0, x_max=C.shape[1]), sr=sr)
+    def f_delta(x):
+        return sum_of_squared_distances[x] - delta_sum_of_squared_distances[x]
+    try:
+        for i in range(1, len(delta_sum_of_squared_distances) - 1):
+            if (f_delta(i-1) - f_delta(i)) < (f_delta(i) - f_delta(i+1)):
+                return i
+    except Exception:
+        _print_exception(traceback.format_exc(),
+                         "Segmentation estimation error in song")
+        return 5
+    return None
+
+
+def _exhaustive_inertias(data, K):
+    sum_of_squared_distances = []
+    for k in K:
+        # Lets a cancelled job stop between the (slow) fits
+        job_progress()
+        km = sklearn.cluster.KMeans(n_clusters=k, random_state=SEGMENTATION_RANDOM_STATE)
+        km = km.fit(data)
+        sum_of_squared_distances.append(km.inertia_)
+    return sum_of_squared_distances
+
+
+def _fast_inertias(data, K, n_jobs):
+    # Rows are the samples: the centered rows in the basis of their principal components
+    # are at the same distances from each other, so every k gets the same fit and inertia
+    centered = data - data.mean(axis=0)
+    u, s, _ = scipy.linalg.svd(centered, full_matrices=False)
+    data = np.ascontiguousarray(u * s, dtype=data.dtype)
+
+    if n_jobs > 1:
+        def fit(k):
+            return sklearn.cluster.KMeans(n_clusters=k, random_state=SEGMENTATION_RANDOM_STATE).fit(data).inertia_
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(fit, K))
+    return _exhaustive_inertias(data, K)
+
+
+@span('segment_estimation')
+def estimate_segments(features, k_range=K_RANGE, estimation=SEGMENT_ESTIMATION):
+    """
+    Estimates the number of segments of a song with the elbow method
+    on KMeans fits of its scaled mel spectrogram.
+    Returns None if no estimate could be made.
+    """
+    mms = sklearn.preprocessing.MinMaxScaler()
+    melspec_db = features.melspectrogram_db()
+    data_transformed = mms.fit_transform(melspec_db)
+    K = range(*k_range)
+
+    if estimation == 'exhaustive':
+        return select_k(_exhaustive_inertias(data_transformed, K))
+
+    k_estimate = select_k(_fast_inertias(data_transformed, K, SEGMENT_ESTIMATION_JOBS))
+    if SEGMENT_ESTIMATION_COMPARE:
+        _print(f"Segment estimation: {estimation} k_estimate={k_estimate}, "
+               f"exhaustive k_estimate={select_k(_exhaustive_inertias(data_transformed, K))}")
+    return k_estimate
+
+
+def _diagonal_median_filter(R, size, chunk_size=2**18):
+    """
+    Sparse equivalent of librosa.segment.timelag_filter(scipy.ndimage.median_filter)(R, size=(1, size)):
+    a median filter along the diagonals of R. Like the dense filter, windows running past the first
+    or last column are reflected back along their diagonal (scipy's 'reflect' mode),
+    and cells whose row falls outside of the matrix count as zero.
+    Only cells within half a window of a stored value (or of its reflection) can end up non-zero.
+    """
+    R = scipy.sparse.coo_matrix(R)
+    n_rows, n_cols = R.shape
+    half = size // 2
+    offsets = np.arange(-half, half + 1)
+    rows, cols = R.row.astype(np.int64), R.col.astype(np.int64)
+    keys = rows * n_cols + cols
+    order = np.argsort(keys)
+    keys, values = keys[order], R.data[order]
+
+    # Windows centred near the first or last column also see the stored values mirrored past it
+    mirrored_cols = np.stack([cols, -cols - 1, 2 * n_cols - cols - 1])
+    candidate_cols = (mirrored_cols[:, :, None] + offsets).ravel()
+    candidate_rows = (mirrored_cols[:, :, None] + (rows - cols)[:, None] + offsets).ravel()
+    inside = ((candidate_rows >= 0) & (candidate_rows < n_rows) &
+              (candidate_cols >= 0) & (candidate_cols < n_cols))
+    candidates = np.unique(candidate_rows[inside] * n_cols + candidate_cols[inside])
+
+    out_rows, out_cols, out_values = [], [], []
+    for start in range(0, len(candidates), chunk_size):
+        chunk = candidates[start:start + chunk_size]
+        window_cols = chunk[:, None] % n_cols + offsets
+        window_cols = np.where(window_cols < 0, -window_cols - 1, window_cols)
+        window_cols = np.where(window_cols >= n_cols, 2 * n_cols - window_cols - 1, window_cols)
+        window_rows = window_cols + (chunk[:, None] // n_cols - chunk[:, None] % n_cols)
+        window_keys = window_rows * n_cols + window_cols
+        positions = np.minimum(np.searchsorted(keys, window_keys), len(keys) - 1)
+        found = ((window_rows >= 0) & (window_rows < n_rows) &
+                 (window_cols >= 0) & (window_cols < n_cols) &
+                 (keys[positions] == window_keys))
+        median = np.median(np.where(found, values[positions], 0), axis=1)
+        keep = median != 0
+        out_rows.append(chunk[keep] // n_cols)
+        out_cols.append(chunk[keep] % n_cols)
+        out_values.append(median[keep])
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(out_values), (np.concatenate(out_rows), np.concatenate(out_cols))), shape=R.shape)
+
+
+@span('eigenvectors')
+def laplacian_eigenvectors(Csync, Msync, k, eigensolver=EIGENSOLVER):
+    """
+    Builds the normalized Laplacian of the combined recurrence and path affinity
+    of the beat-synchronous features (McFee and Ellis, 2014)
+    and returns its k eigenvectors with the smallest eigenvalues.
+    """
+    n_beats = Csync.shape[1]
+    if eigensolver == 'auto':
+        eigensolver = 'sparse' if n_beats >= SPARSE_EIGENSOLVER_MIN_BEATS else 'dense'
+    sparse = eigensolver == 'sparse'
 
     R = librosa.segment.recurrence_matrix(
-        Csync, width=3, mode='affinity', sym=True)
+        Csync, width=3, mode='affinity', sym=True, sparse=sparse)
     # Enhance diagonals with a median filter (Equation 2)
-    df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
-    Rf = df(R, size=(1, 7))
-    mfcc = librosa.feature.mfcc(y=np.array(y), sr=sr)
-    Msync = librosa.util.sync(mfcc, beats)
+    if sparse:
+        Rf = _diagonal_median_filter(R, 7)
+    else:
+        df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+        Rf = df(R, size=(1, 7))
     path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
     sigma = np.median(path_distance)
     path_sim = np.exp(-path_distance / sigma)
-    R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
-    deg_path = np.sum(R_path, axis=1)
-    deg_rec = np.sum(Rf, axis=1)
+    if sparse:
+        R_path = scipy.sparse.diags([path_sim, path_sim], [1, -1], format='csr')
+    else:
+        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+    deg_path = np.asarray(R_path.sum(axis=1)).ravel()
+    deg_rec = np.asarray(Rf.sum(axis=1)).ravel()
     mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
     A = mu * Rf + (1 - mu) * R_path
     L = scipy.sparse.csgraph.laplacian(A, normed=True)
-    # and its spectral decomposition
-    evals, evecs = scipy.linalg.eigh(L)
+    # and its spectral decomposition, only the first k eigenvectors are used
+    if sparse:
+        # The median filter leaves L slightly asymmetric and eigh only reads its lower triangle,
+        # so the same symmetric matrix is built from it here
+        L = scipy.sparse.tril(L, format='csc') + scipy.sparse.tril(L, k=-1, format='csc').T
+        # Shift-invert Lanczos around -1, below the smallest eigenvalue even though the mirrored L
+        # can have slightly negative ones
+        evals, evecs = scipy.sparse.linalg.eigsh(L.tocsc(), k=k, sigma=-1.0, which='LM')
+        evecs = evecs[:, np.argsort(evals)]
+    else:
+        evals, evecs = scipy.linalg.eigh(L, subset_by_index=[0, k - 1])
+    return evecs
+
+
+def laplacian_segmentation(y, sr, bins_per_octave=BINS_PER_OCTAVE, n_octaves=N_OCTAVES, k_range=K_RANGE,
+                           estimation=SEGMENT_ESTIMATION, eigensolver=EIGENSOLVER):
+    """
+    This function uses the Laplacian Segmentation method
+    described in McFee and Ellis, 2014, and adapted from
+    example code in the librosa documentation.
+    It returns the segment boundaries (in frame number and time)
+    and segment ID's of isolated music file segments.
+    The segmentation does not depend on the difficulty, so it is computed once per song
+    and parameter set and served from the feature cache afterwards.
+    """
+    features = SongFeatures(y, sr)
+    return features._get('segmentation',
+                         lambda: _laplacian_segmentation(features, bins_per_octave, n_octaves, k_range,
+                                                         estimation, eigensolver),
+                         bins_per_octave, n_octaves, tuple(k_range), estimation, eigensolver)
+
+
+def _laplacian_segmentation(features, BINS_PER_OCTAVE, N_OCTAVES, k_range, estimation, eigensolver):
+    sr = features.sr
+    tempo, beats = features.beat_track()
+    job_progress('cqt')
+    Csync = features.beat_cqt_db(BINS_PER_OCTAVE, N_OCTAVES * BINS_PER_OCTAVE)
+
+    # For plotting purposes, we'll need the timing of the beats
+    # We fix_frames to include non-beat frames 0 and the final frame
+    beat_times = librosa.frames_to_time(features.beat_bounds(), sr=sr)
+
+    Msync = features.beat_mfcc()
+
+    job_progress('segmentation')
+    # estimate k, set = 5 by default
+    k_estimate = estimate_segments(features, k_range, estimation)
+    if k_estimate is None or k_estimate < 2 or k_estimate > 9:
+        k_estimate = 5
+
+    evecs = laplacian_eigenvectors(Csync, Msync, k_estimate, eigensolver)
     # We can clean this up further with a median filter.
     # This can help smooth over small discontinuities
     evecs = scipy.ndimage.median_filter(evecs, size=(9, 1))
     # cumulative normalization is needed for symmetric normalize laplacian eigenvectors
     Cnorm = np.cumsum(evecs**2, axis=1)**0.5
 
-    # estimate k, set = 5 by default
-    k_estimate = 5
-
-    def estimate_segments():
-        mms = MinMaxScaler()
-        melspec = librosa.feature.melspectrogram(
-            y=np.array(y), sr=sr)
-        mms.fit(librosa.power_to_db(melspec, ref=np.max))
-        data_transformed = mms.transform(
-            librosa.power_to_db(melspec, ref=np.max))
-
-        sum_of_squared_distances = []
-        K = range(1, 12)
-        for k in K:
-            km = KMeans(n_clusters=k)
-            km = km.fit(data_transformed)
-            sum_of_squared_distances.append(km.inertia_)
-        delta_sum_of_squared_distances = np.diff(sum_of_squared_distances)
-
-        def f_delta(x):
-            return sum_of_squared_distances[x] - delta_sum_of_squared_distances[x]
-        try:
-            for i in range(1, len(delta_sum_of_squared_distances) - 1):
-                if (f_delta(i-1) - f_delta(i)) < (f_delta(i) - f_delta(i+1)):
-                    return i
-                    break
-        except Exception:
-            _print_exception(traceback.format_exc(),
-                             "Segmentation estimation error in song")
-            return 5
-
-    k_estimate = estimate_segments()
-    if k_estimate is None or k_estimate < 2 or k_estimate > 9:
-        k_estimate = 5
-
     # If we want k clusters, use the first k normalized eigenvectors.
     X = evecs[:, :k_estimate] / Cnorm[:, k_estimate-1:k_estimate]
-    KM = KMeans(n_clusters=k_estimate)
-    seg_ids = KM.fit_predict(X)
+    KM = sklearn.cluster.KMeans(n_clusters=k_estimate, random_state=SEGMENTATION_RANDOM_STATE)
+    with span('kmeans'):
+        seg_ids = KM.fit_predict(X)
     bound_beats = 1 + np.flatnonzero(seg_ids[:-1] != seg_ids[1:])
     # Count beat 0 as a boundary
     bound_beats = librosa.util.fix_frames(bound_beats, x_min=0)
@@ -528,10 +1712,9 @@ def laplacian_segmentation(y, sr):
     bound_frames = beats[bound_beats]
     # Make sure we cover to the end of the track
     bound_frames = librosa.util.fix_frames(
-        bound_frames, x_min=None, x_max=C.shape[1]-1)
+        bound_frames, x_min=None, x_max=features.n_frames-1)
     bound_times = librosa.frames_to_time(bound_frames)
     bound_times = [(x/60) * tempo for x in bound_times]
-    beat_numbers = list(range(len(bound_frames)))
     bound_beats = np.append(bound_beats, list(range(len(beats)))[-1])
     segments = list(zip(zip(bound_times, bound_times[1:]), zip(
         bound_beats, bound_beats[1:]), bound_segs))
@@ -539,6 +1722,18 @@ def laplacian_segmentation(y, sr):
     return segments, beat_times, tempo
 
 
+def segments_to_json(segments, beat_times, tempo):
+    """Helper function to translate a song segmentation to JSON serializable types."""
+    return {'segments': [{'start_time': float(times[0]),
+                          'end_time': float(times[1]),
+                          'start_beat': int(beats[0]),
+                          'end_beat': int(beats[1]),
+                          'seg_no': int(seg_no)}
+                         for times, beats, seg_no in segments],
+            'beat_times': [float(x) for x in beat_times],
+            'tempo': float(tempo)}
+
+
 def segments_to_data_frame(segments):
     """Helper function to translate a song semgmenation to a pandas DataFrame."""
     lengths = []
@@ -550,314 +1745,1491 @@ def segments_to_data_frame(segments):
     return df
 
 
-def segment_predictions(segment_df, HMM_model):
+@span('walk')
+def segment_predictions(segment_df, walker, rng=None):
     """
     This function predicts a Markov chain walk for each segment of a segmented music file.
     It will repeat a walk for segments that it has already mapped previously
     (truncating or extending as necessary).
     """
-    preds = pd.DataFrame([])
+    preds = []
     completed_segments = {}
-    for index, row in segment_df.iterrows():
-        if row['seg_no'] not in completed_segments.keys():
-            def get_preds(init_state, index):
-                pred = HMM_model.walk(init_state=tuple(
-                    preds.iloc[-5:, 0])) if init_state else HMM_model.walk()
-                while len(pred) < row['length']:
-                    pred = HMM_model.walk(init_state=tuple(
-                        preds.iloc[-5:, 0])) if init_state else HMM_model.walk()
-                obj = {0: {row['seg_no']: {'start': 0, 'end': len(pred)}},
-                       1: {row['seg_no']: {'start': len(preds)+1, 'end': len(preds)+len(pred)}}}
-                completed_segments.update(obj[index])
-                return pd.concat([preds, pd.Series(pred[0: row['length']])], axis=0, ignore_index=True)
-
-            if index == 0:
-                preds = get_preds(False, 0)
-            else:
-                try:
-                    preds = get_preds(True, 1)
-                except Exception:
-                    preds = get_preds(False, 1)
-
+    for length, seg_no in zip(segment_df['length'], segment_df['seg_no']):
+        length = int(length)
+        if seg_no not in completed_segments:
+            # Continue the walk from the end of the previous segment
+            init_state = tuple(preds[-walker.state_size:]) if preds else None
+            pred = walker.walk(length, init_state=init_state, rng=rng)
+            completed_segments[seg_no] = (len(preds), len(preds) + length)
         else:
-            if (row['length'] <= (completed_segments[row['seg_no']]['end'] - completed_segments[row['seg_no']]['start'])):
-                pred = preds.iloc[
-                    completed_segments[row['seg_no']]['start']: completed_segments[row['seg_no']]['start'] + row['length'],
-                    0]
-                preds = pd.concat([preds, pred], axis=0, ignore_index=True)
-            else:
-                def get_preds(extend, preds):
-                    pred = preds.iloc[completed_segments[row['seg_no']]
-                                      ['start']: completed_segments[row['seg_no']]['end'], 0]
-                    diff = row['length'] - len(pred)
-                    pred = pd.concat(
-                        [pred, pd.Series(extend[0: diff+1])], axis=0, ignore_index=True)
-                    completed_segments.update(
-                        {row['seg_no']: {'start': len(preds)+1, 'end': len(preds)+len(pred)}})
-                    return pd.concat([preds, pred], axis=0, ignore_index=True)
-                try:
-                    extend = HMM_model.walk(init_state=tuple(
-                        preds.iloc[completed_segments[row['seg_no']]['end'] - 5: completed_segments[row['seg_no']]['end'], 0]))
-                    preds = get_preds(extend, preds)
-                except Exception:
-                    extend = HMM_model.walk()
-                    preds = get_preds(extend, preds)
+            start, end = completed_segments[seg_no]
+            pred = preds[start: min(end, start + length)]
+            if len(pred) < length:
+                # Extend the previous walk of this segment
+                pred = pred + walker.walk(length - len(pred),
+                                          init_state=tuple(preds[max(start, end - walker.state_size): end]),
+                                          rng=rng)
+                completed_segments[seg_no] = (len(preds), len(preds) + length)
+        preds.extend(pred)
 
-    preds_list = list(preds.iloc[:, 0])
-    preds = walk_to_data_frame(preds_list)
     return preds
 
 
-def segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr):
+def segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr, rng=None):
     """
-    This function writes the list of notes based on the segmented HMM model.
+    This function writes the notes based on the segmented HMM model.
     """
-    MC = load_hmm_model(tempDir, difficulty, version)
+    walker = load_hmm_walker(tempDir, difficulty, version)
     (segments, beat_times, tempo) = laplacian_segmentation(y, sr)
     segments_df = segments_to_data_frame(segments)
-    preds = segment_predictions(segments_df, MC)
+    preds = segment_predictions(segments_df, walker, rng)
     # Combine beat numbers with HMM walk steps
     beats = [(x/60) * tempo for x in beat_times]
-    df_preds = pd.concat(
-        [pd.DataFrame(beats, columns=['_time']), preds], axis=1, sort=True)
-    df_preds.dropna(axis=0, inplace=True)
     # Write notes dictionaries
-    return write_notes_hmm(df_preds, bpm)
+    return write_notes_hmm(beats, preds, bpm, rng)
 
 
 # Rate Modulated Segmented HMM Note Writing Functions
-def choose_rate(decibel, difficulty):
-    """
-    This function modulates the block placement rate by using the average amplitude
-    (i.e., 'loudness') across beats to choose how many blocks per beat will be placed.
-    Takes in the difficulty level and the amplitude and returns an
-    integer in the set {0, 1, 2, 4, 8, 16}.
-    If you are finding that your maps are too fast or too slow for you,
-    you might want to play with the probabilities in this file.
-    """
-    decibel = np.abs(decibel)
-    p = None
-
-    def get_rate_level_from_decibel(decibel):
-        if decibel > 70:
-            return 4
-        elif decibel <= 70 and decibel > 55:
-            return 3
-        elif decibel <= 55 and decibel > 45:
-            return 2
-        elif decibel <= 45 and decibel > 35:
-            return 1
+# Blocks per beat the rate modulated model can place
+RATES = np.array([0, 1, 2, 4, 8, 16])
+# Upper bounds of the absolute decibel levels 0 to 3, anything louder is level 4
+RATE_LEVEL_DECIBELS = [35, 45, 55, 70]
+# Probability of each rate per difficulty and decibel level.
+# If you are finding that your maps are too fast or too slow for you,
+# you might want to play with these probabilities.
+RATE_PROBABILITIES = {'easy':       [[0.3, 0.6, 0.1, 0, 0, 0],
+                                     [0.4, 0.5, 0.1, 0, 0, 0],
+                                     [0.80, 0.2, 0, 0, 0, 0],
+                                     [0.90, 0.10, 0, 0, 0, 0],
+                                     [0.95, 0.05, 0, 0, 0, 0]],
+                      'normal':     [[0.05, 0.7, 0.25, 0, 0, 0],
+                                     [0.2, 0.7, 0.1, 0, 0, 0],
+                                     [0.3, 0.7, 0, 0, 0, 0],
+                                     [0.5, 0.5, 0, 0, 0, 0],
+                                     [0.95, 0.05, 0, 0, 0, 0]],
+                      'hard':       [[0.05, 0.35, 0.6, 0, 0, 0],
+                                     [0.1, 0.5, 0.4, 0, 0, 0],
+                                     [0.2, 0.6, 0.2, 0, 0, 0],
+                                     [0.5, 0.5, 0, 0, 0, 0],
+                                     [0.95, 0.05, 0, 0, 0, 0]],
+                      'expert':     [[0.8, 0.2, 0, 0, 0, 0],
+                                     [0.2, 0.7, 0.1, 0, 0, 0],
+                                     [0.1, 0.4, 0.3, 0.2, 0, 0],
+                                     [0, 0.05, 0.6, 0.35, 0, 0],
+                                     [0, 0, 0.35, 0.65, 0, 0]],
+                      'expertplus': [[0, 0, 0, 0.5, 0.3, 0.2],
+                                     [0, 0.05, 0.1, 0.6, 0.25, 0],
+                                     [0, 0.1, 0.6, 0.3, 0, 0],
+                                     [0, 0.3, 0.6, 0.1, 0, 0],
+                                     [0, 0.5, 0.4, 0.1, 0, 0]]}
+# Largest change of rate between two consecutive beats
+MAX_RATE_CHANGE = {'expert': 4, 'expertplus': 8}
+DEFAULT_MAX_RATE_CHANGE = 2
+
+
+def _rate_transition_tables():
+    """
+    Cumulative distributions of the next rate index indexed by
+    [difficulty][decibel level][previous rate index].
+    Rates further than the difficulty's maximum change from the previous rate
+    are removed and the rest renormalized, so a rate is a single draw.
+    Two 4s in a row are not allowed, that probability goes to 0, 1 and 2 evenly.
+    If no allowed rate is left, the allowed rate closest to the level's mean rate is used.
+    """
+    four = int(np.flatnonzero(RATES == 4)[0])
+    tables = {}
+    for difficulty, probabilities in RATE_PROBABILITIES.items():
+        maxdiff = MAX_RATE_CHANGE.get(difficulty, DEFAULT_MAX_RATE_CHANGE)
+        table = np.zeros((len(probabilities), len(RATES), len(RATES)))
+        for level, p in enumerate(np.asarray(probabilities, dtype=np.float64)):
+            for last, last_rate in enumerate(RATES):
+                allowed = np.abs(RATES - last_rate) <= maxdiff
+                q = np.where(allowed, p, 0)
+                if q.sum() == 0:
+                    q[np.flatnonzero(allowed)[np.argmin(np.abs(RATES[allowed] - RATES @ p))]] = 1
+                q /= q.sum()
+                if last == four:
+                    q[:3] += q[four] / 3
+                    q[four] = 0
+                table[level, last] = np.cumsum(q)
+        # Guard against rounding leaving the last bin short of 1
+        table[..., -1] = 1
+        tables[difficulty] = table.tolist()
+    return tables
+
+
+RATE_TRANSITION_TABLES = _rate_transition_tables()
+
+
+def rate_levels(avg_beat_decibel):
+    """Decibel level (0 to 4) of the mean amplitude of each beat and its two neighbours."""
+    smoothed = np.convolve(np.asarray(avg_beat_decibel, dtype=np.float64), np.ones(3) / 3, mode='valid')
+    return np.searchsorted(RATE_LEVEL_DECIBELS, np.abs(smoothed), side='left')
+
+
+def choose_rates(levels, difficulty, rng=None):
+    """
+    Chooses the rate of each beat from its decibel level,
+    keeping the change between consecutive rates within the difficulty's limit.
+    Returns an array of rates in {0, 1, 2, 4, 8, 16}.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    table = RATE_TRANSITION_TABLES[difficulty.casefold()]
+    indices = []
+    last = 0
+    for level, u in zip(levels.tolist(), rng.random(len(levels)).tolist()):
+        last = bisect.bisect_right(table[level][last], u)
+        indices.append(last)
+    return RATES[np.asarray(indices, dtype=np.int64)]
+
+
+def rates_to_beat_numbers(rates):
+    """Sorted unique beat numbers of the blocks placed by the given rate of each beat."""
+    rates = np.asarray(rates, dtype=np.int64)
+    beats = np.flatnonzero(rates)
+    rates = rates[beats]
+    # A beat at rate r > 1 places blocks at every 1/r of the beat up to and including the next beat
+    counts = np.where(rates == 1, 1, rates + 1)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    steps = np.arange(counts.sum()) - starts
+    return np.unique(np.repeat(beats, counts) + steps / np.repeat(rates, counts))
+
+
+def amplitude_rate_modulation(difficulty, y, sr, rng=None):
+    """
+    This function uses the average amplitude (i.e., 'loudness')
+    of a beat and the difficulty level to determine
+    how many blocks will be placed within the beat.
+    Returns an array of beat numbers.
+    """
+    # Mean amplitude per beat
+    avg_beat_decibel = SongFeatures(y, sr).beat_decibel()
+    # Choose rates and smooth rate transitions, the first beat has no blocks
+    rates = np.r_[0, choose_rates(rate_levels(avg_beat_decibel), difficulty, rng)]
+    # Make array of beat numbers based on rates
+    return rates_to_beat_numbers(rates)
+
+
+def segments_to_data_frame_rate_modulated(segments, modulated_beat_list):
+    """
+    This function returns a DataFrame of the number of blocks needed for each song segment.
+    """
+    modulated_beats = np.asarray(modulated_beat_list, dtype=np.float64)
+    # Assign every modulated beat to the segments whose beat range (start, end] contains it
+    beat_segments = []
+    for (_, (start, end), seg_no) in segments:
+        first, last = np.searchsorted(modulated_beats, [start, end], side='right')
+        beat_segments.append(np.full(max(last - first, 0), seg_no, dtype=np.int64))
+    beat_segments = np.concatenate(beat_segments) if beat_segments else np.empty(0, dtype=np.int64)
+    # Run-length encode consecutive beats of the same segment
+    run_starts = np.flatnonzero(np.r_[True, beat_segments[1:] != beat_segments[:-1]]) \
+        if len(beat_segments) else np.empty(0, dtype=np.int64)
+    lengths = np.diff(np.r_[run_starts, len(beat_segments)])
+    return pd.DataFrame({'length': lengths, 'seg_no': beat_segments[run_starts]})
+
+
+def modulated_beat_times(beat_times, tempo, modulated_beat_list):
+    """
+    Returns the time (in beats) of each modulated beat.
+    Times of fractional beats are interpolated from the whole beats around them.
+    """
+    beat_times = np.asarray(beat_times, dtype=np.float64) / 60 * tempo
+    modulated_beats = np.asarray(modulated_beat_list, dtype=np.float64)
+    beat_count = np.arange(len(beat_times))
+    known = np.isin(beat_count, modulated_beats)
+    if not known.any():
+        return np.full(len(modulated_beats), np.nan)
+    return np.interp(modulated_beats, beat_count[known], beat_times[known])
+
+
+def rate_modulated_segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr, rng=None):
+    """
+    Function to write the notes after predicting with
+    the rate modulated segmented HMM model.
+    """
+    walker = load_hmm_walker(tempDir, difficulty, version)
+    (segments, beat_times, tempo) = laplacian_segmentation(y, sr)
+    modulated_beat_list = amplitude_rate_modulation(difficulty, y, sr, rng)
+    segments_df = segments_to_data_frame_rate_modulated(
+        segments, modulated_beat_list)
+    preds = segment_predictions(segments_df, walker, rng)
+    # Combine beat times with HMM walk steps and write notes dictionaries
+    return write_notes_hmm(modulated_beat_times(beat_times, tempo, modulated_beat_list), preds, bpm, rng)
+
+
+# Level Events
+# Event types of the level format
+EVENT_LIGHTS = 4
+EVENT_TRACK_NEONS = 1
+# Ring rotation, then small ring zoom
+EVENT_RINGS = [8, 9]
+# Light event values, by color (0 red, 1 blue)
+LIGHT_OFF = 0
+LIGHT_ON = [5, 1]
+LIGHT_FLASH = [6, 2]
+LIGHT_FADE = [7, 3]
+# The note lights swap every rounded beats per second times this many beats,
+# cycling flash, on and fade in alternating colors
+EVENT_COLOR_SWAP_OFFSET = 2.5
+LIGHT_CYCLE = np.array([LIGHT_FLASH, LIGHT_ON, LIGHT_FADE])
+# How the lights are driven: 'notes' swaps them on the notes every few beats,
+# 'audio' follows the loudness of every beat and changes color with the song segments
+LIGHTS = 'notes'
+# Loudness quantiles of the beats of a song above which the 'audio' lights fade, are on and flash
+LIGHT_LOUDNESS_QUANTILES = [0.1, 0.4, 0.8]
+LIGHT_LEVELS = np.array([[LIGHT_OFF, LIGHT_OFF], LIGHT_FADE, LIGHT_ON, LIGHT_FLASH])
+
+
+def note_events(notes, bpm, color_swap_offset=EVENT_COLOR_SWAP_OFFSET, lights=True):
+    """
+    Writes the events following a structured note array in time order: the note lights (off at the first
+    and last notes), a ring rotation on every third note and ring zooms on the others,
+    and a track neon light in the color of every red and blue note.
+    Without lights only the initial lights off, ring and neon events are written.
+    """
+    n = len(notes)
+    if n == 0:
+        raise ValueError('Notes list is empty!')
+    times = notes['_time']
+    # (time, type, value, note, order within the note's events) of every event, the initial lights off first
+    parts = [(np.zeros(1), EVENT_LIGHTS, LIGHT_OFF, np.full(1, -1), 0)]
+    if lights:
+        ends = np.unique([0, n - 1])
+        parts.append((times[ends], EVENT_LIGHTS, LIGHT_OFF, ends, 0))
+        # The lights swap on the first note (other than the first and last) past the interval since the last swap
+        interval = np.floor(bpm / 60 + 0.5) * color_swap_offset
+        time_list = times.tolist()
+        swaps = []
+        last, i = 0.0, 1
+        while True:
+            i = max(i, bisect.bisect_right(time_list, last + interval))
+            if i >= n - 1:
+                break
+            swaps.append(i)
+            last, i = time_list[i], i + 1
+        swap_count = np.arange(len(swaps))
+        parts.append((times[swaps], EVENT_LIGHTS, LIGHT_CYCLE[swap_count % 3, 1 - swap_count // 3 % 2],
+                      np.array(swaps, dtype=np.int64), 0))
+    note_index = np.arange(n)
+    parts.append((times, np.where(note_index % 3 == 0, EVENT_RINGS[0], EVENT_RINGS[1]), LIGHT_OFF, note_index, 1))
+    colored = np.flatnonzero(np.isin(notes['_type'], [0, 1]))
+    parts.append((times[colored], EVENT_TRACK_NEONS, np.array(LIGHT_ON)[notes['_type'][colored]], colored, 2))
+
+    events = np.empty(sum(len(part[0]) for part in parts), dtype=EVENT_DTYPE)
+    note, order = np.empty(len(events), dtype=np.int64), np.empty(len(events), dtype=np.int64)
+    start = 0
+    for part_times, part_types, part_values, part_notes, part_order in parts:
+        stop = start + len(part_times)
+        events['_time'][start:stop] = part_times
+        events['_type'][start:stop] = part_types
+        events['_value'][start:stop] = part_values
+        note[start:stop] = part_notes
+        order[start:stop] = part_order
+        start = stop
+    return events[np.lexsort((order, note))]
+
+
+def audio_light_events(beat_decibel, beat_times, tempo, segments):
+    """
+    Writes light events following the song: every beat is lit by its loudness within the song
+    (off, fading, on or flashing, see LIGHT_LOUDNESS_QUANTILES) in a color set by its segment label.
+    Events are written where the lights change and on every flashing beat.
+    beat_times are the times (seconds) of the beat bounds, as returned by laplacian_segmentation.
+    """
+    loudness = scipy.ndimage.uniform_filter1d(np.asarray(beat_decibel, dtype=np.float64), 3, mode='nearest')
+    levels = np.searchsorted(np.quantile(loudness, LIGHT_LOUDNESS_QUANTILES), loudness, side='right')
+    starts = np.array([int(beats[0]) for _, beats, _ in segments], dtype=np.int64)
+    labels = np.array([int(seg_no) for _, _, seg_no in segments] or [1], dtype=np.int64)
+    segment = np.maximum(np.searchsorted(starts, np.arange(len(levels)), side='right') - 1, 0)
+    values = LIGHT_LEVELS[levels, labels[segment] % 2]
+    changed = np.flatnonzero(np.r_[True, values[1:] != values[:-1]] | (levels == len(LIGHT_LEVELS) - 1))
+    events = np.empty(len(changed), dtype=EVENT_DTYPE)
+    events['_time'] = np.asarray(beat_times, dtype=np.float64)[changed] / 60 * tempo
+    events['_type'] = EVENT_LIGHTS
+    events['_value'] = values[changed]
+    return events
+
+
+@span('events')
+def write_events(notes, bpm, y=None, sr=None, lights=LIGHTS, color_swap_offset=EVENT_COLOR_SWAP_OFFSET):
+    """
+    Writes the events of a difficulty from its notes, see note_events.
+    'audio' lights follow the song's analysis instead (see audio_light_events) and turn off at the last note.
+    """
+    if lights == 'notes':
+        return note_events(notes, bpm, color_swap_offset)
+    if lights != 'audio':
+        raise ValueError(f"Unknown lights: {lights}")
+    events = note_events(notes, bpm, lights=False)
+    segments, beat_times, tempo = laplacian_segmentation(y, sr)
+    end = np.array([(notes['_time'][-1], EVENT_LIGHTS, LIGHT_OFF)], dtype=EVENT_DTYPE)
+    events = np.concatenate([events,
+                             audio_light_events(SongFeatures(y, sr).beat_decibel(), beat_times, tempo, segments),
+                             end])
+    return events[np.argsort(events['_time'], kind='stable')]
+
+
+def write_obstacles(notes, bpm):
+    """Writes the obstacles of a difficulty, none of the models places obstacles yet."""
+    return np.empty(0, dtype=OBSTACLE_DTYPE)
+
+
+# Note writers by model, each returns a structured note array
+MODEL_WRITERS = {
+    # Completely random map (i.e. baseline model), likely not enjoyable if even playable!
+    'random': random_notes_writer,
+    # Custom map based on a Hidden Markov Model
+    'HMM': hmm_notes_writer,
+    # HMM walked through the first of each Laplacian song segment,
+    # the block sequence is repeated wherever that segment repeats
+    'segmented_HMM': segmented_hmm_notes_writer,
+    # Segmented HMM placing blocks at a rate driven by the amplitude of each beat
+    'rate_modulated_segmented_HMM': rate_modulated_segmented_hmm_notes_writer,
+}
+# Maximum number of difficulties mapped at the same time by /run_models
+RUN_MODELS_JOBS = 5
+# Notes lists of seeded model runs, which give the same notes every time
+notes_cache = FeatureCache(max_bytes=256 * 1024 * 1024, max_entries=1024)
+
+
+def normalize_seed(seed):
+    """
+    Seed of a model run as a non-negative integer, integers are reduced modulo 2**32 so that any of them works.
+    Raises ValueError for anything other than an integer or None.
+    """
+    if seed is None:
+        return None
+    if isinstance(seed, bool) or not isinstance(seed, (int, np.integer)):
+        raise ValueError(f"Seed must be an integer, got {seed!r}")
+    return int(seed) % 2**32
+
+
+def notes_rng(seed, difficulty):
+    """
+    Random generator of the stochastic steps of mapping one difficulty.
+    A seed always maps a difficulty the same way, whatever difficulties are mapped alongside it,
+    without a seed every run differs.
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, *difficulty.casefold().encode()])
+
+
+def _notes_key(model, tempDir, difficulty, version, y, sr, seed, song_key=None):
+    try:
+        model_mtime = os.path.getmtime(ModelRegistry.model_path(tempDir, difficulty, version))
+    except OSError:
+        # The random model has no model file
+        model_mtime = None
+    return ('notes', song_key or audio_hash(y, sr), model, difficulty, version, seed, model_mtime)
+
+
+def write_notes(model, tempDir, difficulty, beat_times, bpm, version, y, sr, seed=None, song_key=None):
+    """
+    Maps one difficulty of a song with a model, recording its time and notes in the metrics.
+    Seeded runs are kept in the notes cache, keyed by the audio hash (song_key if already known),
+    model, difficulty, version, seed and the model file's modification time.
+    """
+    seed = normalize_seed(seed)
+
+    def run():
+        start = time.perf_counter()
+        notes = MODEL_WRITERS[model](tempDir, difficulty, beat_times, bpm, version, y, sr,
+                                     rng=notes_rng(seed, difficulty))
+        metrics.observe('beatmap_model_seconds', time.perf_counter() - start, model=model, difficulty=difficulty)
+        metrics.inc('beatmap_notes_total', len(notes), model=model, difficulty=difficulty)
+        return notes
+
+    if seed is None:
+        return run()
+    return notes_cache.get(_notes_key(model, tempDir, difficulty, version, y, sr, seed, song_key), run)
+
+
+def write_level(model, tempDir, difficulty, beat_times, bpm, version, y, sr, seed=None, song_key=None,
+                lights=LIGHTS, color_swap_offset=EVENT_COLOR_SWAP_OFFSET):
+    """
+    Maps one difficulty of a song into its complete level data: 'notes' (see write_notes), 'events'
+    (see write_events) and 'obstacles'. Seeded levels are kept in the notes cache like their notes.
+    """
+    seed = normalize_seed(seed)
+    if seed is not None:
+        song_key = song_key or audio_hash(y, sr)
+
+    def run():
+        notes = write_notes(model, tempDir, difficulty, beat_times, bpm, version, y, sr, seed, song_key)
+        return {'notes': notes,
+                'events': write_events(notes, bpm, y, sr, lights, color_swap_offset),
+                'obstacles': write_obstacles(notes, bpm)}
+
+    if seed is None:
+        return run()
+    key = _notes_key(model, tempDir, difficulty, version, y, sr, seed, song_key) + ('level', lights, color_swap_offset)
+    return notes_cache.get(key, run)
+
+
+def level_options(level):
+    """write_level options of a request's 'level' object."""
+    return {'lights': level.get('lights', LIGHTS),
+            'color_swap_offset': float(level.get('color_swap_offset', EVENT_COLOR_SWAP_OFFSET))}
+
+
+def analyse_song(model, y, sr, lights=None):
+    """
+    Computes the song analysis shared by every difficulty of a model (and of its lights),
+    so that the per-difficulty walks only read it from the feature cache.
+    """
+    features = SongFeatures(y, sr)
+    job_progress('beat track')
+    features.beat_track()
+    if 'segmented' in model or lights == 'audio':
+        laplacian_segmentation(y, sr)
+    if model == 'rate_modulated_segmented_HMM' or lights == 'audio':
+        features.beat_decibel()
+
+
+def run_models_parallel(model, tempDir, difficulties, beat_times, bpm, version, y, sr, jobs=RUN_MODELS_JOBS,
+                        seed=None, level=None):
+    """
+    Maps several difficulties of a song with one model, the shared analysis is done once
+    and the difficulties are walked in parallel. Each difficulty is seeded as in write_notes.
+    Returns the seconds spent in the shared analysis and, per difficulty,
+    its note array, seconds and error message (None if it succeeded).
+    With level options (see level_options) every difficulty also gets its events and obstacles.
+    """
+    options = level_options(level) if level is not None else None
+    seed = normalize_seed(seed)
+    start = time.perf_counter()
+    analyse_song(model, y, sr, options and options['lights'])
+    analysis_seconds = time.perf_counter() - start
+    song_key = audio_hash(y, sr) if seed is not None else None
+
+    finished = []
+
+    def run(difficulty):
+        job_progress('walk')
+        start = time.perf_counter()
+        result = {'data': None} if options is None else {'data': None, 'events': None, 'obstacles': None}
+        error = None
+        try:
+            if options is None:
+                result['data'] = write_notes(model, tempDir, difficulty, beat_times, bpm, version, y, sr,
+                                             seed, song_key)
+            else:
+                level_data = write_level(model, tempDir, difficulty, beat_times, bpm, version, y, sr,
+                                         seed, song_key, **options)
+                result = {'data': level_data['notes'], 'events': level_data['events'],
+                          'obstacles': level_data['obstacles']}
+        except JobCancelled:
+            raise
+        except Exception as e:
+            _print_exception(traceback.format_exc())
+            error = f"{type(e).__name__}: {e}"
+        finished.append(difficulty)
+        job_progress(percent=JOB_STAGES['walk'] + (100 - JOB_STAGES['walk']) * len(finished) / len(difficulties))
+        return {**result, 'seconds': time.perf_counter() - start, 'error': error}
+
+    # Every difficulty reports to the job of the calling thread
+    contexts = [contextvars.copy_context() for _ in difficulties]
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(difficulties)))) as executor:
+        results = dict(zip(difficulties, executor.map(
+            lambda context, difficulty: context.run(run, difficulty), contexts, difficulties)))
+    return {'analysis_seconds': analysis_seconds, 'results': results}
+
+
+# Native samples per block of the streaming decoder, and input samples resampled around each block
+STREAM_DECODE_BLOCK = 2**20
+RESAMPLE_CONTEXT = 4096
+# Rough peak bytes per native sample and channel of decoding a whole song with librosa.load
+DECODE_BYTES_PER_SAMPLE = 16
+
+
+def audio_info(song_path):
+    """Returns the duration in seconds, sample rate and channel count of a song without decoding it."""
+    try:
+        info = soundfile.info(song_path)
+        return info.duration, info.samplerate, info.channels
+    except RuntimeError:
+        with audioread.audio_open(song_path) as f:
+            return f.duration, f.samplerate, f.channels
+
+
+def _decoded_blocks(song_path, block_samples=STREAM_DECODE_BLOCK):
+    """Yields (sample rate, mono float32 samples) decoding a song block by block."""
+    try:
+        sound_file = soundfile.SoundFile(song_path)
+    except RuntimeError:
+        sound_file = None
+    if sound_file is not None:
+        with sound_file:
+            for block in sound_file.blocks(blocksize=block_samples, dtype='float32', always_2d=True):
+                yield sound_file.samplerate, block.mean(axis=1)
+        return
+    # Formats libsndfile can't read, like librosa.load
+    with audioread.audio_open(song_path) as f:
+        for buffer in f:
+            yield f.samplerate, librosa.util.buf_to_float(buffer, dtype=np.float32).reshape(-1, f.channels).mean(axis=1)
+
+
+def _resampled_blocks(blocks, sr, block_samples=STREAM_DECODE_BLOCK):
+    """
+    Resamples a stream of (sample rate, samples) blocks to sr like librosa.load does.
+    Every chunk is resampled with RESAMPLE_CONTEXT samples on each side,
+    which gives the same samples as resampling the whole signal at once.
+    """
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    if first is None:
+        return
+    sr_orig = first[0]
+    if sr_orig == sr:
+        yield first[1]
+        for _, block in blocks:
+            yield block
+        return
+    # Chunks start on input samples that fall exactly on an output sample
+    step = sr_orig // np.gcd(sr_orig, sr)
+    chunk = -(-block_samples // step) * step
+    context = -(-RESAMPLE_CONTEXT // step) * step
+    buffer = first[1]
+    origin = 0
+    done = 0
+
+    def resample(stop):
+        start = max(done - context, 0)
+        resampled = librosa.resample(buffer[start - origin:stop - origin], orig_sr=sr_orig, target_sr=sr,
+                                     res_type='kaiser_best')
+        return resampled[(done - start) * sr // sr_orig:]
+
+    for _, block in blocks:
+        buffer = np.concatenate([buffer, block])
+        while origin + len(buffer) >= done + chunk + context:
+            yield resample(done + chunk + context)[:chunk * sr // sr_orig]
+            done += chunk
+            buffer = buffer[max(done - context, 0) - origin:]
+            origin = max(done - context, 0)
+    yield resample(origin + len(buffer))
+
+
+def _concatenate_blocks(blocks, duration, sr):
+    """Concatenates the blocks of a song of about duration seconds into a preallocated array."""
+    y = np.empty(int(np.ceil((duration + 1) * sr)), dtype=np.float32)
+    n = 0
+    for block in blocks:
+        job_progress()
+        if n + len(block) > len(y):
+            y = np.concatenate([y[:n], np.empty(max(len(block), len(y) // 4), dtype=np.float32)])
+        y[n:n + len(block)] = block
+        n += len(block)
+    return y[:n]
+
+
+def _decoded_key(song_path, sr):
+    """Feature cache key of a decoded song file, which changes whenever the file does."""
+    stat = os.stat(song_path)
+    return ('decoded', os.path.abspath(song_path), stat.st_size, stat.st_mtime_ns, sr)
+
+
+def load_audio(song_path, sr=22050):
+    """
+    Decodes a song to mono float32 samples at sr, or returns it from the feature cache.
+    Songs that would take more than ANALYSIS_MEMORY_LIMIT to decode at once
+    are decoded and resampled block by block into the output array.
+    """
+    @span('decode')
+    def decode():
+        duration, sr_native, channels = audio_info(song_path)
+        if duration * sr_native * channels * DECODE_BYTES_PER_SAMPLE <= ANALYSIS_MEMORY_LIMIT:
+            y, _ = librosa.load(song_path, sr=sr, dtype=np.float32)
         else:
-            return 0
+            y = _concatenate_blocks(_resampled_blocks(_decoded_blocks(song_path), sr), duration, sr)
+        metrics.inc('beatmap_audio_seconds_total', len(y) / sr)
+        return y, sr
+    return feature_cache.get(_decoded_key(song_path, sr), decode)
 
-    easy_probabilities = {0: [0.3, 0.6, 0.1, 0, 0, 0],
-                          1: [0.4, 0.5, 0.1, 0, 0, 0],
-                          2: [0.80, 0.2, 0, 0, 0, 0],
-                          3: [0.90, 0.10, 0, 0, 0, 0],
-                          4: [0.95, 0.05, 0, 0, 0, 0]}
 
-    normal_probabilities = {0: [0.05, 0.7, 0.25, 0, 0, 0],
-                            1: [0.2, 0.7, 0.1, 0, 0, 0],
-                            2: [0.3, 0.7, 0, 0, 0, 0],
-                            3: [0.5, 0.5, 0, 0, 0, 0],
-                            4: [0.95, 0.05, 0, 0, 0, 0]}
+def load_song(song_path):
+    """Loads a song and estimates its bpm and beat times."""
+    job_progress('decode')
+    y, sr = load_audio(song_path)
+    job_progress('beat track')
+    bpm, beat_frames = SongFeatures(y, sr).beat_track()
+    return y, sr, bpm, librosa.frames_to_time(beat_frames, sr=sr)
 
-    hard_probabilities = {0: [0.05, 0.35, 0.6, 0, 0, 0],
-                          1: [0.1, 0.5, 0.4, 0, 0, 0],
-                          2: [0.2, 0.6, 0.2, 0, 0, 0],
-                          3: [0.5, 0.5, 0, 0, 0, 0],
-                          4: [0.95, 0.05, 0, 0, 0, 0]}
 
-    expert_probabilities = {0: [0.8, 0.2, 0, 0, 0, 0],
-                            1: [0.2, 0.7, 0.1, 0, 0, 0],
-                            2: [0.1, 0.4, 0.3, 0.2, 0, 0],
-                            3: [0, 0.05, 0.6, 0.35, 0, 0],
-                            4: [0, 0, 0.35, 0.65, 0, 0]}
+# Audio Conversion
+# Samples read from ffmpeg at a time, per channel
+CONVERT_PIPE_BLOCK = 2**18
 
-    expertPlus_probabilities = {0: [0, 0, 0, 0.5, 0.3, 0.2],
-                                1: [0, 0.05, 0.1, 0.6, 0.25, 0],
-                                2: [0, 0.1, 0.6, 0.3, 0, 0],
-                                3: [0, 0.3, 0.6, 0.1, 0, 0],
-                                4: [0, 0.5, 0.4, 0.1, 0, 0]}
 
-    difficulty_probabilities = {'easy':       easy_probabilities,
-                                'normal':     normal_probabilities,
-                                'hard':       hard_probabilities,
-                                'expert':     expert_probabilities,
-                                'expertplus': expertPlus_probabilities}
+def _pipe_blocks(pipe, sr_native, channels, block_samples=CONVERT_PIPE_BLOCK):
+    """Yields (sample rate, mono float32 samples) blocks of interleaved float32 PCM read from a pipe."""
+    while True:
+        data = pipe.read(block_samples * channels * 4)
+        if not data:
+            return
+        samples = np.frombuffer(data, dtype='<f4')
+        yield sr_native, samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
 
-    p = difficulty_probabilities[difficulty.casefold(
-    )][get_rate_level_from_decibel(decibel)]
 
-    return np.random.choice([0, 1, 2, 4, 8, 16], p=p)
+def is_ogg_vorbis(song_path):
+    try:
+        info = soundfile.info(song_path)
+    except RuntimeError:
+        return False
+    return info.format == 'OGG' and info.subtype == 'VORBIS'
 
 
-def amplitude_rate_modulation(difficulty, y, sr):
+@span('convert')
+def convert_song(song_path, out_path, sr=22050):
     """
-    This function uses the average amplitude (i.e., 'loudness')
-    of a beat and the difficulty level to determine
-    how many blocks will be placed within the beat.
-    Returns a list of beat numbers.
-    """
-    # Make amplitude matrix
-    D = np.abs(librosa.stft(np.array(y)))
-    decibel = librosa.amplitude_to_db(D, ref=np.max)
-    # Get beat frames and sync with amplitudes
-    tempo, beat_frames = librosa.beat.beat_track(
-        np.array(y), sr, trim=False)
-    beat_decibel = pd.DataFrame(librosa.util.sync(
-        decibel, beat_frames, aggregate=np.mean))
-    # Mean amplitude per beat
-    avg_beat_decibel = beat_decibel.mean()
-    # Choose rates and smooth rate transitions
-    rates = [0]
-    counter = 1
-    while counter < len(avg_beat_decibel)-1:
-        rate = choose_rate(np.mean(
-            [avg_beat_decibel.iloc[counter-1], avg_beat_decibel.iloc[counter], avg_beat_decibel.iloc[counter+1]]), difficulty)
-        diff = np.abs(rate - rates[-1])
-
-        if difficulty.casefold() == 'expert':
-            maxdiff = 4
-        elif difficulty.casefold() == 'expertplus':
-            maxdiff = 8
+    Converts a song to the Ogg Vorbis file played by Beat Saber.
+    Ogg Vorbis songs are copied as they are. Other songs are transcoded by a single ffmpeg run,
+    which also pipes the decoded samples back: they are resampled like load_audio does
+    and put in the feature cache, so that loading the song next doesn't decode it again.
+    """
+    if is_ogg_vorbis(song_path):
+        shutil.copyfile(song_path, out_path)
+        return
+    duration, sr_native, channels = audio_info(song_path)
+    command = [pydub.AudioSegment.converter, '-nostdin', '-v', 'error', '-y', '-i', song_path,
+               '-map', '0:a:0', '-f', 'ogg', out_path,
+               '-map', '0:a:0', '-f', 'f32le', '-acodec', 'pcm_f32le', 'pipe:1']
+    # stderr goes to a file, so that ffmpeg never blocks on a full stderr pipe while stdout is read
+    with tempfile.TemporaryFile() as stderr, \
+            subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr) as process:
+        y = _concatenate_blocks(_resampled_blocks(_pipe_blocks(process.stdout, sr_native, channels), sr),
+                                duration, sr)
+        process.wait()
+        # The last errors are enough, a damaged file can make ffmpeg repeat them many times
+        stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - 4096))
+        error = stderr.read()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to convert {song_path}: {error.decode(errors='replace').strip()}")
+    metrics.inc('beatmap_audio_seconds_total', len(y) / sr)
+    feature_cache.put(_decoded_key(song_path, sr), _freeze((y, sr)))
+
+
+# Batch Mode
+BATCH_AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flv', '.raw', '.ogg', '.egg')
+BATCH_CHECKPOINT = 'batch_checkpoint.jsonl'
+# Read by the BLAS, OpenMP and numba thread pools when a batch worker process starts
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS']
+_batch_thread_limits = None
+
+
+def batch_songs(source):
+    """Song paths of a directory (searched recursively) or of a manifest file listing one path per line."""
+    if os.path.isdir(source):
+        songs = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names
+                 if os.path.splitext(name)[1].casefold() in BATCH_AUDIO_EXTENSIONS]
+    else:
+        # Relative paths in a manifest are relative to the manifest
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            songs = [os.path.join(base, line.strip()) for line in f
+                     if line.strip() and not line.lstrip().startswith('#')]
+    return sorted(os.path.abspath(song) for song in songs)
+
+
+def batch_root(source):
+    """Default batch root of a source: the songs directory, or the directory of the manifest file."""
+    return os.path.abspath(source) if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+
+
+def batch_output_path(song_path, root, out_dir):
+    """
+    Notes file of a song, mirroring its path relative to the batch root.
+    Songs outside of the root mirror their whole path, so that a song always gets the same notes file.
+    """
+    try:
+        relative = os.path.relpath(song_path, root)
+    except ValueError:
+        # On another drive
+        relative = os.pardir
+    if relative.split(os.sep)[0] == os.pardir:
+        drive, path = os.path.splitdrive(song_path)
+        relative = os.path.join(drive.strip('\\/').replace(':', ''), path.lstrip('\\/'))
+    return os.path.join(out_dir, os.path.splitext(relative)[0] + '.json')
+
+
+@contextlib.contextmanager
+def worker_thread_env(threads):
+    """Sizes the thread pools of the worker processes spawned within it, restoring the environment afterwards."""
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    # Spawned workers read these before importing numpy
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def read_checkpoint(checkpoint_path):
+    """Songs mapped successfully by earlier runs writing to the same checkpoint log."""
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted run
+                    continue
+                if entry.get('status') == 'ok':
+                    done.add(entry['song'])
+    return done
+
+
+def _init_batch_worker(threads, store_root=FEATURE_STORE_DIR, store_max_bytes=FEATURE_STORE_MAX_BYTES,
+                       analysis_memory_limit=ANALYSIS_MEMORY_LIMIT):
+    """
+    Pins the thread pools of a batch worker process, so that workers don't oversubscribe the cores,
+    and opens the feature store and applies the analysis memory limit of the parent process.
+    """
+    global _batch_thread_limits, feature_store, ANALYSIS_MEMORY_LIMIT
+    feature_store = FeatureStore(store_root, store_max_bytes)
+    ANALYSIS_MEMORY_LIMIT = analysis_memory_limit
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    _batch_thread_limits = threadpool_limits(threads)
+
+
+def batch_map_song(song_path, out_path, model, difficulties, version, tempDir, convert=False, seed=None):
+    """
+    Maps every difficulty of one song and writes the notes lists to out_path,
+    with convert the song is also converted to an .egg file next to it.
+    With a seed, mapping a song again gives the same notes.
+    Runs in a batch worker process. Returns the seconds taken and the error of each failed difficulty.
+    """
+    start = time.perf_counter()
+    try:
+        if convert:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            # Converting first hands the decoded song to load_song
+            convert_song(song_path, f"{os.path.splitext(out_path)[0]}.egg")
+        y, sr, bpm, beat_times = load_song(song_path)
+        beat_times = beat_times.tolist()
+        result = run_models_parallel(model, tempDir, difficulties, beat_times, bpm, version, y, sr, jobs=1,
+                                     seed=seed)
+    finally:
+        # Batch songs are never revisited
+        feature_cache.clear()
+        notes_cache.clear()
+    song = {'song_path': song_path,
+            'model': model,
+            'version': version,
+            'seed': seed,
+            'bpm': bpm,
+            'beat_times': beat_times,
+            'notes': {difficulty: records_to_list(entry['data']) for difficulty, entry in result['results'].items()
+                      if entry['error'] is None}}
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(f"{out_path}.tmp", 'w') as f:
+        json.dump(song, f)
+    os.replace(f"{out_path}.tmp", out_path)
+    return {'seconds': time.perf_counter() - start,
+            'errors': {difficulty: entry['error'] for difficulty, entry in result['results'].items()
+                       if entry['error'] is not None}}
+
+
+def run_batch(source, out_dir, model, difficulties, version, tempDir, workers=None, threads=1, convert=False,
+              seed=None, root=None):
+    """
+    Maps every song of a directory or manifest file across a pool of worker processes,
+    writing one notes file (and with convert one .egg file) per song to out_dir,
+    at the song's path relative to root (by default see batch_root).
+    Every finished song is appended to a checkpoint log in out_dir,
+    songs already mapped successfully are skipped when a run is resumed.
+    """
+    songs = batch_songs(source)
+    root = os.path.abspath(root) if root is not None else batch_root(source)
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint_path = os.path.join(out_dir, BATCH_CHECKPOINT)
+    done = read_checkpoint(checkpoint_path)
+    todo = [song for song in songs if song not in done]
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    _print(f"Batch: {len(songs)} songs, {len(songs) - len(todo)} already mapped, {workers} workers")
+    summary = {'songs': len(songs), 'skipped': len(songs) - len(todo), 'mapped': 0, 'failed': 0}
+    with open(checkpoint_path, 'a') as checkpoint, worker_thread_env(threads), \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_batch_worker,
+                                initargs=(threads, feature_store.root, feature_store.max_bytes,
+                                          ANALYSIS_MEMORY_LIMIT)) as executor:
+        futures = {executor.submit(batch_map_song, song, batch_output_path(song, root, out_dir),
+                                   model, difficulties, version, tempDir, convert, seed): song
+                   for song in todo}
+        for future in as_completed(futures):
+            song = futures[future]
+            entry = {'song': song}
+            try:
+                result = future.result()
+                entry.update(result, status='error' if result['errors'] else 'ok')
+            except Exception as e:
+                _print_exception(traceback.format_exc(), f"Failed to map song: {song}")
+                entry.update(status='error', error=f"{type(e).__name__}: {e}")
+            checkpoint.write(json.dumps(entry) + '\n')
+            checkpoint.flush()
+            summary['mapped' if entry['status'] == 'ok' else 'failed'] += 1
+            _print(f"[{summary['mapped'] + summary['failed']}/{len(todo)}] {entry['status']}: {song}")
+    return summary
+
+
+def warm_song(song_path):
+    """
+    Stores the analysis used by every model of one song in the feature store.
+    Runs in a batch worker process. Returns the seconds taken.
+    """
+    start = time.perf_counter()
+    try:
+        y, sr, bpm, beat_times = load_song(song_path)
+        analyse_song('rate_modulated_segmented_HMM', y, sr)
+        feature_store.mark_source(song_path, audio_hash(y, sr))
+    finally:
+        feature_cache.clear()
+    return time.perf_counter() - start
+
+
+def run_warm(source, workers=None, threads=1):
+    """
+    Fills the feature store with the analysis of every song of a directory or manifest file,
+    so that later mapping runs skip it. Songs whose analysis is already stored are skipped.
+    """
+    if feature_store.root is None:
+        raise ValueError('The feature store is disabled')
+    songs = batch_songs(source)
+    todo = [song for song in songs if not feature_store.has_source(song)]
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    _print(f"Warm: {len(songs)} songs, {len(songs) - len(todo)} already stored, {workers} workers")
+    summary = {'songs': len(songs), 'skipped': len(songs) - len(todo), 'warmed': 0, 'failed': 0}
+    with worker_thread_env(threads), \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_batch_worker,
+                                initargs=(threads, feature_store.root, feature_store.max_bytes,
+                                          ANALYSIS_MEMORY_LIMIT)) as executor:
+        futures = {executor.submit(warm_song, song): song for song in todo}
+        for future in as_completed(futures):
+            song = futures[future]
+            try:
+                future.result()
+                status = 'ok'
+                summary['warmed'] += 1
+            except Exception:
+                _print_exception(traceback.format_exc(), f"Failed to analyse song: {song}")
+                status = 'error'
+                summary['failed'] += 1
+            _print(f"[{summary['warmed'] + summary['failed']}/{len(todo)}] {status}: {song}")
+    return summary
+
+
+# Async Jobs
+# Percent complete of a job when it enters each stage, the walk then advances with every finished difficulty
+JOB_STAGES = {'queued': 0, 'decode': 0, 'beat track': 10, 'cqt': 20, 'segmentation': 40,
+              'walk': 60, 'validation': 60, 'done': 100}
+# Seconds the status and result of a finished job are kept
+JOB_RESULT_TTL = 600
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A model run submitted to /jobs. The pipeline reports its stage through job_progress,
+    which is also where a cancelled job stops.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.percent = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.cancel_requested = threading.Event()
+        self._lock = threading.Lock()
+
+    def progress(self, stage=None, percent=None):
+        if self.cancel_requested.is_set():
+            raise JobCancelled()
+        with self._lock:
+            if stage is not None:
+                self.stage = stage
+                percent = max(percent or 0, JOB_STAGES[stage])
+            if percent is not None:
+                self.percent = max(self.percent, percent)
+
+    def run(self, fn, *args):
+        """Runs fn as the work of the job, recording its result, error or cancellation."""
+        self._finish_if_cancelled()
+        if self.status == 'cancelled':
+            return
+        self.status = 'running'
+        self.started = time.time()
+        token = current_job.set(self)
+        try:
+            result = fn(*args)
+            with self._lock:
+                self.result = result
+                self.stage = 'done'
+                self.percent = 100
+                self.status = 'done'
+        except JobCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            _print_exception(traceback.format_exc(), f"Job {self.id} failed")
+            self.error = f"{type(e).__name__}: {e}"
+            self.status = 'failed'
+        finally:
+            current_job.reset(token)
+            self.finished = time.time()
+
+    def cancel(self):
+        self.cancel_requested.set()
+        # A job still waiting for a worker never starts
+        if self.future is not None and self.future.cancel():
+            self._finish_if_cancelled()
+
+    def _finish_if_cancelled(self):
+        with self._lock:
+            if self.cancel_requested.is_set() and self.status == 'queued':
+                self.status = 'cancelled'
+                self.finished = time.time()
+
+    def to_json(self):
+        with self._lock:
+            return {'id': self.id,
+                    'status': self.status,
+                    'stage': self.stage,
+                    'percent': round(self.percent, 1),
+                    'error': self.error,
+                    'created': self.created,
+                    'started': self.started,
+                    'finished': self.finished}
+
+
+class JobStore:
+    """Jobs by id. Finished jobs are dropped ttl seconds after they finish."""
+
+    def __init__(self, ttl=JOB_RESULT_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, executor, fn, *args):
+        """Queues fn as a new job on the executor, raises ExecutorFull if it is full."""
+        job = Job()
+        job.future = executor.submit(job.run, fn, *args)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def _purge(self):
+        expired = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and job.finished < expired]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            self._purge()
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ['queued', 'running', 'done', 'failed', 'cancelled']}
+
+
+job_store = JobStore()
+
+
+def job_progress(stage=None, percent=None):
+    """
+    Reports the stage and/or percent complete of the job running on this thread, if any.
+    Raises JobCancelled once the job has been cancelled.
+    """
+    job = current_job.get()
+    if job is not None:
+        job.progress(stage, percent)
+
+
+def map_song_job(data, song):
+    """
+    Work of a job submitted to /jobs: maps the requested difficulties of a song,
+    decoding it and tracking its beats first if it is given by 'song_path'.
+    """
+    if song is None:
+        y, sr, bpm, beat_times = load_song(data['song_path'])
+        beat_times = beat_times.tolist()
+    else:
+        y, sr = song
+        bpm, beat_times = data['bpm'], data['beat_times']
+    difficulties = data.get('difficulties') or [data['difficulty']]
+    result = run_models_parallel(data['model'], data['tempDir'], difficulties, beat_times, bpm, data['version'],
+                                 y, sr, jobs=data.get('jobs', RUN_MODELS_JOBS), seed=data.get('seed'),
+                                 level=data.get('level'))
+    return {**result, 'bpm': bpm, 'beat_times': beat_times}
+
+
+# Serving
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+# Threads running the CPU-bound requests and how many more requests may wait for one
+SERVER_WORKERS = 2
+SERVER_MAX_QUEUED = 8
+# Seconds a client is asked to wait before retrying a request rejected with 503
+RETRY_AFTER_SECONDS = 5
+# Seconds given to in-flight requests to finish on shutdown
+SHUTDOWN_TIMEOUT = 60
+# Note formats of the model responses, negotiated with the Accept header. By default notes (and events,
+# obstacles) are JSON dictionaries, they can also be JSON or msgpack (if installed) parallel lists per field,
+# or packed binary records (see pack_level_payload)
+NOTES_JSON = 'application/json'
+NOTES_COLUMNS = 'application/vnd.beatmapsynth.columns+json'
+NOTES_BINARY = 'application/vnd.beatmapsynth.notes'
+NOTES_MSGPACK = 'application/msgpack'
+NOTE_FORMATS = [NOTES_JSON, NOTES_COLUMNS, NOTES_BINARY] + (
+    [NOTES_MSGPACK] if importlib.util.find_spec('msgpack') is not None else [])
+# Requests sent with this header ('cprofile' or 'pyinstrument') are profiled,
+# the response's X-Profile-Path header tells where the profile was written
+PROFILE_HEADER = 'X-Profile'
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'beatMapSynth_profiles')
+
+
+class ExecutorFull(Exception):
+    pass
+
+
+class _QueuedResult(AsyncResult):
+    """Result of a request submitted to a cooperative BoundedExecutor, it can be cancelled until it starts."""
+
+    def __init__(self, executor):
+        super().__init__()
+        self._executor = executor
+        self._cancelled = False
+
+    def cancel(self):
+        return self._executor._cancel(self)
+
+    def cancelled(self):
+        return self._cancelled
+
+
+class BoundedExecutor:
+    """
+    Runs CPU-bound requests on a fixed number of worker threads,
+    so the server keeps answering light requests (e.g. /ping) while models run.
+    At most max_queued requests wait for a free worker, beyond that submit raises ExecutorFull.
+    Cooperative executors wait on their jobs without blocking the gevent server, they queue the waiting
+    requests themselves since gevent's thread pool blocks the submitting greenlet once its workers are busy.
+    The lock is never held across a greenlet switch, so the hub can take it.
+    """
+
+    def __init__(self, workers=SERVER_WORKERS, max_queued=SERVER_MAX_QUEUED, cooperative=False):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.cooperative = cooperative
+        self.accepting = True
+        self.rejected = 0
+        if cooperative:
+            self._pool = CooperativeThreadPool(workers)
         else:
-            maxdiff = 2
-
-        while diff > maxdiff:
-            rate = choose_rate(np.mean(
-                [avg_beat_decibel.iloc[counter-1], avg_beat_decibel.iloc[counter], avg_beat_decibel.iloc[counter+1]]), difficulty)
-            diff = rates[-1] - rate
-        if rate == 4 and rates[-1] == 4:
-            rate = np.random.choice([0, 1, 2])
-        rates.append(rate)
-        counter += 1
-    # Make list of beat numbers based on rates
-    beat_num_list = []
-    for ind, val in enumerate(rates):
-        if val == 0:
-            continue
-        elif val == 1:
-            beat_num_list.append(ind)
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request')
+        # Accepted requests, counted as soon as their slot is reserved
+        self._pending = 0
+        self._futures = set()
+        # Requests waiting for a worker of a cooperative executor, and the number running
+        self._queue = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on a worker, or queues it while they are all busy. Never blocks."""
+        with self._lock:
+            if not self.accepting or self._pending >= self.workers + self.max_queued:
+                self.rejected += 1
+                raise ExecutorFull()
+            self._pending += 1
+            if self.cooperative:
+                future = _QueuedResult(self)
+                self._futures.add(future)
+                self._queue.append((future, fn, args, kwargs))
+        if self.cooperative:
+            self._dispatch()
+            return future
+        future = self._pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self._futures.discard(future)
+
+    def _dispatch(self):
+        """Starts the queued requests of a cooperative executor on its free workers."""
+        while True:
+            with self._lock:
+                if self._running >= self.workers or not self._queue:
+                    return
+                item = self._queue.popleft()
+                self._running += 1
+            gevent.spawn(self._run, *item)
+
+    def _run(self, future, fn, args, kwargs):
+        try:
+            future.set_result(self._pool.spawn(fn, *args, **kwargs).get())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._running -= 1
+            self._done(future)
+            self._dispatch()
+
+    def _cancel(self, future):
+        """Drops a request still waiting in the queue of a cooperative executor. Returns whether it was dropped."""
+        with self._lock:
+            for i, (queued, _, _, _) in enumerate(self._queue):
+                if queued is future:
+                    del self._queue[i]
+                    break
+            else:
+                return False
+        self._done(future)
+        future._cancelled = True
+        future.set_exception(concurrent.futures.CancelledError())
+        return True
+
+    def drain(self, timeout=None):
+        """Stops accepting requests and waits for the accepted ones. Returns whether they all finished."""
+        with self._lock:
+            self.accepting = False
+            futures = list(self._futures)
+        if self.cooperative:
+            done = gevent.wait(futures, timeout=timeout)
+            self._pool.kill()
         else:
-            num_list = [ind, ind+1]
-            for x in range(1, val):
-                num_list.append(ind+(x/val))
-            for y in num_list:
-                beat_num_list.append(y)
-    beat_num_list = list(set(beat_num_list))
-    beat_num_list.sort()
-    return beat_num_list
+            done = concurrent.futures.wait(futures, timeout=timeout).done
+            self._pool.shutdown(wait=False)
+        return len(done) == len(futures)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers,
+                    'pending': self._pending,
+                    'max_queued': self.max_queued,
+                    'rejected': self.rejected,
+                    'accepting': self.accepting}
+
+
+request_executor = BoundedExecutor()
+
+
+def notes_response(data):
+    """Responds with data, its level record arrays encoded in the note format asked for by the Accept header."""
+    mimetype = request.accept_mimetypes.best_match(NOTE_FORMATS, default=NOTES_JSON)
+    if mimetype == NOTES_BINARY:
+        return pack_level_payload(data), 200, {'Content-Type': NOTES_BINARY}
+    if mimetype == NOTES_MSGPACK:
+        import msgpack
+        return msgpack.packb({'data': map_records(data, records_to_columns)}), 200, {'Content-Type': NOTES_MSGPACK}
+    if mimetype == NOTES_COLUMNS:
+        response = jsonify(data=map_records(data, records_to_columns))
+        response.mimetype = NOTES_COLUMNS
+        return response
+    return jsonify(data=map_records(data, records_to_list))
+
+
+def _invalid_seed(data):
+    """Normalizes the 'seed' of a request in place, returns the 400 response if it isn't an integer."""
+    try:
+        data['seed'] = normalize_seed(data.get('seed'))
+    except ValueError as e:
+        return jsonify(error='INVALID SEED', message=str(e)), 400
+    return None
 
 
-def segments_to_data_frame_rate_modulated(segments, modulated_beat_list):
+def _busy():
+    return (jsonify(error='BUSY', retry_after=RETRY_AFTER_SECONDS), 503,
+            {'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+
+def profiled(fn, profiler, name):
     """
-    This function returns a DataFrame of the number of blocks needed for each song segment.
+    Wraps fn to run under cProfile, or pyinstrument if asked for and installed,
+    the wrapper returns the result of fn and the path of the profile written to PROFILE_DIR.
+    Only the calling thread is profiled, not the threads it hands work to.
     """
-    expanded_beat_list = []
-    for x in segments:
-        for y in modulated_beat_list:
-            if y > x[1][0] and y <= x[1][1]:
-                expanded_beat_list.append({'_time': y, 'segment': x[2]})
-    df = pd.DataFrame([], columns=['length', 'seg_no'])
-    counter = 0
-    first = None
-    last = None
-    while counter < len(expanded_beat_list):
-        if counter == 0:
-            first = counter
-            counter += 1
-        elif expanded_beat_list[counter]['segment'] != expanded_beat_list[counter-1]['segment']:
-            first = counter
-            counter += 1
-        elif expanded_beat_list[counter] == expanded_beat_list[-1]:
-            length = len(expanded_beat_list[first: -1])
-            df = df.append(pd.DataFrame(
-                {'length': length, 'seg_no': expanded_beat_list[-1]['segment']}, index=[0]))
-            break
-        elif expanded_beat_list[counter]['segment'] == expanded_beat_list[counter+1]['segment']:
-            counter += 1
-        elif expanded_beat_list[counter]['segment'] != expanded_beat_list[counter+1]['segment']:
-            last = counter
-            length = len(expanded_beat_list[first: last+1])
-            df = df.append(pd.DataFrame(
-                {'length': length, 'seg_no': expanded_beat_list[counter]['segment']}, index=[0]))
-            counter += 1
-    return df
+    if profiler == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            _print('pyinstrument is not installed, profiling with cProfile')
+            profiler = 'cprofile'
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+        if profiler == 'pyinstrument':
+            profile = pyinstrument.Profiler()
+            profile.start()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                profile.stop()
+                path += '.html'
+                with open(path, 'w') as f:
+                    f.write(profile.output_html())
+        else:
+            profile = cProfile.Profile()
+            try:
+                result = profile.runcall(fn, *args, **kwargs)
+            finally:
+                path += '.prof'
+                profile.dump_stats(path)
+        _print(f"Profile of {name} written to {path}")
+        return result, path
+    return wrapper
 
 
-def rate_modulated_segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr):
+def offloaded(view):
     """
-    Function to write the notes to a list after predicting with
-    the rate modulated segmented HMM model.
+    Runs a CPU-bound view on the request executor, answering 503 when it is full.
+    Requests sent with the PROFILE_HEADER are profiled.
     """
-    MC = load_hmm_model(tempDir, difficulty, version)
-    (segments, beat_times, tempo) = laplacian_segmentation(y, sr)
-    modulated_beat_list = amplitude_rate_modulation(difficulty, y, sr)
-    segments_df = segments_to_data_frame_rate_modulated(
-        segments, modulated_beat_list)
-    preds = segment_predictions(segments_df, MC)
-    # Combine beat numbers with HMM walk steps
-    beat_times = [(x/60) * tempo for x in beat_times]
-    beat_count = list(range(len(beat_times)))
-    beats = pd.concat([pd.Series(beat_times, name='_time'),
-                       pd.Series(beat_count, name='beat_count')],
-                      axis=1)
-    for index, value in beats.iterrows():
-        if value['beat_count'] not in modulated_beat_list:
-            beats.drop(index=index, inplace=True)
-    leftDF = beats.astype('float64')
-    rightDF = pd.Series(modulated_beat_list,
-                        name='beat_count').astype('float64')
-    merged_beats = pd.merge(
-        left=leftDF, right=rightDF, how='outer', on='beat_count', sort=True)
-    merged_beats.interpolate(inplace=True)
-    merged_beats.drop(columns='beat_count', inplace=True)
-
-    df_preds = pd.concat([merged_beats, preds], axis=1, sort=True)
-    df_preds.dropna(axis=0, inplace=True)
-    # Write notes dictionaries
-    return write_notes_hmm(df_preds, bpm)
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Read the body on the server's thread, the gevent socket can't be read from a worker
+        request.get_data()
+        profiler = request.headers.get(PROFILE_HEADER)
+        run = copy_current_request_context(view)
+        if profiler:
+            run = profiled(run, profiler.casefold(), view.__name__)
+        start = time.perf_counter()
+        try:
+            future = request_executor.submit(run, *args, **kwargs)
+        except ExecutorFull:
+            return _busy()
+        try:
+            response = future.result()
+        finally:
+            metrics.observe('beatmap_request_seconds', time.perf_counter() - start, endpoint=view.__name__)
+        if profiler:
+            response, path = response
+            response = make_response(response)
+            response.headers['X-Profile-Path'] = path
+        return response
+    return wrapper
+
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
+    """Stops accepting model runs, lets the running ones finish and stops the server."""
+    if not request_executor.drain(timeout):
+        _print('Shutting down with requests still running')
+    if http_server is not None:
+        http_server.stop(timeout)
+    if dev_server is not None:
+        dev_server.shutdown()
+
+
+# Startup phases reported by /ping: the server answers requests from 'starting' on,
+# they only run faster once it is 'ready'
+server_phase = 'starting'
+
+
+def _warm_up_analysis():
+    """Runs the analysis once on a short click track, paying for its first-call costs (JIT, filter loading)."""
+    sr = 22050
+    y = np.zeros(4 * 2 * sr, dtype=np.float32)
+    y[::sr // 2] = 1.0
+    librosa.resample(y, orig_sr=2 * sr, target_sr=sr, res_type='kaiser_best')
+    y = y[:4 * sr]
+    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+    librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+    librosa.feature.mfcc(y=y, sr=sr)
+    sklearn.cluster.KMeans(n_clusters=2, n_init=1).fit(np.random.default_rng(0).random((16, 2)))
+
+
+def warm_up(tempDir=None, preload_versions=()):
+    """
+    Imports the lazily imported libraries, warms the analysis up and preloads models,
+    in the background once the server is up. Logs where the startup time went.
+    """
+    global server_phase
+    try:
+        server_phase = 'importing'
+        for module in LAZY_MODULES:
+            module._lazy_load()
+        server_phase = 'warming up'
+        start = time.perf_counter()
+        _warm_up_analysis()
+        startup_times['warm up'] = time.perf_counter() - start
+        if preload_versions:
+            server_phase = 'loading models'
+            start = time.perf_counter()
+            model_registry.preload(tempDir, preload_versions)
+            startup_times['load models'] = time.perf_counter() - start
+    except Exception:
+        _print_exception(traceback.format_exc(), 'Warm up failed, libraries are imported on first use')
+    server_phase = 'ready'
+    startup_times['ready'] = time.perf_counter() - _module_start
+    _print('Startup: ' + ', '.join(f"{name} {seconds:.2f}s" for name, seconds in startup_times.items()))
 
 
 app = Flask(__name__)
+# The gevent server, or with --dev the werkzeug development server
 http_server = None
+dev_server = None
 
 
 @app.route('/ping', methods=['GET'])
 def ping():
-    return 'OK', 200
+    """Reports the startup phase of the server."""
+    return jsonify(data={'phase': server_phase, 'ready': server_phase == 'ready'})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Reports cache and model statistics of the server."""
+    return jsonify(data={'startup': startup_times,
+                         'feature_cache': feature_cache.stats(),
+                         'feature_store': feature_store.stats(),
+                         'notes_cache': notes_cache.stats(),
+                         'models': model_registry.stats(),
+                         'executor': request_executor.stats(),
+                         'jobs': job_store.stats()})
+
+
+def stats_metrics():
+    """The /stats counters and gauges as (name, type, help, [(labels, value)]) metrics."""
+    cache = feature_cache.stats()
+    store = feature_store.stats()
+    notes = notes_cache.stats()
+    executor = request_executor.stats()
+    models = model_registry.stats()
+    jobs = job_store.stats()
+    model_labels = [(('difficulty', model['difficulty']), ('version', model['version'])) for model in models]
+    return [
+        ('beatmap_feature_cache_hits_total', 'counter', 'Feature cache hits', [((), cache['hits'])]),
+        ('beatmap_feature_cache_misses_total', 'counter', 'Feature cache misses', [((), cache['misses'])]),
+        ('beatmap_feature_cache_evictions_total', 'counter', 'Feature cache evictions', [((), cache['evictions'])]),
+        ('beatmap_feature_cache_bytes', 'gauge', 'Bytes held by the feature cache', [((), cache['bytes'])]),
+        ('beatmap_feature_store_hits_total', 'counter', 'Feature store hits', [((), store['hits'])]),
+        ('beatmap_feature_store_misses_total', 'counter', 'Feature store misses', [((), store['misses'])]),
+        ('beatmap_feature_store_evictions_total', 'counter', 'Feature store evictions', [((), store['evictions'])]),
+        ('beatmap_notes_cache_hits_total', 'counter', 'Seeded model runs answered from the notes cache',
+         [((), notes['hits'])]),
+        ('beatmap_notes_cache_misses_total', 'counter', 'Seeded model runs missing from the notes cache',
+         [((), notes['misses'])]),
+        ('beatmap_model_loads_total', 'counter', 'HMM model loads',
+         [(labels, model['loads']) for labels, model in zip(model_labels, models)]),
+        ('beatmap_model_hits_total', 'counter', 'HMM model registry hits',
+         [(labels, model['hits']) for labels, model in zip(model_labels, models)]),
+        ('beatmap_requests_pending', 'gauge', 'Model requests running or waiting for a worker',
+         [((), executor['pending'])]),
+        ('beatmap_requests_rejected_total', 'counter', 'Model requests rejected with 503',
+         [((), executor['rejected'])]),
+        ('beatmap_jobs', 'gauge', 'Kept jobs by status', [((('status', status),), count)
+                                                        for status, count in jobs.items()]),
+        ('beatmap_ready', 'gauge', 'Whether the server has finished warming up',
+         [((), int(server_phase == 'ready'))]),
+    ]
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Reports the pipeline metrics and the /stats counters in the Prometheus text format."""
+    return metrics.render(stats_metrics()), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 @app.route('/close', methods=['GET'])
 def close():
+    """Shuts the server down once the running requests have finished."""
     if http_server is not None:
-        http_server.close()
+        gevent.spawn(shutdown)
+    elif dev_server is not None:
+        # The development server only stops once this request has been answered
+        threading.Thread(target=shutdown, daemon=True).start()
+    else:
+        return 'NOT SERVING', 503
     return 'OK', 200
 
 
 @app.route('/get_beat_features', methods=['POST'])
+@offloaded
 def get_beat_features():
-    """Takes in the song stored at 'song_path' and estimates the bpm and beat times."""
+    """
+    Takes in the song stored at 'song_path' and estimates the bpm and beat times.
+    The decoded song is kept server-side and referenced by the returned 'song_id'.
+    The raw waveform is only returned if 'y_format' ('base64' or 'npy') is requested.
+    """
     data = request.get_json()
     song_path = data['song_path']
     if song_path is not None:
-        # Load song and split into harmonic and percussive parts.
-        y, sr = librosa.load(song_path)
-        # y_harmonic, y_percussive = librosa.effects.hpss(y)
-        # Isolate beats and beat times
-        bpm, beat_frames = librosa.beat.beat_track(y=y, sr=sr, trim=False)
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
-        return jsonify(data={
+        # Load song and isolate beats and beat times
+        y, sr, bpm, beat_times = load_song(song_path)
+        song_id = song_store.put(y, sr)
+        features = {
             'bpm': bpm,
             'beat_times': beat_times.tolist(),
-            'y': y.tolist(),
+            'song_id': song_id,
             'sr': sr
-        })
+        }
+        y_format = data.get('y_format')
+        if y_format:
+            features['y'] = encode_waveform(y, y_format, song_id)
+            features['y_format'] = y_format
+        return jsonify(data=features)
     return 'ERROR', 500
 
 
+@app.route('/release_song', methods=['POST'])
+def release_song():
+    """Drops a song from the song store once a client is done with it."""
+    data = request.get_json()
+    if song_store.release(data['song_id']):
+        return 'OK', 200
+    return 'NOT FOUND', 404
+
+
+@app.route('/segment_song', methods=['POST'])
+@offloaded
+def segment_song():
+    """
+    Runs the Laplacian segmentation of a song ahead of the segmented models,
+    so that every difficulty reuses the same cached segmentation.
+    It uses the segmentation settings of the models, the cached result is not reused otherwise.
+    """
+    data = request.get_json()
+    song = resolve_song(data)
+    if song is None:
+        return 'UNKNOWN SONG', 404
+    y, sr = song
+    (segments, beat_times, tempo) = laplacian_segmentation(y, sr)
+    return jsonify(data=segments_to_json(segments, beat_times, tempo))
+
+
 @app.route('/run_model', methods=['POST'])
+@offloaded
 def run_model():
     """Refractored model runner to allow for only a single mapping function"""
     data = request.get_json()
@@ -866,51 +3238,111 @@ def run_model():
     beat_times = data['beat_times']
     bpm = data['bpm']
     version = data['version']
-    y = data['y']
-    sr = data['sr']
     tempDir = data['tempDir']
-    if model == 'random':
-        """
-        Function to generate a completely random map (i.e. baseline model) for a song.
-        This is completely random and is likely not enjoyable if even playable!
-        """
-        return jsonify(data=random_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr))
-    elif model == 'HMM':
-        """
-        This function generates a custom map based on a Hidden Markov Model.
-        """
-        return jsonify(data=hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr))
-    elif model == 'segmented_HMM':
-        """
-        This function generates a custom map based on a
-        HMM model that operates on song segments.
-        First, Laplacian song segmentation is performed
-        to identify similar portions of songs.
-        Then, a HMM is used to generate a block sequence through
-        the first of each of these identified song segments.
-        If that segment is repeated later in the song,
-        the block sequence will be repeated.
-        """
-        return jsonify(data=segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr))
-    elif model == 'rate_modulated_segmented_HMM':
-        """
-        This function generates the files for a custom map using a
-        rate modulated segmented HMM model.
-        """
-        return jsonify(data=rate_modulated_segmented_hmm_notes_writer(tempDir, difficulty, beat_times, bpm, version, y, sr))
-    return 'ERROR', 500
+    song = resolve_song(data)
+    if song is None:
+        return 'UNKNOWN SONG', 404
+    y, sr = song
+    if model not in MODEL_WRITERS:
+        return 'ERROR', 500
+    invalid = _invalid_seed(data)
+    if invalid is not None:
+        return invalid
+    if data.get('level') is not None:
+        return notes_response(write_level(model, tempDir, difficulty, beat_times, bpm, version, y, sr, data.get('seed'),
+                                          **level_options(data['level'])))
+    return notes_response(write_notes(model, tempDir, difficulty, beat_times, bpm, version, y, sr, data.get('seed')))
+
+
+@app.route('/run_models', methods=['POST'])
+@offloaded
+def run_models():
+    """
+    Maps every difficulty in 'difficulties' of one song with a single model.
+    A failing difficulty reports its error without failing the others.
+    """
+    data = request.get_json()
+    model = data['model']
+    if model not in MODEL_WRITERS:
+        return 'ERROR', 500
+    song = resolve_song(data)
+    if song is None:
+        return 'UNKNOWN SONG', 404
+    y, sr = song
+    invalid = _invalid_seed(data)
+    if invalid is not None:
+        return invalid
+    return notes_response(run_models_parallel(
+        model, data['tempDir'], data['difficulties'], data['beat_times'], data['bpm'], data['version'], y, sr,
+        jobs=data.get('jobs', RUN_MODELS_JOBS), seed=data.get('seed'), level=data.get('level')))
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues a model run and returns its job right away, poll /jobs/<id> for its progress.
+    Takes the /run_models arguments ('difficulty' also works for a single difficulty),
+    the song is either a stored 'song_id' or a 'song_path' decoded by the job.
+    """
+    data = request.get_json()
+    if data.get('model') not in MODEL_WRITERS:
+        return 'ERROR', 500
+    invalid = _invalid_seed(data)
+    if invalid is not None:
+        return invalid
+    song = None
+    if data.get('song_path') is None:
+        song = resolve_song(data)
+        if song is None:
+            return 'UNKNOWN SONG', 404
+    try:
+        job = job_store.submit(request_executor, map_song_job, data, song)
+    except ExecutorFull:
+        return _busy()
+    return jsonify(data=job.to_json()), 202, {'Location': f"/jobs/{job.id}"}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Reports the status, stage and percent complete of a job."""
+    job = job_store.get(job_id)
+    if job is None:
+        return 'UNKNOWN JOB', 404
+    return jsonify(data=job.to_json())
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Returns the result of a finished job, or its status with 202 while it runs."""
+    job = job_store.get(job_id)
+    if job is None:
+        return 'UNKNOWN JOB', 404
+    if job.status == 'done':
+        return notes_response(job.result)
+    if job.status in ('queued', 'running'):
+        return jsonify(data=job.to_json()), 202
+    return jsonify(data=job.to_json()), 409
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancels a job, a running job stops at its next stage."""
+    job = job_store.get(job_id)
+    if job is None:
+        return 'UNKNOWN JOB', 404
+    job.cancel()
+    return jsonify(data=job.to_json())
 
 
 @app.route('/convert_music_file', methods=['POST'])
+@offloaded
 def convert_music_file():
     """Converts audio file from supported type to EGG"""
     data = request.get_json()
     song_path = data['song_path']
     workingDir = data['workingDir']
-    song_ext = os.path.splitext(song_path)[1][1:]
     try:
-        AudioSegment.from_file(song_path, format=song_ext).export(
-            f"{workingDir}/song.egg", format='ogg')
+        convert_song(song_path, f"{workingDir}/song.egg")
         return 'OK', 200
     except Exception:
         _print_exception(traceback.format_exc())
@@ -918,6 +3350,72 @@ def convert_music_file():
 
 
 if __name__ == "__main__":
-    app.run(port=5000)
-    # http_server = WSGIServer(('127.0.0.1', 5000), app)
-    # http_server.serve_forever()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Beat map synthesizer server')
+    parser.add_argument('--preload-models', type=int, nargs='+', default=[], metavar='VERSION',
+                        help='load the HMM models of these versions at startup')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help='threads running the model requests')
+    parser.add_argument('--max-queued', type=int, default=SERVER_MAX_QUEUED,
+                        help='requests waiting for a worker before new ones are rejected with 503')
+    parser.add_argument('--dev', action='store_true', help="use Flask's development server")
+    parser.add_argument('--feature-store', default=FEATURE_STORE_DIR, metavar='DIR',
+                        help='directory of the on-disk feature store')
+    parser.add_argument('--feature-store-max-mb', type=int, default=FEATURE_STORE_MAX_BYTES // 2**20)
+    parser.add_argument('--no-feature-store', action='store_true', help='only cache features in memory')
+    parser.add_argument('--analysis-memory-mb', type=int, default=ANALYSIS_MEMORY_LIMIT // 2**20,
+                        help='peak memory of the analysis of a song, longer songs are analysed block by block')
+    subparsers = parser.add_subparsers(dest='command')
+    batch = subparsers.add_parser('batch', help='map every song of a directory or manifest file')
+    batch.add_argument('source', help='directory of songs or manifest file listing one song path per line')
+    batch.add_argument('out_dir', help='directory of the notes files and checkpoint log')
+    batch.add_argument('--model', choices=list(MODEL_WRITERS), default='rate_modulated_segmented_HMM')
+    batch.add_argument('--difficulties', nargs='+', default=['easy', 'normal', 'hard', 'expert', 'expertplus'])
+    batch.add_argument('--version', type=int, default=1)
+    batch.add_argument('--models-dir', default=script_dir, help='directory holding the models folder')
+    batch.add_argument('--workers', type=int, help='worker processes, defaults to the cores / threads')
+    batch.add_argument('--threads', type=int, default=1, help='BLAS and OpenMP threads per worker')
+    batch.add_argument('--convert', action='store_true', help='also convert every song to an .egg file')
+    batch.add_argument('--seed', type=int, help='map every song the same way on every run')
+    batch.add_argument('--root', help='directory the notes file paths mirror the songs from, '
+                                      'defaults to the songs directory or the directory of the manifest')
+    warm = subparsers.add_parser('warm', help='store the analysis of every song of a directory or manifest file')
+    warm.add_argument('source', help='directory of songs or manifest file listing one song path per line')
+    warm.add_argument('--workers', type=int, help='worker processes, defaults to the cores / threads')
+    warm.add_argument('--threads', type=int, default=1, help='BLAS and OpenMP threads per worker')
+    args = parser.parse_args()
+    feature_store = FeatureStore(None if args.no_feature_store else args.feature_store,
+                                 args.feature_store_max_mb * 2**20)
+    ANALYSIS_MEMORY_LIMIT = args.analysis_memory_mb * 2**20
+    if args.command == 'warm':
+        summary = run_warm(args.source, args.workers, args.threads)
+        _print(json.dumps(summary))
+        sys.exit(1 if summary['failed'] else 0)
+    if args.command == 'batch':
+        summary = run_batch(args.source, args.out_dir, args.model, args.difficulties, args.version,
+                            args.models_dir, args.workers, args.threads, args.convert, args.seed, args.root)
+        _print(json.dumps(summary))
+        sys.exit(1 if summary['failed'] else 0)
+    warm_up_thread = threading.Thread(target=warm_up, args=(script_dir, args.preload_models), daemon=True)
+    if args.dev:
+        request_executor = BoundedExecutor(args.workers, args.max_queued)
+        dev_server = make_server(args.host, args.port, app, threaded=True)
+        startup_times['listening'] = time.perf_counter() - _module_start
+        # The client waits for this line before sending requests
+        _print(f"Running on http://{args.host}:{args.port}/")
+        warm_up_thread.start()
+        dev_server.serve_forever()
+    else:
+        request_executor = BoundedExecutor(args.workers, args.max_queued, cooperative=True)
+        http_server = WSGIServer((args.host, args.port), app)
+        http_server.start()
+        startup_times['listening'] = time.perf_counter() - _module_start
+        if sys.platform != 'win32':
+            for signum in [signal.SIGINT, signal.SIGTERM]:
+                gevent.signal_handler(signum, gevent.spawn, shutdown)
+        # The client waits for this line before sending requests
+        _print(f"Running on http://{args.host}:{args.port}/")
+        warm_up_thread.start()
+        http_server.serve_forever()
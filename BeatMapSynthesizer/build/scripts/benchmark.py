@@ -0,0 +1,574 @@
+"""
+Benchmarks for the beat map synthesizer server.
+Run from this directory, e.g.: python benchmark.py laplacian
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import markovify
+import numpy as np
+import scipy.linalg
+import soundfile
+
+import beatMapSynthServer as server
+
+# Benchmarks time the analysis itself, not reading it back from disk
+server.feature_store = server.FeatureStore(None)
+
+
+def _print_rows(rows):
+    if not rows:
+        return
+    # Nested results only go to the JSON file
+    columns = [column for column, value in rows[0].items() if not isinstance(value, (dict, list))]
+    server._print('  '.join(f"{column:>14}" for column in columns))
+    for row in rows:
+        server._print('  '.join(
+            f"{row[column]:>14.4f}" if isinstance(row[column], float) else f"{row[column]:>14}"
+            for column in columns))
+
+
+def synthetic_beat_features(n_beats, n_sections=4, section_length=32, seed=0):
+    """
+    Beat-synchronous CQT and MFCC like features of a song
+    made of a few sections that repeat in a random order.
+    """
+    rng = np.random.default_rng(seed)
+    c_templates = rng.normal(size=(n_sections, 252, section_length))
+    m_templates = rng.normal(size=(n_sections, 20, section_length))
+    order = rng.integers(0, n_sections, size=int(np.ceil(n_beats / section_length)))
+    Csync = np.concatenate([c_templates[i] for i in order], axis=1)[:, :n_beats]
+    Msync = np.concatenate([m_templates[i] for i in order], axis=1)[:, :n_beats]
+    Csync += 0.1 * rng.normal(size=Csync.shape)
+    Msync += 0.1 * rng.normal(size=Msync.shape)
+    return Csync, Msync
+
+
+def bench_laplacian(beat_counts, k=5, dense_max_beats=5000):
+    """Compares the dense and sparse Laplacian eigenvector paths over a range of beat counts."""
+    rows = []
+    for n_beats in beat_counts:
+        Csync, Msync = synthetic_beat_features(n_beats)
+        row = {'beats': n_beats}
+        evecs = {}
+        for eigensolver in ['dense', 'sparse']:
+            if eigensolver == 'dense' and n_beats > dense_max_beats:
+                row['dense_s'] = float('nan')
+                continue
+            start = time.perf_counter()
+            evecs[eigensolver] = server.laplacian_eigenvectors(Csync, Msync, k, eigensolver)
+            row[f"{eigensolver}_s"] = time.perf_counter() - start
+        if len(evecs) == 2:
+            # Largest principal angle between the two eigenvector subspaces
+            row['max_angle_deg'] = float(np.degrees(
+                np.max(scipy.linalg.subspace_angles(evecs['dense'], evecs['sparse']))))
+        else:
+            row['max_angle_deg'] = float('nan')
+        rows.append(row)
+    return rows
+
+
+def synthetic_rate_modulated_beats(minutes, bpm=120, n_segments=12, seed=0):
+    """Beat times, segments and a modulated beat list of a song of the given length."""
+    rng = np.random.default_rng(seed)
+    n_beats = int(minutes * bpm)
+    beat_times = np.arange(n_beats) * 60 / bpm
+    bounds = np.unique(np.r_[0, np.sort(rng.integers(1, n_beats - 1, size=n_segments * int(np.ceil(minutes)))),
+                             n_beats - 1])
+    segments = [((0, 0), (bounds[i], bounds[i + 1]), int(rng.integers(0, n_segments)))
+                for i in range(len(bounds) - 1)]
+    rates = rng.choice([0, 1, 2, 4, 8, 16], size=n_beats)
+    modulated_beats = np.unique(np.concatenate(
+        [[ind] if rate == 1 else ind + np.arange(rate + 1) / rate
+         for ind, rate in enumerate(rates) if rate > 0]))
+    return beat_times, segments, modulated_beats
+
+
+def bench_segments(minutes_list, repeat=3):
+    """Times segment lengths and modulated beat times of the rate modulated model on synthetic songs."""
+    rows = []
+    for minutes in minutes_list:
+        beat_times, segments, modulated_beats = synthetic_rate_modulated_beats(minutes)
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            server.segments_to_data_frame_rate_modulated(segments, modulated_beats)
+            server.modulated_beat_times(beat_times, 120, modulated_beats)
+            best = min(best, time.perf_counter() - start)
+        rows.append({'minutes': minutes,
+                     'beats': len(modulated_beats),
+                     'segments': len(segments),
+                     'seconds': best,
+                     'us_per_beat': 1e6 * best / len(modulated_beats)})
+    return rows
+
+
+def bench_run_models(song_path, temp_dir, models, version=1,
+                     difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus')):
+    """Times mapping every difficulty with sequential /run_model requests and with one /run_models request."""
+    client = server.app.test_client()
+    # Both passes use already loaded models
+    server.model_registry.preload(temp_dir, [version], difficulties)
+    rows = []
+    for model in models:
+        row = {'model': model}
+        for endpoint in ['run_model', 'run_models']:
+            # Start each pass from a cold feature cache, like a new song would
+            server.feature_cache.clear()
+            features = client.post('/get_beat_features', json={'song_path': song_path}).get_json()['data']
+            body = {'model': model, 'beat_times': features['beat_times'], 'bpm': features['bpm'],
+                    'version': version, 'song_id': features['song_id'], 'tempDir': temp_dir}
+            start = time.perf_counter()
+            if endpoint == 'run_model':
+                for difficulty in difficulties:
+                    client.post('/run_model', json={**body, 'difficulty': difficulty})
+            else:
+                client.post('/run_models', json={**body, 'difficulties': list(difficulties)})
+            row[f"{endpoint}_s"] = time.perf_counter() - start
+            client.post('/release_song', json={'song_id': features['song_id']})
+        row['speedup'] = row['run_model_s'] / row['run_models_s']
+        rows.append(row)
+    return rows
+
+
+def bench_feature_store(song_path, temp_dir, models, version=1,
+                        difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus')):
+    """Times mapping a song with an empty feature store and again with its analysis stored."""
+    client = server.app.test_client()
+    server.model_registry.preload(temp_dir, [version], difficulties)
+    rows = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        for model in models:
+            server.feature_store = server.FeatureStore(os.path.join(store_dir, model))
+            row = {'model': model}
+            for run in ['cold', 'stored']:
+                server.feature_cache.clear()
+                start = time.perf_counter()
+                features = client.post('/get_beat_features', json={'song_path': song_path}).get_json()['data']
+                client.post('/run_models', json={'model': model, 'beat_times': features['beat_times'],
+                                                 'bpm': features['bpm'], 'version': version,
+                                                 'song_id': features['song_id'], 'tempDir': temp_dir,
+                                                 'difficulties': list(difficulties)})
+                row[f"{run}_s"] = time.perf_counter() - start
+                client.post('/release_song', json={'song_id': features['song_id']})
+            row['speedup'] = row['cold_s'] / row['stored_s']
+            rows.append(row)
+        server.feature_store = server.FeatureStore(None)
+    return rows
+
+
+def synthetic_song(path, minutes, sr=44100, bpm=120, seed=0):
+    """Writes a stereo click and noise track of the given length, block by block."""
+    rng = np.random.default_rng(seed)
+    beat = int(sr * 60 / bpm)
+    click = np.zeros(beat, dtype=np.float32)
+    click[:400] = np.hanning(800)[400:] * np.sin(np.arange(400) * 0.3)
+    with soundfile.SoundFile(path, 'w', samplerate=sr, channels=2, subtype='PCM_16') as f:
+        for _ in range(int(minutes * bpm)):
+            x = click * rng.uniform(0.3, 1.0) + 0.02 * rng.standard_normal(beat).astype(np.float32)
+            f.write(np.column_stack([x, x]))
+
+
+def bench_streaming(minutes_list, memory_limit=server.ANALYSIS_MEMORY_LIMIT):
+    """Peak traced memory and time of decoding and analysing a song, at once and block by block."""
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for minutes in minutes_list:
+            path = os.path.join(temp_dir, f"song_{minutes}.wav")
+            synthetic_song(path, minutes)
+            row = {'minutes': minutes}
+            for mode, limit in [('full', float('inf')), ('streaming', memory_limit)]:
+                server.ANALYSIS_MEMORY_LIMIT = limit
+                server.feature_cache.clear()
+                tracemalloc.start()
+                start = time.perf_counter()
+                y, sr, bpm, beat_times = server.load_song(path)
+                server.laplacian_segmentation(y, sr)
+                server.SongFeatures(y, sr).beat_decibel()
+                row[f"{mode}_s"] = time.perf_counter() - start
+                row[f"{mode}_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+                del y
+            server.ANALYSIS_MEMORY_LIMIT = memory_limit
+            server.feature_cache.clear()
+            rows.append(row)
+    return rows
+
+
+def bench_convert(minutes_list):
+    """
+    Times converting a song to .egg and then loading it,
+    with pydub (decode and encode by separate ffmpeg runs, then librosa.load)
+    and with convert_song (one ffmpeg run handing the decoded song to load_audio).
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for minutes in minutes_list:
+            path = os.path.join(temp_dir, f"song_{minutes}.wav")
+            synthetic_song(path, minutes)
+            out_path = os.path.join(temp_dir, 'song.egg')
+            row = {'minutes': minutes}
+            server.feature_cache.clear()
+            start = time.perf_counter()
+            server.pydub.AudioSegment.from_file(path, format='wav').export(out_path, format='ogg')
+            row['pydub_convert_s'] = time.perf_counter() - start
+            server.load_audio(path)
+            row['pydub_total_s'] = time.perf_counter() - start
+            server.feature_cache.clear()
+            start = time.perf_counter()
+            server.convert_song(path, out_path)
+            row['convert_s'] = time.perf_counter() - start
+            server.load_audio(path)
+            row['total_s'] = time.perf_counter() - start
+            row['speedup'] = row['pydub_total_s'] / row['total_s']
+            server.feature_cache.clear()
+            rows.append(row)
+    return rows
+
+
+def bench_startup(repeat=3, port=5099):
+    """Seconds from starting a server process until /ping answers and until it reports it is ready."""
+    rows = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, server.__file__, '--port', str(port), '--no-feature-store'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        row = {'run': run}
+        try:
+            while 'ready_s' not in row:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=5) as response:
+                        status = json.load(response)['data']
+                except OSError:
+                    time.sleep(0.01)
+                    continue
+                row.setdefault('ping_s', time.perf_counter() - start)
+                if status['ready']:
+                    row['ready_s'] = time.perf_counter() - start
+                time.sleep(0.01)
+        finally:
+            process.terminate()
+            process.wait()
+        rows.append(row)
+    return rows
+
+
+# Synthetic tracks of bench_models as kind:bpm
+MODEL_TRACKS = ['click:90', 'click:150', 'chirp:110', 'noise:128']
+# Job stages in the order the models go through them
+MODEL_STAGES = ['decode', 'beat track', 'cqt', 'segmentation', 'walk', 'validation']
+
+
+def synthetic_track(path, kind, minutes, bpm=120, sr=44100, seed=0, n_sections=4, section_beats=32):
+    """
+    Writes a deterministic mono track made of sections of section_beats beats repeating in a seeded order,
+    so that the segmentation has some structure to find. Every beat of a section plays
+    a click ('click'), a chirp sweeping to the pitch of the next beat ('chirp') or a burst of noise ('noise'),
+    with a pitch, level or burst length that depends on the section and the position in the bar.
+    """
+    rng = np.random.default_rng(seed)
+    beat = int(round(sr * 60 / bpm))
+    t = np.arange(beat) / sr
+    freqs = rng.uniform(200, 2000, size=(n_sections, 4))
+    levels = rng.uniform(0.3, 1.0, size=(n_sections, 4))
+    bursts = rng.uniform(0.02, 0.2, size=(n_sections, 4))
+
+    def render_beat(section, i, noise):
+        f, level = freqs[section, i], levels[section, i]
+        if kind == 'click':
+            x = np.sin(2 * np.pi * f * t) * np.exp(-60 * t)
+        elif kind == 'chirp':
+            f_next = freqs[section, (i + 1) % 4]
+            x = np.sin(2 * np.pi * (f * t + (f_next - f) * t**2 / (2 * t[-1]))) * np.exp(-8 * t)
+        elif kind == 'noise':
+            x = noise * (t < bursts[section, i])
+        else:
+            raise ValueError(f"Unknown track kind: {kind}")
+        return level * x
+
+    n_beats = int(minutes * bpm)
+    order = rng.integers(0, n_sections, size=-(-n_beats // section_beats))
+    with soundfile.SoundFile(path, 'w', samplerate=sr, channels=1, subtype='PCM_16') as f:
+        for n, section in enumerate(order):
+            beats = [render_beat(section, i % 4, rng.standard_normal(beat))
+                     for i in range(min(section_beats, n_beats - n * section_beats))]
+            x = np.concatenate(beats) + 0.01 * rng.standard_normal(len(beats) * beat)
+            f.write(np.clip(0.8 * x, -1, 1).astype(np.float32))
+
+
+def synthetic_chain(seed=0, n_walks=40, state_size=5):
+    """A small markovify chain of random walk steps, in the format of the trained HMM models."""
+    rng = np.random.default_rng(seed)
+
+    def step():
+        parts = []
+        for note_type in server.WALK_NOTE_TYPES:
+            if note_type != 3 and rng.random() < 0.5:
+                parts += [note_type, rng.integers(0, 4), rng.integers(0, 3), rng.integers(0, 9)]
+            else:
+                parts += [server.WALK_EMPTY] * 4
+        return ', '.join(str(part) for part in parts)
+
+    corpus = [[step() for _ in range(rng.integers(50, 400))] for _ in range(n_walks)]
+    return markovify.Chain(corpus, state_size=state_size)
+
+
+def write_synthetic_models(temp_dir, version=1, difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus')):
+    """Writes a synthetic model of every difficulty where the server looks for the HMM models."""
+    os.makedirs(os.path.join(temp_dir, 'models'), exist_ok=True)
+    for seed, difficulty in enumerate(difficulties):
+        with open(server.ModelRegistry.model_path(temp_dir, difficulty, version), 'wb') as f:
+            pickle.dump(synthetic_chain(seed), f)
+
+
+class StageRecorder:
+    """
+    Stands in for the job of the benchmarked thread, recording the wall time
+    and peak traced memory of every stage the server reports with job_progress.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.stage = None
+        self.start = None
+
+    def progress(self, stage=None, percent=None):
+        if stage is not None and stage != self.stage:
+            self._enter(stage)
+
+    def _enter(self, stage):
+        now = time.perf_counter()
+        if self.stage is not None:
+            entry = self.stages.setdefault(self.stage, {'seconds': 0.0, 'peak_mb': 0.0})
+            entry['seconds'] += now - self.start
+            entry['peak_mb'] = max(entry['peak_mb'], tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.reset_peak()
+        self.stage, self.start = stage, now
+
+    def finish(self):
+        self._enter(None)
+
+
+def bench_models(tracks, minutes_list, models, difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus'),
+                 sr=44100):
+    """
+    Maps synthetic tracks with every model and difficulty from a cold feature cache, using synthetic models.
+    Reports the wall time and peak traced memory of every stage, and the notes per second of every difficulty.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_synthetic_models(temp_dir, 1, difficulties)
+        for difficulty in difficulties:
+            server.model_registry.walker(temp_dir, difficulty, 1)
+        # Keep first-call costs (filter loading, JIT) out of the first track
+        server._warm_up_analysis()
+        for track in tracks:
+            kind, bpm = track.split(':')
+            for minutes in minutes_list:
+                path = os.path.join(temp_dir, f"{kind}_{bpm}_{minutes}.wav")
+                synthetic_track(path, kind, minutes, int(bpm), sr)
+                for model in models:
+                    server.feature_cache.clear()
+                    recorder = StageRecorder()
+                    token = server.current_job.set(recorder)
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    row = {'track': track, 'minutes': minutes, 'model': model}
+                    try:
+                        y, song_sr, song_bpm, beat_times = server.load_song(path)
+                        result = server.run_models_parallel(model, temp_dir, list(difficulties), beat_times.tolist(),
+                                                            song_bpm, 1, y, song_sr, jobs=1)
+                        error = None
+                    except Exception as e:
+                        result, error = {'results': {}}, f"{type(e).__name__}: {e}"
+                    finally:
+                        row['total_s'] = time.perf_counter() - start
+                        recorder.finish()
+                        tracemalloc.stop()
+                        server.current_job.reset(token)
+                    for stage in MODEL_STAGES:
+                        row[f"{stage.replace(' ', '_')}_s"] = recorder.stages.get(stage, {}).get('seconds', 0.0)
+                    row['peak_mb'] = max((entry['peak_mb'] for entry in recorder.stages.values()), default=0.0)
+                    counts = {difficulty: len(entry['data']) if entry['data'] is not None else 0
+                              for difficulty, entry in result['results'].items()}
+                    notes = sum(counts.values())
+                    walk_seconds = sum(entry['seconds'] for entry in result['results'].values())
+                    row['notes'] = notes
+                    row['notes_per_s'] = notes / walk_seconds if walk_seconds else float('nan')
+                    row['error'] = error or ''
+                    row['stages'] = recorder.stages
+                    row['difficulties'] = {
+                        difficulty: {'notes': counts[difficulty],
+                                     'seconds': entry['seconds'],
+                                     'notes_per_s': counts[difficulty] / entry['seconds']
+                                     if entry['seconds'] else float('nan'),
+                                     'error': entry['error']}
+                        for difficulty, entry in result['results'].items()}
+                    rows.append(row)
+    return rows
+
+
+def bench_note_formats(minutes_list, bpm=180, difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus'),
+                       repeat=5):
+    """
+    Encodes a /run_models result of random maps in every note format, reporting the payload size
+    and the best server encode and client decode times.
+    """
+    decoders = {server.NOTES_JSON: json.loads,
+                server.NOTES_COLUMNS: json.loads,
+                server.NOTES_BINARY: server.unpack_level_payload}
+    if server.NOTES_MSGPACK in server.NOTE_FORMATS:
+        import msgpack
+        decoders[server.NOTES_MSGPACK] = msgpack.unpackb
+    rows = []
+    for minutes in minutes_list:
+        beat_times = np.arange(0, minutes * 60, 60 / bpm)
+        results = {difficulty: {'data': server.random_notes_writer(None, difficulty, beat_times, bpm, 1, None, None,
+                                                                   rng=np.random.default_rng(0)),
+                                'seconds': 0.0, 'error': None}
+                   for difficulty in difficulties}
+        data = {'analysis_seconds': 0.0, 'results': results}
+        notes = sum(len(entry['data']) for entry in results.values())
+        for mimetype, decode in decoders.items():
+            encode_s, decode_s = float('inf'), float('inf')
+            for _ in range(repeat):
+                with server.app.test_request_context(headers={'Accept': mimetype}):
+                    start = time.perf_counter()
+                    response = server.app.make_response(server.notes_response(data))
+                    encode_s = min(encode_s, time.perf_counter() - start)
+                payload = response.get_data()
+                start = time.perf_counter()
+                decode(payload)
+                decode_s = min(decode_s, time.perf_counter() - start)
+            rows.append({'minutes': minutes, 'format': mimetype.rsplit('/', 1)[1].replace('vnd.beatmapsynth.', ''),
+                         'notes': notes, 'kb': len(payload) / 1024, 'encode_s': encode_s, 'decode_s': decode_s})
+    return rows
+
+
+def bench_events(minutes_list, bpm=180, difficulties=('easy', 'normal', 'hard', 'expert', 'expertplus'),
+                 section_beats=32, repeat=5):
+    """
+    Writes the level events of random maps, reporting the best time of the note driven lights
+    and of the audio driven lights over synthetic per-beat loudness and segments.
+    """
+    rows = []
+    for minutes in minutes_list:
+        beat_times = np.arange(0, minutes * 60, 60 / bpm)
+        rng = np.random.default_rng(0)
+        beat_decibel = rng.normal(-20, 6, len(beat_times))
+        segments = [(None, np.arange(start, min(start + section_beats, len(beat_times))), i % 4)
+                    for i, start in enumerate(range(0, len(beat_times), section_beats))]
+        for difficulty in difficulties:
+            notes = server.random_notes_writer(None, difficulty, beat_times, bpm, 1, None, None, rng=rng)
+            notes_s, audio_s = float('inf'), float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                events = server.note_events(notes, bpm)
+                notes_s = min(notes_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                lights = server.audio_light_events(beat_decibel, beat_times, bpm, segments)
+                audio_s = min(audio_s, time.perf_counter() - start)
+            rows.append({'minutes': minutes, 'difficulty': difficulty, 'notes': len(notes), 'events': len(events),
+                         'notes_s': notes_s, 'audio_lights': len(lights), 'audio_s': audio_s})
+    return rows
+
+
+def environment():
+    """Versions of the benchmarked stack, stored with the JSON results to compare runs between releases."""
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'librosa': server.librosa.__version__,
+            'sklearn': server.sklearn.__version__}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--json', help='write the results to this JSON file')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    laplacian = subparsers.add_parser('laplacian', help='dense vs sparse Laplacian eigenvectors')
+    laplacian.add_argument('--beats', type=int, nargs='+', default=[200, 500, 1000, 2000, 5000])
+    laplacian.add_argument('--k', type=int, default=5)
+
+    segments = subparsers.add_parser('segments', help='rate modulated segment lengths and beat times')
+    segments.add_argument('--minutes', type=float, nargs='+', default=[1, 2.5, 5, 10])
+
+    run_models = subparsers.add_parser('run_models', help='all difficulties in one request vs one request each')
+    run_models.add_argument('song_path')
+    run_models.add_argument('temp_dir', help='directory holding the models folder')
+    run_models.add_argument('--models', nargs='+', default=list(server.MODEL_WRITERS))
+    run_models.add_argument('--version', type=int, default=1)
+
+    store = subparsers.add_parser('feature_store', help='mapping a song from an empty vs a filled feature store')
+    store.add_argument('song_path')
+    store.add_argument('temp_dir', help='directory holding the models folder')
+    store.add_argument('--models', nargs='+', default=list(server.MODEL_WRITERS))
+    store.add_argument('--version', type=int, default=1)
+
+    convert = subparsers.add_parser('convert', help='pydub vs single ffmpeg run song conversion and loading')
+    convert.add_argument('--minutes', type=float, nargs='+', default=[3, 10])
+
+    startup = subparsers.add_parser('startup', help='server process start until /ping answers and until ready')
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--port', type=int, default=5099)
+
+    models = subparsers.add_parser('models', help='every model and difficulty on synthetic tracks, per stage')
+    models.add_argument('--tracks', nargs='+', default=MODEL_TRACKS, metavar='KIND:BPM',
+                        help='click, chirp or noise tracks at a tempo')
+    models.add_argument('--minutes', type=float, nargs='+', default=[1, 5, 20])
+    models.add_argument('--models', nargs='+', default=list(server.MODEL_WRITERS))
+    models.add_argument('--difficulties', nargs='+', default=['easy', 'normal', 'hard', 'expert', 'expertplus'])
+    models.add_argument('--sr', type=int, default=44100, help='sample rate of the synthetic tracks')
+
+    streaming = subparsers.add_parser('streaming', help='whole song vs block by block decoding and analysis')
+    streaming.add_argument('--minutes', type=float, nargs='+', default=[5, 15, 30])
+    streaming.add_argument('--memory-limit-mb', type=int, default=server.ANALYSIS_MEMORY_LIMIT // 2**20)
+
+    note_formats = subparsers.add_parser('note_formats', help='size and speed of the note response formats')
+    note_formats.add_argument('--minutes', type=float, nargs='+', default=[3, 60])
+
+    events = subparsers.add_parser('events', help='note driven and audio driven level events')
+    events.add_argument('--minutes', type=float, nargs='+', default=[3, 60])
+
+    args = parser.parse_args(argv)
+    if args.benchmark == 'laplacian':
+        results = bench_laplacian(args.beats, args.k)
+    elif args.benchmark == 'segments':
+        results = bench_segments(args.minutes)
+    elif args.benchmark == 'run_models':
+        results = bench_run_models(args.song_path, args.temp_dir, args.models, args.version)
+    elif args.benchmark == 'feature_store':
+        results = bench_feature_store(args.song_path, args.temp_dir, args.models, args.version)
+    elif args.benchmark == 'convert':
+        results = bench_convert(args.minutes)
+    elif args.benchmark == 'startup':
+        results = bench_startup(args.repeat, args.port)
+    elif args.benchmark == 'models':
+        results = bench_models(args.tracks, args.minutes, args.models, args.difficulties, args.sr)
+    elif args.benchmark == 'streaming':
+        results = bench_streaming(args.minutes, args.memory_limit_mb * 2**20)
+    elif args.benchmark == 'note_formats':
+        results = bench_note_formats(args.minutes)
+    elif args.benchmark == 'events':
+        results = bench_events(args.minutes)
+
+    _print_rows(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'environment': environment(), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+import beatMapSynthServer as server
+import benchmark
+
+
+@pytest.fixture
+def songs(tmp_path):
+    """A songs directory holding a/one.wav and b/two.wav."""
+    root = tmp_path / 'songs'
+    for name in ['a/one', 'b/two']:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        benchmark.synthetic_track(str(root / f'{name}.wav'), 'click', 0.1, bpm=120, sr=22050)
+    return root
+
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    for var in server.THREAD_ENV_VARS:
+        monkeypatch.delenv(var, raising=False)
+
+
+def _checkpoint(out_dir):
+    with open(out_dir / server.BATCH_CHECKPOINT) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batch_output_paths_mirror_the_root(tmp_path):
+    root, out_dir = str(tmp_path / 'songs'), str(tmp_path / 'out')
+    assert server.batch_output_path(os.path.join(root, 'a', 'one.mp3'), root, out_dir) == \
+        os.path.join(out_dir, 'a', 'one.json')
+    outside = str(tmp_path / 'elsewhere' / 'three.mp3')
+    path = server.batch_output_path(outside, root, out_dir)
+    assert path.startswith(out_dir + os.sep) and path.endswith(os.path.join('elsewhere', 'three.json'))
+
+
+def test_batch_maps_songs_and_resumes_with_other_sources(tmp_path, songs, clean_env):
+    out_dir = tmp_path / 'out'
+    summary = server.run_batch(str(songs / 'a'), str(out_dir), 'random', ['easy', 'hard'], 1, str(tmp_path),
+                               workers=1, seed=3, root=str(songs))
+    assert summary == {'songs': 1, 'skipped': 0, 'mapped': 1, 'failed': 0}
+    with open(out_dir / 'a' / 'one.json') as f:
+        song = json.load(f)
+    assert set(song['notes']) == {'easy', 'hard'} and song['seed'] == 3
+    assert not any(var in os.environ for var in server.THREAD_ENV_VARS)
+
+    # A manifest next to the songs has the same root, so the first song keeps its notes file and is skipped
+    manifest = songs / 'manifest.txt'
+    manifest.write_text('a/one.wav\nb/two.wav\n')
+    summary = server.run_batch(str(manifest), str(out_dir), 'random', ['easy'], 1, str(tmp_path), workers=1)
+    assert summary == {'songs': 2, 'skipped': 1, 'mapped': 1, 'failed': 0}
+    assert (out_dir / 'b' / 'two.json').exists()
+    assert [(os.path.relpath(entry['song'], songs), entry['status']) for entry in _checkpoint(out_dir)] == \
+        [(os.path.join('a', 'one.wav'), 'ok'), (os.path.join('b', 'two.wav'), 'ok')]
+    assert not any(var in os.environ for var in server.THREAD_ENV_VARS)
+
+
+def test_worker_thread_env_restores_the_environment(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '8')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    with server.worker_thread_env(2):
+        assert os.environ['OMP_NUM_THREADS'] == os.environ['MKL_NUM_THREADS'] == '2'
+    assert os.environ['OMP_NUM_THREADS'] == '8'
+    assert 'MKL_NUM_THREADS' not in os.environ
+
+
+def test_warm_stores_the_analysis_once(tmp_path, songs, clean_env, monkeypatch):
+    monkeypatch.setattr(server, 'feature_store', server.FeatureStore(str(tmp_path / 'store')))
+    assert server.run_warm(str(songs), workers=1) == {'songs': 2, 'skipped': 0, 'warmed': 2, 'failed': 0}
+    assert all(server.feature_store.has_source(str(song)) for song in songs.rglob('*.wav'))
+    assert server.run_warm(str(songs), workers=1) == {'songs': 2, 'skipped': 2, 'warmed': 0, 'failed': 0}
+    assert not any(var in os.environ for var in server.THREAD_ENV_VARS)
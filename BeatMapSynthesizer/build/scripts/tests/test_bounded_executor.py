@@ -0,0 +1,72 @@
+import threading
+
+import gevent
+import gevent.socket
+import pytest
+from gevent.pywsgi import WSGIServer
+
+import beatMapSynthServer as server
+
+
+def _get(address, path):
+    """Status code of a GET request, sent through a gevent socket so that the server's hub keeps running."""
+    with gevent.Timeout(5):
+        sock = gevent.socket.create_connection(address)
+        try:
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+            response = b''
+            while chunk := sock.recv(4096):
+                response += chunk
+        finally:
+            sock.close()
+    return int(response.split(b' ', 2)[1])
+
+
+@pytest.mark.parametrize('cooperative', [False, True])
+def test_full_executor_rejects_without_blocking(cooperative):
+    executor = server.BoundedExecutor(workers=1, max_queued=2, cooperative=cooperative)
+    release = threading.Event()
+    futures = [executor.submit(release.wait, 10) for _ in range(3)]
+    with gevent.Timeout(1):
+        with pytest.raises(server.ExecutorFull):
+            executor.submit(release.wait, 10)
+    assert executor.stats()['pending'] == 3
+    assert executor.stats()['rejected'] == 1
+
+    release.set()
+    assert [future.result(timeout=5) for future in futures] == [True, True, True]
+    gevent.sleep(0.1)
+    assert executor.stats()['pending'] == 0
+    assert executor.submit(lambda: 'free').result(timeout=5) == 'free'
+
+
+def test_cooperative_executor_cancels_queued_requests():
+    executor = server.BoundedExecutor(workers=1, max_queued=2, cooperative=True)
+    release = threading.Event()
+    running = executor.submit(release.wait, 10)
+    queued = executor.submit(lambda: 'ran')
+    assert queued.cancel()
+    assert queued.cancelled()
+    assert executor.stats()['pending'] == 1
+    release.set()
+    assert running.result(timeout=5)
+    assert not running.cancel()
+
+
+def test_saturated_server_keeps_answering(monkeypatch):
+    executor = server.BoundedExecutor(workers=1, max_queued=3, cooperative=True)
+    monkeypatch.setattr(server, 'request_executor', executor)
+    http_server = WSGIServer(('127.0.0.1', 0), server.app, log=None)
+    http_server.start()
+    release = threading.Event()
+    try:
+        futures = [executor.submit(release.wait, 10) for _ in range(4)]
+        assert _get(http_server.address, '/ping') == 200
+        with gevent.Timeout(1):
+            with pytest.raises(server.ExecutorFull):
+                executor.submit(release.wait, 10)
+        assert _get(http_server.address, '/ping') == 200
+    finally:
+        release.set()
+        http_server.stop()
+    assert all(future.result(timeout=5) for future in futures)
@@ -0,0 +1,65 @@
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+
+SR = 22050
+
+# Stands in for ffmpeg: floods stderr before writing the song's samples to stdout and copying it to the .ogg output
+FAKE_FFMPEG = '''
+import os
+import sys
+
+import soundfile
+
+args = sys.argv[1:]
+y, _ = soundfile.read(args[args.index('-i') + 1], dtype='float32')
+sys.stderr.write('[mp3 @ 0x0] invalid frame\\n' * 20000)
+sys.stderr.flush()
+sys.stdout.buffer.write(y.astype('<f4').tobytes())
+sys.stdout.flush()
+with open(args[args.index('ogg') + 1], 'wb') as f:
+    f.write(b'OggS')
+sys.exit(int(os.environ.get('FAKE_FFMPEG_EXIT', '0')))
+'''
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    path = tmp_path / 'ffmpeg'
+    path.write_text(f"#!{sys.executable}\n{FAKE_FFMPEG}")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(server.pydub.AudioSegment, 'converter', str(path))
+    monkeypatch.setattr(server, 'feature_cache', server.FeatureCache())
+    return path
+
+
+@pytest.fixture
+def song(tmp_path):
+    y = (0.5 * np.sin(2 * np.pi * 440 * np.arange(2 * SR) / SR)).astype(np.float32)
+    path = str(tmp_path / 'song.wav')
+    server.soundfile.write(path, y, SR, subtype='FLOAT')
+    return path, y
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='the fake ffmpeg is a script')
+def test_convert_reads_samples_past_a_full_stderr_pipe(fake_ffmpeg, song, tmp_path):
+    song_path, y = song
+    out_path = str(tmp_path / 'song.egg')
+    server.convert_song(song_path, out_path, sr=SR)
+    assert os.path.exists(out_path)
+    cached, sr = server.feature_cache.get(server._decoded_key(song_path, SR), lambda: None)
+    assert sr == SR
+    np.testing.assert_allclose(cached, y, atol=1e-6)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='the fake ffmpeg is a script')
+def test_failed_convert_reports_the_last_errors(fake_ffmpeg, song, tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_EXIT', '1')
+    with pytest.raises(RuntimeError, match='invalid frame') as error:
+        server.convert_song(song[0], str(tmp_path / 'song.egg'), sr=SR)
+    assert len(str(error.value)) < 8192
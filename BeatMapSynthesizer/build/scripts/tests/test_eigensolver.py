@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+import benchmark
+
+
+@pytest.mark.parametrize('n', [5, 40, 300])
+@pytest.mark.parametrize('density', [0.05, 0.5])
+def test_sparse_diagonal_filter_matches_dense_filter(n, density):
+    rng = np.random.default_rng(n)
+    R = (rng.random((n, n)) < density) * rng.random((n, n))
+    R = np.maximum(R, R.T)
+    dense = server.librosa.segment.timelag_filter(server.scipy.ndimage.median_filter)(R, size=(1, 7))
+    sparse = server._diagonal_median_filter(server.scipy.sparse.csr_matrix(R), 7)
+    np.testing.assert_array_equal(sparse.toarray(), dense)
+
+
+@pytest.mark.parametrize('kind, bpm', [('click', 90), ('chirp', 110), ('noise', 128)])
+def test_sparse_eigensolver_matches_dense(tmp_path, kind, bpm):
+    path = str(tmp_path / f'{kind}.wav')
+    benchmark.synthetic_track(path, kind, 1, bpm=bpm, sr=22050, section_beats=8)
+    y, sr = server.load_audio(path)
+    features = server.SongFeatures(y, sr, cache=server.FeatureCache(), store=server.FeatureStore(None))
+    Csync = features.beat_cqt_db(server.BINS_PER_OCTAVE, server.N_OCTAVES * server.BINS_PER_OCTAVE)
+    Msync = features.beat_mfcc()
+    dense = server.laplacian_eigenvectors(Csync, Msync, 5, 'dense')
+    sparse = server.laplacian_eigenvectors(Csync, Msync, 5, 'sparse')
+    np.testing.assert_allclose(server.scipy.linalg.subspace_angles(dense, sparse), 0, atol=1e-8)
+
+    dense_segments, sparse_segments = [
+        server._laplacian_segmentation(features, server.BINS_PER_OCTAVE, server.N_OCTAVES, server.K_RANGE,
+                                       'fast', eigensolver)[0]
+        for eigensolver in ['dense', 'sparse']]
+    assert [beats for _, beats, _ in dense_segments] == [beats for _, beats, _ in sparse_segments]
+    np.testing.assert_allclose([times for times, _, _ in dense_segments],
+                               [times for times, _, _ in sparse_segments])
+    # Labels only have to match up to their numbering
+    relabel = {}
+    for (_, _, dense_label), (_, _, sparse_label) in zip(dense_segments, sparse_segments):
+        assert relabel.setdefault(dense_label, sparse_label) == sparse_label
+    assert len(set(relabel.values())) == len(relabel)
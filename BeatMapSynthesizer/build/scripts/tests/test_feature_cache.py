@@ -0,0 +1,60 @@
+import threading
+import time
+
+import numpy as np
+
+import beatMapSynthServer as server
+
+
+def test_concurrent_misses_compute_once():
+    cache = server.FeatureCache()
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.2)
+        return np.arange(3)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(('song', 'feature'), compute)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len(calls) == 1
+    assert len(results) == 4 and all(result is results[0] for result in results)
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (1, 3)
+
+
+def test_failed_compute_is_retried():
+    cache = server.FeatureCache()
+
+    def fail():
+        raise RuntimeError('compute failed')
+
+    try:
+        cache.get('key', fail)
+    except RuntimeError:
+        pass
+    assert cache.get('key', lambda: 1) == 1
+
+
+def test_read_only_songs_are_hashed_once():
+    y = np.random.default_rng(0).standard_normal(22050).astype(np.float32)
+    key = server.audio_hash(y, 22050)
+    assert id(y) not in server._audio_keys
+    server._freeze(y)
+    assert server.audio_hash(y, 22050) == key
+    assert server._audio_keys[id(y)][2] == key
+    assert server.audio_hash(y, 44100) != key
+    ident = id(y)
+    del y
+    assert ident not in server._audio_keys
+
+
+def test_stored_songs_are_read_only(monkeypatch):
+    monkeypatch.setattr(server, 'song_store', server.SongStore())
+    song_id = server.song_store.put(np.zeros(100, dtype=np.float64), 22050)
+    y, sr = server.song_store.get(song_id)
+    assert y.dtype == np.float32 and not y.flags.writeable
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+import beatMapSynthServer as server
+
+
+class Compute:
+    """Counts the calls of a feature computation."""
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def _song_key(i):
+    return f"{i:02x}" + 'ab' * 15
+
+
+def _values(seed, n=1024):
+    # Random values don't compress, so that every entry takes about the same space
+    return np.random.default_rng(seed).random(n)
+
+
+def test_stored_features_are_reused_across_stores(tmp_path):
+    store = server.FeatureStore(str(tmp_path))
+    compute = Compute((120.0, np.arange(0, 400, 20)))
+    tempo, beats = store.get(_song_key(1), 'beat_track', (), compute)
+    assert compute.calls == 1 and (store.hits, store.misses) == (0, 1)
+
+    # A restarted server finds the same entry by the song's audio hash and the analysis parameters
+    restarted = server.FeatureStore(str(tmp_path))
+    stored_tempo, stored_beats = restarted.get(_song_key(1), 'beat_track', (), compute)
+    assert compute.calls == 1 and (restarted.hits, restarted.misses) == (1, 0)
+    assert stored_tempo == tempo
+    np.testing.assert_array_equal(stored_beats, beats)
+
+    restarted.get(_song_key(1), 'beat_track', ('other parameters',), compute)
+    restarted.get(_song_key(2), 'beat_track', (), compute)
+    assert compute.calls == 3
+
+
+def test_segmentation_round_trips(tmp_path):
+    segmentation = ([((0.0, 4.0), (0, 8), 1), ((4.0, 6.5), (8, 13), 0)], np.linspace(0, 6.5, 14), 118.5)
+    store = server.FeatureStore(str(tmp_path))
+    store.get(_song_key(1), 'segmentation', (), Compute(segmentation))
+    segments, beat_times, tempo = store.get(_song_key(1), 'segmentation', (), Compute(None))
+    assert segments == segmentation[0] and tempo == segmentation[2]
+    np.testing.assert_array_equal(beat_times, segmentation[1])
+
+
+def test_unstored_features_and_disabled_store_always_compute(tmp_path):
+    compute = Compute(np.ones(4))
+    store = server.FeatureStore(str(tmp_path))
+    store.get(_song_key(1), 'stft_db', (), compute)
+    store.get(_song_key(1), 'stft_db', (), compute)
+    disabled = server.FeatureStore(None)
+    disabled.get(_song_key(1), 'beat_mfcc', (), compute)
+    disabled.get(_song_key(1), 'beat_mfcc', (), compute)
+    assert compute.calls == 4
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_used_songs_are_evicted(tmp_path):
+    store = server.FeatureStore(str(tmp_path))
+    store.get(_song_key(1), 'beat_mfcc', (), Compute(_values(1)))
+    entry_bytes = store.stats()['bytes']
+    store.max_bytes = int(2.5 * entry_bytes)
+    store.get(_song_key(2), 'beat_mfcc', (), Compute(_values(2)))
+    os.utime(store.song_dir(_song_key(1)), (1000, 1000))
+    os.utime(store.song_dir(_song_key(2)), (2000, 2000))
+
+    # Reading song 1 makes song 2 the least recently used
+    store.get(_song_key(1), 'beat_mfcc', (), Compute(None))
+    store.get(_song_key(3), 'beat_mfcc', (), Compute(_values(3)))
+    assert os.path.isdir(store.song_dir(_song_key(1)))
+    assert not os.path.exists(store.song_dir(_song_key(2)))
+    assert os.path.isdir(store.song_dir(_song_key(3)))
+    assert store.stats()['evictions'] == 1
+    assert store.stats()['bytes'] <= store.max_bytes
+
+
+def test_truncated_entry_is_a_miss_and_rewritten(tmp_path):
+    store = server.FeatureStore(str(tmp_path))
+    values = _values(1)
+    store.get(_song_key(1), 'beat_decibel', (), Compute(values))
+    path = store.entry_path(_song_key(1), 'beat_decibel', ())
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+    compute = Compute(values)
+    np.testing.assert_array_equal(store.get(_song_key(1), 'beat_decibel', (), compute), values)
+    assert compute.calls == 1 and store.stats()['misses'] == 2
+    np.testing.assert_array_equal(store.get(_song_key(1), 'beat_decibel', (), Compute(None)), values)
+    assert store.stats()['hits'] == 1
@@ -0,0 +1,124 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """A test client with one request worker, fresh jobs and a song in the song store."""
+    monkeypatch.setattr(server, 'request_executor', server.BoundedExecutor(workers=1, max_queued=1))
+    monkeypatch.setattr(server, 'job_store', server.JobStore())
+    monkeypatch.setattr(server, 'song_store', server.SongStore())
+    song_id = server.song_store.put(np.zeros(22050, dtype=np.float32), 22050)
+    client = server.app.test_client()
+
+    def submit():
+        return client.post('/jobs', json={'model': 'random', 'song_id': song_id, 'difficulty': 'easy'})
+    return client, submit
+
+
+def _blocking_job(monkeypatch):
+    """Makes jobs report their beat tracking stage, then wait for the returned event before finishing."""
+    started, release = threading.Event(), threading.Event()
+
+    def map_song_job(data, song):
+        server.job_progress('beat track')
+        started.set()
+        while not release.wait(0.01):
+            server.job_progress()
+        return {'difficulty': data['difficulty']}
+    monkeypatch.setattr(server, 'map_song_job', map_song_job)
+    return started, release
+
+
+def _wait_for(client, job_id, statuses):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").get_json()['data']
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} never reached {statuses}")
+
+
+def test_job_runs_from_queued_to_done(monkeypatch, jobs):
+    client, submit = jobs
+    started, release = _blocking_job(monkeypatch)
+    response = submit()
+    assert response.status_code == 202
+    job_id = response.get_json()['data']['id']
+    assert response.headers['Location'] == f"/jobs/{job_id}"
+
+    assert started.wait(5)
+    job = client.get(f"/jobs/{job_id}").get_json()['data']
+    assert (job['status'], job['stage'], job['percent']) == ('running', 'beat track', server.JOB_STAGES['beat track'])
+    assert client.get(f"/jobs/{job_id}/result").status_code == 202
+
+    release.set()
+    job = _wait_for(client, job_id, {'done'})
+    assert (job['stage'], job['percent']) == ('done', 100)
+    response = client.get(f"/jobs/{job_id}/result")
+    assert response.status_code == 200
+    assert response.get_json()['data'] == {'difficulty': 'easy'}
+
+
+def test_job_cancelled_before_it_starts_never_runs(monkeypatch, jobs):
+    client, submit = jobs
+    started, release = _blocking_job(monkeypatch)
+    running_id = submit().get_json()['data']['id']
+    assert started.wait(5)
+    queued_id = submit().get_json()['data']['id']
+    assert client.get(f"/jobs/{queued_id}").get_json()['data']['status'] == 'queued'
+
+    assert client.post(f"/jobs/{queued_id}/cancel").get_json()['data']['status'] == 'cancelled'
+    assert client.get(f"/jobs/{queued_id}/result").status_code == 409
+    release.set()
+    _wait_for(client, running_id, {'done'})
+    job = client.get(f"/jobs/{queued_id}").get_json()['data']
+    assert (job['status'], job['started']) == ('cancelled', None)
+
+
+def test_running_job_stops_at_its_next_stage_once_cancelled(monkeypatch, jobs):
+    client, submit = jobs
+    started, _ = _blocking_job(monkeypatch)
+    job_id = submit().get_json()['data']['id']
+    assert started.wait(5)
+    client.post(f"/jobs/{job_id}/cancel")
+    job = _wait_for(client, job_id, {'cancelled'})
+    assert job['finished'] is not None
+    assert client.get(f"/jobs/{job_id}/result").status_code == 409
+
+
+def test_failed_job_reports_its_error(monkeypatch, jobs):
+    client, submit = jobs
+
+    def map_song_job(data, song):
+        raise ValueError('no beats')
+    monkeypatch.setattr(server, 'map_song_job', map_song_job)
+    job_id = submit().get_json()['data']['id']
+    job = _wait_for(client, job_id, {'failed'})
+    assert job['error'] == 'ValueError: no beats'
+    assert client.get(f"/jobs/{job_id}/result").status_code == 409
+
+
+def test_full_executor_answers_busy(monkeypatch, jobs):
+    client, submit = jobs
+    started, release = _blocking_job(monkeypatch)
+    assert submit().status_code == 202
+    assert started.wait(5)
+    assert submit().status_code == 202
+    response = submit()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(server.RETRY_AFTER_SECONDS)
+    release.set()
+
+
+def test_unknown_job_is_not_found(jobs):
+    client, _ = jobs
+    assert client.get('/jobs/unknown').status_code == 404
+    assert client.get('/jobs/unknown/result').status_code == 404
+    assert client.post('/jobs/unknown/cancel').status_code == 404
@@ -0,0 +1,47 @@
+import numpy as np
+
+import beatMapSynthServer as server
+
+
+def _level_data():
+    """A /run_models result with notes, events and obstacles, one difficulty having only empty arrays."""
+    notes = np.array([(0.5, 0, 1, 0, 1), (1.0, 3, 2, 1, 8), (1.25, 1, 0, 3, 5)], dtype=server.NOTE_DTYPE)
+    events = np.array([(0.0, 12, 3), (0.5, 4, 7), (1.0, 0, 0)], dtype=server.EVENT_DTYPE)
+    obstacles = np.array([(2.0, 0, 1, 1.5, 2)], dtype=server.OBSTACLE_DTYPE)
+    return {'analysis_seconds': 1.5,
+            'results': {'easy': {'data': notes, 'events': events, 'obstacles': obstacles,
+                                 'seconds': 0.25, 'error': None},
+                        'hard': {'data': np.empty(0, dtype=server.NOTE_DTYPE),
+                                 'events': np.empty(0, dtype=server.EVENT_DTYPE),
+                                 'obstacles': np.empty(0, dtype=server.OBSTACLE_DTYPE),
+                                 'seconds': 0.0, 'error': 'ValueError: no beats'}},
+            'beat_times': [0.0, 0.5, 1.0]}
+
+
+def test_binary_payload_round_trips():
+    data = _level_data()
+    unpacked = server.unpack_level_payload(server.pack_level_payload(data))
+    for difficulty, entry in data['results'].items():
+        for key in ['data', 'events', 'obstacles']:
+            assert unpacked['results'][difficulty][key].dtype == entry[key].dtype
+            np.testing.assert_array_equal(unpacked['results'][difficulty][key], entry[key])
+    assert server.map_records(unpacked, server.records_to_list) == server.map_records(data, server.records_to_list)
+
+
+def test_binary_response_matches_json_response():
+    data = _level_data()
+    with server.app.test_request_context(headers={'Accept': server.NOTES_BINARY}):
+        payload, status, headers = server.notes_response(data)
+    assert (status, headers['Content-Type']) == (200, server.NOTES_BINARY)
+    with server.app.test_request_context():
+        response = server.notes_response(data)
+    assert response.mimetype == server.NOTES_JSON
+    assert server.map_records(server.unpack_level_payload(payload), server.records_to_list) == \
+        response.get_json()['data']
+
+
+def test_bare_note_array_round_trips():
+    notes = np.array([(0.5, 2, 1, 1, 0)], dtype=server.NOTE_DTYPE)
+    np.testing.assert_array_equal(server.unpack_level_payload(server.pack_level_payload(notes)), notes)
+    empty = server.unpack_level_payload(server.pack_level_payload(notes[:0]))
+    assert empty.dtype == server.NOTE_DTYPE and len(empty) == 0
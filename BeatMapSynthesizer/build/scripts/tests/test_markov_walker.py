@@ -0,0 +1,38 @@
+import threading
+
+import markovify
+import pandas as pd
+
+import beatMapSynthServer as server
+
+# A training song of seven distinct steps, in the models' note token format
+SONG = [','.join([str(i)] * 12) for i in range(7)]
+
+
+def _run(fn, timeout=10):
+    """Runs fn in a daemon thread, failing instead of hanging if it never returns."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'walk did not finish'
+    return result[0]
+
+
+def test_walk_returns_exactly_n_tokens():
+    walker = server.MarkovWalker(markovify.Chain([SONG, SONG[:2] + SONG[3:]], 2))
+    for n in (0, 1, 5, 100):
+        assert len(walker.walk(n)) == n
+
+
+def test_walk_from_end_only_state():
+    walker = server.MarkovWalker(markovify.Chain([SONG], 2))
+    walk = _run(lambda: walker.walk(3, init_state=SONG[-2:]))
+    assert walk == SONG[:3]
+
+
+def test_segment_predictions_continue_from_song_tail():
+    walker = server.MarkovWalker(markovify.Chain([SONG], 2))
+    segments = pd.DataFrame({'length': [7, 3], 'seg_no': [0, 1]})
+    preds = _run(lambda: server.segment_predictions(segments, walker))
+    assert len(preds) == 10
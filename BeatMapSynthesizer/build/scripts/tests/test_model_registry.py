@@ -0,0 +1,48 @@
+import pickle
+import threading
+
+import markovify
+
+import beatMapSynthServer as server
+
+
+def _write_models(temp_dir, difficulties):
+    (temp_dir / 'models').mkdir()
+    for difficulty in difficulties:
+        with open(server.ModelRegistry.model_path(temp_dir, difficulty, 1), 'wb') as f:
+            pickle.dump(markovify.Chain([list('abcdefg')], 2), f)
+
+
+def test_get_reuses_loaded_model(tmp_path):
+    _write_models(tmp_path, ['easy'])
+    registry = server.ModelRegistry()
+    assert registry.get(tmp_path, 'easy', 1) is registry.get(tmp_path, 'easy', 1)
+    [entry] = registry.stats()
+    assert (entry['loads'], entry['hits']) == (1, 1)
+
+
+def test_load_does_not_block_registry(tmp_path, monkeypatch):
+    _write_models(tmp_path, ['easy', 'expert'])
+    registry = server.ModelRegistry()
+    loading, release = threading.Event(), threading.Event()
+    load = pickle.load
+
+    def slow_load(f):
+        if 'easy' in f.name:
+            loading.set()
+            release.wait(10)
+        return load(f)
+
+    monkeypatch.setattr(server.pickle, 'load', slow_load)
+    easy = threading.Thread(target=registry.get, args=(tmp_path, 'easy', 1), daemon=True)
+    easy.start()
+    assert loading.wait(10)
+    try:
+        # Neither the stats nor another model wait for the easy model to unpickle
+        assert registry.stats() == []
+        registry.get(tmp_path, 'expert', 1)
+        assert [entry['difficulty'] for entry in registry.stats()] == ['expert']
+    finally:
+        release.set()
+    easy.join(10)
+    assert sorted(entry['difficulty'] for entry in registry.stats()) == ['easy', 'expert']
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+
+
+def _old_events(notes_list, bpm, event_color_swap_offset):
+    """The events written by the client's getEventsList before they moved to the server."""
+    events_list = [{'_time': 0, '_type': 4, '_value': 0}]
+    event_values = {'Normal': [5, 1], 'FadeIn': [6, 2], 'FadeOut': [7, 3]}
+    last_event_time = 0
+    last_event_color = 0
+    last_event_intensity = 'Off'
+    last_event_ring = 0
+    # Math.round rounds halves up
+    event_color_swap_interval = math.floor(bpm / 60 + 0.5) * event_color_swap_offset
+    for i, note in enumerate(notes_list):
+        if i == len(notes_list) - 1 or i == 0:
+            events_list.append({'_time': note['_time'], '_type': 4, '_value': 0})
+        elif note['_time'] - last_event_time > event_color_swap_interval:
+            if last_event_intensity in ('Off', 'FadeOut'):
+                intensity = 'FadeIn'
+                color = 0 if last_event_color == 1 else 1
+            elif last_event_intensity == 'FadeIn':
+                intensity = 'Normal'
+                color = last_event_color
+            else:
+                intensity = 'FadeOut'
+                color = last_event_color
+            events_list.append({'_time': note['_time'], '_type': 4, '_value': event_values[intensity][color]})
+            last_event_time = note['_time']
+            last_event_color = color
+            last_event_intensity = intensity
+        if last_event_ring > 2:
+            last_event_ring = 0
+        events_list.append({'_time': note['_time'], '_type': [8, 9][1 if last_event_ring > 0 else 0], '_value': 0})
+        last_event_ring += 1
+        if note['_type'] != 3:
+            events_list.append({'_time': note['_time'], '_type': 1, '_value': event_values['Normal'][note['_type']]})
+    return events_list
+
+
+def _notes(times, types):
+    notes = np.zeros(len(times), dtype=server.NOTE_DTYPE)
+    notes['_time'] = times
+    notes['_type'] = types
+    return notes
+
+
+# Red, blue and bomb notes with repeated times, at a bpm whose beats per second round half up
+NOTES = _notes([0.5, 1.0, 1.0, 2.0, 4.5, 5.0, 7.5, 8.0, 8.0, 11.0, 12.5, 13.0, 16.0, 19.5, 20.0],
+               [0, 1, 3, 0, 1, 1, 0, 3, 1, 0, 1, 0, 1, 3, 0])
+
+
+@pytest.mark.parametrize('bpm, offset', [(150, 1), (120, 2.5), (90, 0.5), (60, 20)])
+def test_note_events_match_the_old_events_list(bpm, offset):
+    events = server.records_to_list(server.note_events(NOTES, bpm, offset))
+    assert events == _old_events(server.records_to_list(NOTES), bpm, offset)
+
+
+@pytest.mark.parametrize('n', [1, 2])
+def test_note_events_of_a_few_notes_match_the_old_events_list(n):
+    events = server.records_to_list(server.note_events(NOTES[:n], 120))
+    assert events == _old_events(server.records_to_list(NOTES[:n]), 120, server.EVENT_COLOR_SWAP_OFFSET)
+
+
+def test_lights_swap_through_the_color_cycle():
+    notes = _notes(np.arange(10.0) * 10, 0)
+    events = server.note_events(notes, 60, 1)
+    lights = events[events['_type'] == server.EVENT_LIGHTS]
+    assert lights['_time'].tolist() == notes['_time'][[0, 0] + list(range(1, 10))].tolist()
+    # Off at the start and the first note, then flash, on and fade in blue and then red, until the last note
+    assert lights['_value'].tolist() == [0, 0, 2, 1, 3, 6, 5, 7, 2, 1, 0]
+
+
+def test_note_events_without_lights_only_turn_them_off_at_the_start():
+    events = server.note_events(NOTES, 120, lights=False)
+    old = [event for i, event in enumerate(_old_events(server.records_to_list(NOTES), 120, 2.5))
+           if event['_type'] != server.EVENT_LIGHTS or i == 0]
+    assert server.records_to_list(events) == old
+    assert np.all(np.diff(events['_time']) >= 0)
+
+
+def test_note_events_of_no_notes_raise():
+    with pytest.raises(ValueError):
+        server.note_events(NOTES[:0], 120)
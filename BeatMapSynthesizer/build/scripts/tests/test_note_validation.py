@@ -0,0 +1,139 @@
+import copy
+
+import numpy as np
+
+import beatMapSynthServer as server
+
+cut_dirs = server.Notes.cut_dirs
+line_indices = server.Notes.line_indices
+line_layers = server.Notes.line_layers
+
+
+def _old_remove_bad_notes(notes_list, bpm, coins, picks):
+    """
+    The note validation loop from before the rule tables, on note dictionaries.
+    Its np.random.choice draws are replaced by coins and picks, drawn like validate_notes draws them,
+    and a note at the same time and of the same color as the previous note is dropped
+    (the old notes_list.pop(i) assignment replaced the whole list instead).
+    """
+    def seconds(number):
+        return round(bpm / 60) * number
+
+    def remove_zeros(number, limit):
+        while number > limit and number % 10 == 0:
+            number //= 10
+        return number
+
+    notes_list = [note for note in notes_list if note['_time'] >= seconds(2)]
+    for note in notes_list:
+        note['_lineIndex'] = remove_zeros(note['_lineIndex'], line_indices.Col4)
+        note['_lineLayer'] = remove_zeros(note['_lineLayer'], line_layers.Top)
+        note['_cutDirection'] = remove_zeros(note['_cutDirection'], cut_dirs.Dot)
+    notes_list = [note for note in notes_list
+                  if note['_lineIndex'] in server.Notes.validColumns and note['_lineLayer'] in server.Notes.validRows
+                  and note['_cutDirection'] in server.Notes.validCutDirs]
+    coins, picks = coins(len(notes_list)), picks(len(notes_list))
+
+    oppositeCutDir = {cut_dirs.Up: cut_dirs.Down, cut_dirs.UpRight: cut_dirs.DownLeft,
+                      cut_dirs.Right: cut_dirs.Left, cut_dirs.DownRight: cut_dirs.UpLeft,
+                      cut_dirs.Down: cut_dirs.Up, cut_dirs.DownLeft: cut_dirs.UpRight,
+                      cut_dirs.Left: cut_dirs.Right, cut_dirs.UpLeft: cut_dirs.DownRight}
+    oppositeIndices = {line_indices.Col1: [line_indices.Col2, line_indices.Col3],
+                       line_indices.Col2: [line_indices.Col1, line_indices.Col3, line_indices.Col4],
+                       line_indices.Col3: [line_indices.Col1, line_indices.Col2, line_indices.Col4],
+                       line_indices.Col4: [line_indices.Col2, line_indices.Col3]}
+    oppositeLayers = {line_layers.Bottom: [line_layers.Middle, line_layers.Top],
+                      line_layers.Middle: [line_layers.Bottom, line_layers.Top],
+                      line_layers.Top: [line_layers.Bottom, line_layers.Middle]}
+
+    validated = notes_list[:1]
+    lastNote = notes_list[0] if notes_list else None
+    for i in range(1, len(notes_list)):
+        note = notes_list[i]
+        if note['_cutDirection'] != cut_dirs.Dot and note['_type'] != 3 and lastNote['_time'] - note['_time'] < seconds(1.5):
+            if (lastNote['_cutDirection'] != cut_dirs.Dot and note['_cutDirection'] != oppositeCutDir[lastNote['_cutDirection']] and
+                    note['_type'] == lastNote['_type']):
+                note['_cutDirection'] = oppositeCutDir[lastNote['_cutDirection']]
+
+            if (note['_lineIndex'] not in oppositeIndices[lastNote['_lineIndex']] and
+                    note['_lineLayer'] not in oppositeLayers[lastNote['_lineLayer']] and
+                    note['_type'] != lastNote['_type']):
+                if coins[i]:
+                    options = oppositeIndices[lastNote['_lineIndex']]
+                    note['_lineIndex'] = options[picks[i] % len(options)]
+                else:
+                    options = oppositeLayers[lastNote['_lineLayer']]
+                    note['_lineLayer'] = options[picks[i] % len(options)]
+
+            if note['_time'] == lastNote['_time']:
+                if note['_type'] == lastNote['_type']:
+                    continue
+                if note['_lineIndex'] == lastNote['_lineIndex']:
+                    if note['_lineIndex'] in [line_indices.Col2, line_indices.Col3]:
+                        note['_cutDirection'] = lastNote['_cutDirection'] = cut_dirs.Dot
+                    elif note['_lineIndex'] == line_indices.Col1:
+                        note['_cutDirection'] = lastNote['_cutDirection'] = cut_dirs.Left
+                        if note['_type'] == 0 and note['_lineLayer'] < lastNote['_lineLayer']:
+                            lastNote['_lineLayer'] = note['_lineLayer']
+                            note['_lineLayer'] = lastNote['_lineLayer']
+                    elif note['_lineIndex'] == line_indices.Col4:
+                        note['_cutDirection'] = lastNote['_cutDirection'] = cut_dirs.Right
+                        if note['_type'] == 0 and note['_lineLayer'] > lastNote['_lineLayer']:
+                            lastNote['_lineLayer'] = note['_lineLayer']
+                            note['_lineLayer'] = lastNote['_lineLayer']
+                elif note['_lineLayer'] == lastNote['_lineLayer']:
+                    if note['_lineLayer'] in [line_layers.Bottom, line_layers.Middle]:
+                        note['_cutDirection'] = lastNote['_cutDirection'] = cut_dirs.Down
+                    elif note['_lineLayer'] == line_layers.Top:
+                        note['_cutDirection'] = lastNote['_cutDirection'] = cut_dirs.Up
+
+            if (note['_lineLayer'] == line_layers.Top and note['_lineIndex'] in [line_indices.Col2, line_indices.Col3]
+                    and lastNote['_cutDirection'] != cut_dirs.Up):
+                note['_cutDirection'] = cut_dirs.Up
+            elif (note['_lineLayer'] == line_layers.Top and note['_lineIndex'] == line_indices.Col1
+                    and lastNote['_cutDirection'] != cut_dirs.UpLeft):
+                note['_cutDirection'] = cut_dirs.UpLeft
+            elif (note['_lineLayer'] == line_layers.Top and note['_lineIndex'] == line_indices.Col2
+                    and lastNote['_cutDirection'] != cut_dirs.UpRight):
+                note['_cutDirection'] = cut_dirs.UpRight
+            elif note['_lineIndex'] == line_indices.Col1 and lastNote['_cutDirection'] != cut_dirs.Left:
+                note['_cutDirection'] = cut_dirs.Left
+            elif note['_lineIndex'] == line_indices.Col4 and lastNote['_cutDirection'] != cut_dirs.Right:
+                note['_cutDirection'] = cut_dirs.Right
+
+        validated.append(note)
+        lastNote = note
+    return validated
+
+
+def _random_notes(rng, n):
+    # Few distinct times so that notes often share one, and some out of range values with trailing zeros
+    times = np.sort(rng.integers(0, n // 2 + 1, size=n)) * 0.5
+    return [{'_time': float(time),
+             '_lineIndex': int(rng.choice([0, 1, 2, 3, 10, 20, 30, 5])),
+             '_lineLayer': int(rng.choice([0, 1, 2, 10, 20, 3])),
+             '_type': int(rng.choice([0, 1, 0, 1, 3])),
+             '_cutDirection': int(rng.choice([0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 80, 9]))}
+            for time in times]
+
+
+def test_validate_notes_matches_old_rules():
+    for seed in range(600):
+        rng = np.random.default_rng(seed)
+        notes_list = _random_notes(rng, int(rng.integers(1, 200)))
+        bpm = float(rng.uniform(60, 200))
+        draws = np.random.default_rng(seed)
+        expected = _old_remove_bad_notes(copy.deepcopy(notes_list), bpm,
+                                         lambda n: draws.integers(0, 2, size=n).tolist(),
+                                         lambda n: draws.integers(0, 6, size=n).tolist())
+        assert server.remove_bad_notes(notes_list, bpm, np.random.default_rng(seed)) == expected, seed
+
+
+def test_same_time_same_color_note_is_dropped():
+    notes = [{'_time': 4.0, '_lineIndex': 1, '_lineLayer': 0, '_type': 0, '_cutDirection': 1},
+             {'_time': 4.0, '_lineIndex': 2, '_lineLayer': 0, '_type': 0, '_cutDirection': 1},
+             {'_time': 5.0, '_lineIndex': 2, '_lineLayer': 0, '_type': 0, '_cutDirection': 1}]
+    validated = server.remove_bad_notes(notes, 60, np.random.default_rng(0))
+    assert [note['_time'] for note in validated] == [4.0, 5.0]
+    # The note after the dropped one alternates with the kept note
+    assert validated[1]['_cutDirection'] == cut_dirs.Up
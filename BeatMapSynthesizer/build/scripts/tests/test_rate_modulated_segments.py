@@ -0,0 +1,49 @@
+from itertools import groupby
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import beatMapSynthServer as server
+import benchmark
+
+
+def _old_beat_segments(segments, modulated_beat_list):
+    """The segment of every modulated beat, as the old loop compared every segment with every beat."""
+    return [x[2] for x in segments for y in modulated_beat_list if y > x[1][0] and y <= x[1][1]]
+
+
+def _old_modulated_beat_times(beat_times, tempo, modulated_beat_list):
+    """The writer's old outer merge of the whole beats with the modulated beats, interpolated by pandas."""
+    beat_times = [(x/60) * tempo for x in beat_times]
+    beats = pd.concat([pd.Series(beat_times, name='_time'),
+                       pd.Series(list(range(len(beat_times))), name='beat_count')], axis=1)
+    beats = beats[beats['beat_count'].isin(modulated_beat_list)].astype('float64')
+    merged_beats = pd.merge(left=beats, right=pd.Series(modulated_beat_list, name='beat_count').astype('float64'),
+                            how='outer', on='beat_count', sort=True)
+    return merged_beats.interpolate()['_time'].to_numpy()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_segment_lengths_count_every_run_in_full(seed):
+    beat_times, segments, modulated_beats = benchmark.synthetic_rate_modulated_beats(3, seed=seed)
+    df = server.segments_to_data_frame_rate_modulated(segments, modulated_beats)
+    expected = [(seg_no, len(list(run))) for seg_no, run in groupby(_old_beat_segments(segments, modulated_beats))]
+    assert list(zip(df['seg_no'], df['length'])) == expected
+
+
+def test_segment_lengths_keep_single_beat_runs_and_the_last_segment():
+    segments = [((0, 0), (0, 4), 0), ((0, 0), (4, 5), 1), ((0, 0), (5, 8), 2)]
+    modulated_beats = [0, 1, 1.5, 2, 3, 4, 5, 6, 7, 7.5, 8]
+    df = server.segments_to_data_frame_rate_modulated(segments, modulated_beats)
+    assert df['seg_no'].tolist() == [0, 1, 2]
+    # Beat 0 is in no segment, every later beat is in exactly one
+    assert df['length'].tolist() == [5, 1, 4]
+    assert df['length'].sum() == len(modulated_beats) - 1
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_modulated_beat_times_match_old_interpolation(seed):
+    beat_times, _, modulated_beats = benchmark.synthetic_rate_modulated_beats(2, seed=seed)
+    np.testing.assert_allclose(server.modulated_beat_times(beat_times, 120, modulated_beats),
+                               _old_modulated_beat_times(beat_times, 120, modulated_beats))
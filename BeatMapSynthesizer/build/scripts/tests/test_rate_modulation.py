@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+
+
+def _old_rate_level(decibel):
+    if decibel > 70:
+        return 4
+    elif decibel <= 70 and decibel > 55:
+        return 3
+    elif decibel <= 55 and decibel > 45:
+        return 2
+    elif decibel <= 45 and decibel > 35:
+        return 1
+    else:
+        return 0
+
+
+def _old_maxdiff(difficulty):
+    if difficulty == 'expert':
+        return 4
+    elif difficulty == 'expertplus':
+        return 8
+    return 2
+
+
+def _old_beat_numbers(rates):
+    beat_num_list = []
+    for ind, val in enumerate(rates):
+        if val == 0:
+            continue
+        elif val == 1:
+            beat_num_list.append(ind)
+        else:
+            num_list = [ind, ind+1]
+            for x in range(1, val):
+                num_list.append(ind+(x/val))
+            for y in num_list:
+                beat_num_list.append(y)
+    beat_num_list = list(set(beat_num_list))
+    beat_num_list.sort()
+    return beat_num_list
+
+
+def _old_rate_frequencies(difficulty, level, last_rate, rng, n=4000, max_draws=50):
+    """
+    Frequencies of the rates chosen by the old loop: draw from the level's probabilities until the rate is
+    within the difficulty's maximum change of the last rate, then replace a second 4 by 0, 1 or 2.
+    The old retries compared the signed change, letting rises past the limit through,
+    the limit applies both ways here as it did on the first draw.
+    """
+    p = server.RATE_PROBABILITIES[difficulty][level]
+    maxdiff = _old_maxdiff(difficulty)
+    draws = server.RATES[rng.choice(len(server.RATES), size=(n, max_draws), p=p)]
+    allowed = np.abs(draws - last_rate) <= maxdiff
+    rates = draws[np.arange(n), np.argmax(allowed, axis=1)]
+    if last_rate == 4:
+        rates = np.where(rates == 4, rng.choice([0, 1, 2], size=n), rates)
+    return (rates[:, None] == server.RATES).mean(axis=0)
+
+
+@pytest.mark.parametrize('difficulty', list(server.RATE_PROBABILITIES))
+def test_transition_tables_match_old_rejection_loop(difficulty):
+    rng = np.random.default_rng(0)
+    maxdiff = _old_maxdiff(difficulty)
+    table = np.asarray(server.RATE_TRANSITION_TABLES[difficulty])
+    for level, p in enumerate(server.RATE_PROBABILITIES[difficulty]):
+        for last, last_rate in enumerate(server.RATES):
+            if not np.dot(p, np.abs(server.RATES - last_rate) <= maxdiff):
+                # The old loop never ended here
+                continue
+            expected = _old_rate_frequencies(difficulty, level, last_rate, rng)
+            np.testing.assert_allclose(np.diff(np.r_[0, table[level, last]]), expected, atol=0.03)
+
+
+def test_transition_without_allowed_rate_picks_closest_to_mean_rate():
+    # After a 16, expert+'s loudest level can only place 1, 2 or 4 blocks, all more than 8 away
+    table = server.RATE_TRANSITION_TABLES['expertplus'][4][list(server.RATES).index(16)]
+    assert np.diff(np.r_[0, table]).tolist() == [0, 0, 0, 0, 1, 0]
+
+
+@pytest.mark.parametrize('difficulty', list(server.RATE_PROBABILITIES))
+def test_chosen_rates_follow_the_rules(difficulty):
+    rng = np.random.default_rng(1)
+    maxdiff = _old_maxdiff(difficulty)
+    levels = rng.integers(0, 5, size=5000)
+    rates = np.r_[0, server.choose_rates(levels, difficulty, rng)]
+    assert np.isin(rates, server.RATES).all()
+    assert (np.abs(np.diff(rates)) <= maxdiff).all()
+    assert not ((rates[1:] == 4) & (rates[:-1] == 4)).any()
+
+
+def test_rate_levels_match_old_levels():
+    decibels = np.r_[-80, 0, 35, 35.001, 45, 45.5, 55, 60, 70, 70.5, 80, np.random.default_rng(2).uniform(-90, 0, 200)]
+    expected = [_old_rate_level(np.abs(np.mean(decibels[i - 1:i + 2]))) for i in range(1, len(decibels) - 1)]
+    assert server.rate_levels(decibels).tolist() == expected
+
+
+def test_beat_numbers_match_old_beat_numbers():
+    rates = np.r_[0, np.random.default_rng(3).choice(server.RATES, size=500)]
+    assert server.rates_to_beat_numbers(rates).tolist() == _old_beat_numbers(rates.tolist())
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+
+
+def test_negative_seed_maps_like_its_reduced_seed():
+    seed = server.normalize_seed(-1)
+    assert seed == 2**32 - 1
+    a = server.notes_rng(seed, 'Expert').random(8)
+    b = server.notes_rng(server.normalize_seed(2**32 - 1), 'expert').random(8)
+    np.testing.assert_array_equal(a, b)
+
+
+def test_seed_is_normalized_before_keying_the_notes_cache(tmp_path):
+    y = np.zeros(22050, dtype=np.float32)
+    key = server._notes_key('random', str(tmp_path), 'easy', 1, y, 22050, server.normalize_seed(np.int64(7)))
+    assert key == server._notes_key('random', str(tmp_path), 'easy', 1, y, 22050, 7)
+
+
+@pytest.mark.parametrize('seed', [1.5, '7', True, [7]])
+def test_non_integer_seeds_are_rejected(seed):
+    with pytest.raises(ValueError):
+        server.normalize_seed(seed)
+
+
+@pytest.mark.parametrize('seed', [1.5, '7'])
+def test_request_with_non_integer_seed_is_a_bad_request(seed):
+    response = server.app.test_client().post('/jobs', json={'model': 'random', 'song_id': 'unknown', 'seed': seed})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'INVALID SEED'
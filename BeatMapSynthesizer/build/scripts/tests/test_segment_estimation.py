@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import beatMapSynthServer as server
+import benchmark
+
+
+def _features(tmp_path, kind, bpm):
+    path = str(tmp_path / f'{kind}.wav')
+    benchmark.synthetic_track(path, kind, 0.5, bpm=bpm, sr=22050, section_beats=8)
+    y, sr = server.load_audio(path)
+    return server.SongFeatures(y, sr, cache=server.FeatureCache(), store=server.FeatureStore(None))
+
+
+@pytest.mark.parametrize('kind, bpm', [('click', 90), ('chirp', 110), ('noise', 128)])
+def test_fast_estimation_matches_exhaustive(tmp_path, kind, bpm):
+    features = _features(tmp_path, kind, bpm)
+    data = server.sklearn.preprocessing.MinMaxScaler().fit_transform(features.melspectrogram_db())
+    K = range(*server.K_RANGE)
+    exhaustive = server._exhaustive_inertias(data, K)
+    np.testing.assert_allclose(server._fast_inertias(data, K, 1), exhaustive, rtol=1e-4)
+    np.testing.assert_allclose(server._fast_inertias(data, K, 2), exhaustive, rtol=1e-4)
+    assert (server.estimate_segments(features, estimation='fast') ==
+            server.estimate_segments(features, estimation='exhaustive') == server.select_k(exhaustive))
@@ -0,0 +1,36 @@
+import pytest
+
+import beatMapSynthServer as server
+import benchmark
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, 'request_executor', server.BoundedExecutor())
+    monkeypatch.setattr(server, 'song_store', server.SongStore())
+    monkeypatch.setattr(server, 'feature_cache', server.FeatureCache())
+    monkeypatch.setattr(server, 'feature_store', server.FeatureStore(None))
+    return server.app.test_client()
+
+
+def test_segment_song_is_reused_by_the_models(client, tmp_path, monkeypatch):
+    path = str(tmp_path / 'song.wav')
+    benchmark.synthetic_track(path, 'chirp', 0.5, bpm=110, sr=22050, section_beats=8)
+    y, sr = server.load_audio(path)
+    song_id = server.song_store.put(y, sr)
+
+    response = client.post('/segment_song', json={'song_id': song_id})
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert data['segments'][0]['start_beat'] == 0
+    assert all(a['end_beat'] == b['start_beat'] for a, b in zip(data['segments'], data['segments'][1:]))
+
+    def recompute(*args):
+        raise AssertionError('The segmentation was computed again')
+    monkeypatch.setattr(server, '_laplacian_segmentation', recompute)
+    segments, beat_times, tempo = server.laplacian_segmentation(y, sr)
+    assert server.segments_to_json(segments, beat_times, tempo) == data
+
+
+def test_segment_song_of_an_unknown_song_is_not_found(client):
+    assert client.post('/segment_song', json={'song_id': 'unknown'}).status_code == 404
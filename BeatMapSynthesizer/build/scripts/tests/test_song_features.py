@@ -0,0 +1,47 @@
+import numpy as np
+
+import beatMapSynthServer as server
+
+SR = 22050
+
+
+def _click_track(seconds=30, bpm=120, seed=0):
+    rng = np.random.default_rng(seed)
+    beats = np.arange(0, seconds, 60 / bpm)
+    y = server.librosa.clicks(times=beats, sr=SR, click_freq=880.0, length=seconds * SR)
+    return (y + 0.01 * rng.standard_normal(len(y))).astype(np.float32)
+
+
+def _features(y, streaming):
+    features = server.SongFeatures(y, SR, cache=server.FeatureCache(), store=server.FeatureStore(None))
+    features.streaming = streaming
+    return features
+
+
+def test_streaming_beat_cqt_matches_full_analysis(monkeypatch):
+    # Small blocks, so that the streaming analysis spans several of them
+    monkeypatch.setattr(server, 'ANALYSIS_MEMORY_LIMIT', 16 * 1024 * 1024)
+    y = _click_track()
+    full, streaming = _features(y, False), _features(y, True)
+    # Both analyses sync on the same beats
+    streaming.cache.put((streaming.key, 'beat_track'), full.beat_track())
+    n_beats = len(full.beat_bounds()) - 1
+
+    C_full = full.beat_cqt_db(server.BINS_PER_OCTAVE, server.N_OCTAVES * server.BINS_PER_OCTAVE)
+    C_streaming = streaming.beat_cqt_db(server.BINS_PER_OCTAVE, server.N_OCTAVES * server.BINS_PER_OCTAVE)
+    assert C_full.shape == C_streaming.shape == (server.N_OCTAVES * server.BINS_PER_OCTAVE, n_beats)
+    np.testing.assert_allclose(C_streaming, C_full, atol=1e-3)
+    assert full.beat_decibel().shape == streaming.beat_decibel().shape == (n_beats,)
+
+
+def test_beat_cqt_ignores_frames_past_the_song(monkeypatch):
+    cqt_db = server.SongFeatures.cqt_db
+
+    def cqt_db_extra_frame(self, bins_per_octave, n_bins):
+        C = cqt_db(self, bins_per_octave, n_bins)
+        return np.concatenate([C, C[:, -1:]], axis=1)
+
+    monkeypatch.setattr(server.SongFeatures, 'cqt_db', cqt_db_extra_frame)
+    features = _features(_click_track(), False)
+    C = features.beat_cqt_db(server.BINS_PER_OCTAVE, server.N_OCTAVES * server.BINS_PER_OCTAVE)
+    assert C.shape[1] == len(features.beat_bounds()) - 1
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+import beatMapSynthServer as server
+
+
+def _song(seconds=1, sr=22050):
+    return np.random.default_rng(0).standard_normal(seconds * sr).astype(np.float32), sr
+
+
+def test_npy_file_deleted_on_release(monkeypatch):
+    monkeypatch.setattr(server, 'song_store', server.SongStore())
+    y, sr = _song()
+    song_id = server.song_store.put(y, sr)
+    npy_path = server.encode_waveform(y, 'npy', song_id)
+    assert os.path.exists(npy_path)
+    resolved = server.resolve_song({'y': npy_path, 'y_format': 'npy', 'sr': sr})
+    np.testing.assert_array_equal(resolved[0], y)
+    assert server.song_store.release(song_id)
+    assert not os.path.exists(npy_path)
+    assert server.resolve_song({'y': npy_path, 'y_format': 'npy', 'sr': sr}) is None
+
+
+def test_npy_file_deleted_on_eviction(monkeypatch):
+    monkeypatch.setattr(server, 'song_store', server.SongStore(max_songs=1))
+    y, sr = _song()
+    song_id = server.song_store.put(y, sr)
+    npy_path = server.encode_waveform(y, 'npy', song_id)
+    server.song_store.put(y, sr)
+    assert server.song_store.get(song_id) is None
+    assert not os.path.exists(npy_path)
+
+
+def test_npy_paths_not_saved_by_the_server_are_refused(monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'song_store', server.SongStore())
+    y, sr = _song()
+    server.song_store.put(y, sr)
+    npy_path = str(tmp_path / 'song.npy')
+    np.save(npy_path, y)
+    assert server.resolve_song({'y': npy_path, 'y_format': 'npy', 'sr': sr}) is None
@@ -15,7 +15,9 @@ export const pythonRequest = async (url: string = '', data?: Record<string, unkn
   }
   const response = await fetch(`http://127.0.0.1:5000/${url}`, options);
   if (response.ok) {
-    return options.method === 'GET' || url === 'convert_music_file' ? await response.text() : await response.json();
+    return (options.method === 'GET' && !url.startsWith('jobs/') && url !== 'ping') || url === 'convert_music_file' || url === 'release_song'
+      ? await response.text()
+      : await response.json();
   }
   return new Error(response.statusText);
 };
@@ -32,10 +34,40 @@ interface PythonResponseData<T> {
   data: T;
 }
 
+export interface ServerStatus {
+  phase: 'starting' | 'importing' | 'warming up' | 'loading models' | 'ready';
+  ready: boolean;
+}
+export const getServerStatus = (): Promise<PythonResponseData<ServerStatus>> => pythonRequest('ping');
+/**
+ * Waits until the server answers, it accepts requests from then on
+ * and runs them faster once its status is ready (libraries and models warm).
+ */
+export const waitForPythonServer = async (
+  onStatus?: (status: ServerStatus) => void,
+  pollInterval: number = 100,
+  timeout: number = 30000
+) => {
+  const start = Date.now();
+  while (Date.now() - start < timeout) {
+    try {
+      const status: ServerStatus | undefined = (await getServerStatus()).data;
+      if (status) {
+        onStatus && onStatus(status);
+        return true;
+      }
+    } catch (e) {
+      // Not listening yet
+    }
+    await new Promise(resolve => setTimeout(resolve, pollInterval));
+  }
+  return false;
+};
+
 export interface BeatFeatures {
   bpm: number;
   beat_times: number[];
-  y: number[];
+  song_id: string;
   sr: number;
 }
 export const getBeatFeatures = (song_path: string): Promise<PythonResponseData<BeatFeatures>> =>
@@ -46,151 +78,95 @@ export const getNotesList = (args: {
   beat_times: number[];
   bpm: number;
   version: number;
-  y: number[];
-  sr: number;
+  song_id: string;
   tempDir: string;
-}): Promise<PythonResponseData<Notes[]>> => pythonRequest('run_model', args);
-
+  seed?: number;
+  level?: LevelOptions;
+}): Promise<PythonResponseData<Notes[] | Level>> => pythonRequest('run_model', args);
 /**
- * Function for writing a list of events.
- * @param args
- * @returns event_list
+ * Asks the server for the events and obstacles along with the notes, 'lights' are derived
+ * from the notes (default) or from the song's loudness and segments ('audio').
  */
-export const getEventsList = (args: { eventColorSwapOffset: number; notes_list: Notes[]; bpm: number }): Events[] => {
-  const { eventColorSwapOffset, notes_list, bpm } = args;
-  // Set an event to be at time 0
-  let events_list: Events[] = [{ _time: 0, _type: 4, _value: 0 }];
-
-  /**
-   * _type
-   *  0 : Back Laser
-   *  1 : Track Neons
-   *  2 : Left Laser
-   *  3 : Right Laser
-   *  4 : Primary Light
-   *  5 :
-   *  6 :
-   *  7 :
-   *  8 : Ring Rotation (uses value of 0, swaps rotation each time)
-   *  9 : Small Ring Zoom (uses value of 0, zooms in/out if it is zoomed out/in)
-   * 10 :
-   * 11 :
-   * 12 : Left Laser Speed (value is 0-12, higher value = higher speed)
-   * 13 : Right Laser Speed (value is 0-12, higher value = higher speed)
-   */
-  const eventTypes = {
-    Lights: 4,
-    Lasers: [0, 1, 2, 3],
-    Rings: [8, 9],
-    Speeds: [12, 13],
-  };
-
-  /**
-   * _value
-   * 0 : Off
-   * 1 : Blue Normal
-   * 2 : Blue Fade In
-   * 3 : Blue Fade Out
-   * 4 :
-   * 5 : Red Normal
-   * 6 : Red Fade In
-   * 7 : Red Fade Out
-   */
-  const eventValues = {
-    Off: 0,
-    Normal: [5, 1],
-    FadeIn: [6, 2],
-    FadeOut: [7, 3],
-  };
-
-  let lastEventTime = 0;
-  let lastEventColor = 0;
-  let lastEventIntensity = 'Off';
-  let lastEventRing = 0;
-  // Offset is applied to change the lighting every n'th second
-  const eventColorSwapInterval = Math.round(bpm / 60) * eventColorSwapOffset;
-
-  if (!notes_list || notes_list.length === 0) {
-    throw new Error('Notes list is empty!');
+export interface LevelOptions {
+  lights?: 'notes' | 'audio';
+  color_swap_offset?: number;
+}
+export interface Level {
+  notes: Notes[];
+  events: Events[];
+  obstacles: Obstacles[];
+}
+export interface DifficultyNotes {
+  data: Notes[] | null;
+  events?: Events[] | null;
+  obstacles?: Obstacles[] | null;
+  seconds: number;
+  error: string | null;
+}
+export interface NotesLists {
+  analysis_seconds: number;
+  results: Record<string, DifficultyNotes>;
+}
+export const getNotesLists = (args: {
+  model: string;
+  difficulties: string[];
+  beat_times: number[];
+  bpm: number;
+  version: number;
+  song_id: string;
+  tempDir: string;
+  seed?: number;
+  level?: LevelOptions;
+}): Promise<PythonResponseData<NotesLists>> => pythonRequest('run_models', args);
+export interface JobStatus {
+  id: string;
+  status: 'queued' | 'running' | 'done' | 'failed' | 'cancelled';
+  stage: string;
+  percent: number;
+  error: string | null;
+}
+export const getJob = (job_id: string): Promise<PythonResponseData<JobStatus>> => pythonRequest(`jobs/${job_id}`);
+export const cancelJob = (job_id: string): Promise<PythonResponseData<JobStatus>> =>
+  pythonRequest(`jobs/${job_id}/cancel`, {});
+/**
+ * Maps the difficulties of a song as a server-side job, polling it until it finishes
+ * instead of holding a request open for the whole model run.
+ * @param args same as getNotesLists
+ * @param onProgress called with the job status after every poll
+ * @param pollInterval milliseconds between polls
+ * @returns the notes lists, like getNotesLists
+ */
+export const runNotesListsJob = async (
+  args: Parameters<typeof getNotesLists>[0],
+  onProgress?: (job: JobStatus) => void,
+  pollInterval: number = 1000
+): Promise<PythonResponseData<NotesLists>> => {
+  let job: JobStatus | undefined = (await pythonRequest('jobs', args)).data;
+  if (!job) {
+    throw new Error('Mapping job was not accepted!');
   }
-
-  const firstNote = notes_list[0];
-  const lastNote = notes_list[notes_list.length - 1];
-
-  for (const note of notes_list) {
-    // Lights
-    try {
-      if (note === lastNote || note === firstNote) {
-        events_list.push({
-          _time: note._time,
-          _type: eventTypes.Lights,
-          _value: eventValues.Off,
-        });
-      } else if (note._time - lastEventTime > eventColorSwapInterval) {
-        let color = 0;
-        let intensity = 'Normal';
-        if (lastEventIntensity === 'Off' || lastEventIntensity === 'FadeOut') {
-          intensity = 'FadeIn';
-          color = lastEventColor === 1 ? 0 : 1;
-        } else if (lastEventIntensity === 'FadeIn') {
-          intensity = 'Normal';
-          color = lastEventColor;
-        } else {
-          intensity = 'FadeOut';
-          color = lastEventColor;
-        }
-        events_list.push({
-          _time: note._time,
-          _type: eventTypes.Lights,
-          _value: eventValues[intensity][color],
-        });
-        lastEventTime = note._time;
-        lastEventColor = color;
-        lastEventIntensity = intensity;
-      }
-    } catch (error) {
-      console.error(`Lights event writing error: ${JSON.stringify(note, null, 2)}`);
-      console.error(error);
-    }
-
-    // Rings
-    try {
-      if (lastEventRing > 2) {
-        lastEventRing = 0;
-      }
-      const ring = lastEventRing > 0 ? 1 : 0;
-      events_list.push({
-        _time: note._time,
-        _type: eventTypes.Rings[ring],
-        _value: eventValues.Off,
-      });
-      lastEventRing++;
-    } catch (error) {
-      console.error(`Rings event writing error: ${JSON.stringify(note, null, 2)}`);
-      console.error(error);
-    }
-
-    // Lasers
-    try {
-      if (note._type !== 3) {
-        events_list.push({
-          _time: note._time,
-          _type: eventTypes.Lasers[1],
-          _value: eventValues.Normal[note._type],
-        });
-      }
-    } catch (error) {
-      console.error(`Lasers event writing error: ${JSON.stringify(note, null, 2)}`);
-      console.error(error);
+  while (job.status === 'queued' || job.status === 'running') {
+    await new Promise(resolve => setTimeout(resolve, pollInterval));
+    job = (await getJob(job.id)).data;
+    if (!job) {
+      throw new Error('Mapping job was lost!');
     }
+    onProgress && onProgress(job);
+  }
+  if (job.status !== 'done') {
+    throw new Error(`Mapping job ${job.status}! ${job.error || ''}`);
   }
-  return events_list;
+  return pythonRequest(`jobs/${job.id}/result`);
 };
-
-export const getObstaclesList = (args: { notes_list: Notes[]; bpm: number }): Obstacles[] => {
-  const { notes_list, bpm } = args;
-  let obstacles_list = [];
-  return obstacles_list;
+export interface SongSegmentation {
+  segments: { start_time: number; end_time: number; start_beat: number; end_beat: number; seg_no: number }[];
+  beat_times: number[];
+  tempo: number;
+}
+export const segmentSong = (song_id: string): Promise<PythonResponseData<SongSegmentation>> =>
+  pythonRequest('segment_song', { song_id });
+export const releaseSong = async (song_id: string) => {
+  return !!(await pythonRequest('release_song', { song_id }));
 };
 
 export const convertMusicFile = async (song_path: string, workingDir: string) => {
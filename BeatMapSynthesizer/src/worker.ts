@@ -14,10 +14,11 @@ import {
   closePythonServer,
   convertMusicFile,
   getBeatFeatures,
-  getEventsList,
-  getNotesList,
-  getObstaclesList,
-  isPythonServerRunning,
+  JobStatus,
+  NotesLists,
+  releaseSong,
+  runNotesListsJob,
+  waitForPythonServer,
 } from './pythonApi';
 import AdmZip from 'adm-zip';
 
@@ -62,7 +63,7 @@ export interface Obstacles {
 export interface Tracks {
   bpm: number;
   beat_times: number[];
-  y: number[];
+  song_id: string;
   sr: number;
   easy: { events_list: Events[]; notes_list: Notes[]; obstacles_list: Obstacles[] };
   normal: { events_list: Events[]; notes_list: Notes[]; obstacles_list: Obstacles[] };
@@ -335,7 +336,8 @@ export class Worker {
       environment: args.environment ?? 'DefaultEnvironment',
       lightsIntensity: args.lightsIntensity ? 11.5 - args.lightsIntensity : 2.5,
       zipFiles: args.zipFiles,
-      seed: seedrandom(song_name, { entropy: true })(),
+      // Unsigned 32-bit integer, seeds the server's random generator
+      seed: seedrandom(song_name, { entropy: true }).int32() >>> 0,
       eventColorSwapOffset: 2.5,
     };
 
@@ -352,7 +354,7 @@ export class Worker {
     this.tracks = {
       bpm: 0,
       beat_times: [],
-      y: [],
+      song_id: '',
       sr: 0,
       easy: { ...baseLists },
       normal: { ...baseLists },
@@ -371,7 +373,14 @@ export class Worker {
 
     await this.runPythonShell();
 
-    if (this.song_args && this.tracks && (await isPythonServerRunning())) {
+    if (
+      this.song_args &&
+      this.tracks &&
+      (await waitForPythonServer(status => this.appendMessageTaskLog(`Python server ${status.phase}`)))
+    ) {
+      // Converting first also hands the decoded song to the server, so loading it doesn't decode it again
+      this.appendMessageTaskLog('Converting music file');
+      await convertMusicFile(this.song_args.song_path, this.song_args.workingDir);
       this.appendMessageTaskLog('Loading Song');
       const modelParams = (await getBeatFeatures(this.song_args.song_path)).data;
       this.tracks = {
@@ -386,36 +395,50 @@ export class Worker {
       ).map(difficulty => difficulty.toLowerCase());
       let processedDifficultes: string[] = [];
       this.appendMessageTaskLog('Mapping');
-      for (const difficulty of difficulties as ('easy' | 'normal' | 'hard' | 'expert' | 'expertplus')[]) {
-        this.appendMessageTaskLog(`Processing ${difficulty}`);
-        try {
-          this.tracks[difficulty].notes_list = (
-            await getNotesList({
+      // Every difficulty is mapped in a single job sharing the song analysis
+      let notesLists: NotesLists | undefined;
+      let lastStage = '';
+      try {
+        notesLists = (
+          await runNotesListsJob(
+            {
               model: this.song_args.model,
-              difficulty: difficulty,
+              difficulties: difficulties,
               beat_times: this.tracks.beat_times,
               bpm: this.tracks.bpm,
               version: this.song_args.version,
-              y: this.tracks.y,
-              sr: this.tracks.sr,
+              song_id: this.tracks.song_id,
               tempDir: this.tempDir,
-            })
-          ).data;
+              seed: this.song_args.seed,
+              level: { color_swap_offset: this.song_args.eventColorSwapOffset },
+            },
+            (job: JobStatus) => {
+              if (job.stage !== lastStage) {
+                lastStage = job.stage;
+                this.appendMessageTaskLog(`Mapping: ${job.stage} (${Math.round(job.percent)}%)`);
+              }
+            }
+          )
+        ).data;
+      } catch (e) {
+        this.error(e);
+      }
+      for (const difficulty of difficulties as ('easy' | 'normal' | 'hard' | 'expert' | 'expertplus')[]) {
+        this.appendMessageTaskLog(`Processing ${difficulty}`);
+        try {
+          const result = notesLists?.results[difficulty];
+          if (result?.error) {
+            throw new Error(result.error);
+          }
+          this.tracks[difficulty].notes_list = result?.data as Notes[];
 
           if (!this.tracks[difficulty].notes_list || !Array.isArray(this.tracks[difficulty].notes_list)) {
             throw new Error(`Notes list was invalid!\n\t${JSON.stringify(this.tracks[difficulty].notes_list)}`);
           }
 
-          this.tracks[difficulty].events_list = getEventsList({
-            notes_list: this.tracks[difficulty].notes_list,
-            bpm: this.tracks.bpm,
-            eventColorSwapOffset: this.song_args.eventColorSwapOffset,
-          });
-
-          this.tracks[difficulty].obstacles_list = getObstaclesList({
-            notes_list: this.tracks[difficulty].notes_list,
-            bpm: this.tracks.bpm,
-          });
+          // Events and obstacles are generated by the server along with the notes
+          this.tracks[difficulty].events_list = result?.events as Events[];
+          this.tracks[difficulty].obstacles_list = result?.obstacles as Obstacles[];
 
           processedDifficultes.push(difficulty);
         } catch (e) {
@@ -425,12 +448,11 @@ export class Worker {
         this.appendMessageTaskLog(`Processing ${difficulty} done!`);
       }
       this.appendMessageTaskLog('Mapping done!');
+      await releaseSong(this.tracks.song_id);
       if (processedDifficultes.length > 0) {
         this.appendMessageTaskLog('Writing files to disk');
         this.writeInfoFile(processedDifficultes);
         this.writeLevelFile(processedDifficultes);
-        this.appendMessageTaskLog('Converting music file');
-        await convertMusicFile(this.song_args.song_path, this.song_args.workingDir);
         this.appendMessageTaskLog('Zipping folder');
         this.zipFiles(processedDifficultes);
         this.appendMessageTaskLog(